@@ -1,38 +1,50 @@
 # app/agent_logic.py
 
 import os
+import re
 import uuid
-import subprocess
+import asyncio
 import operator
-import pandas as pd
-from io import StringIO
-from typing import TypedDict, List, Union, Optional
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+from pathlib import Path
+from typing import TypedDict, List, Optional, Iterator, AsyncIterator, Tuple
 from typing_extensions import Annotated
-from functools import partial
 
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langchain_core.messages import BaseMessage, AIMessage
 from langchain_core.language_models.llms import LLM
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain_core.outputs import GenerationChunk
 from langgraph.graph import StateGraph, END
-from dashscope import MultiModalConversation, Generation
-from http import HTTPStatus
+from langgraph.config import get_stream_writer
 
-import base64
-from openai import OpenAI
 from openai import APIError, RateLimitError # 引入具体的异常类型，便于处理
 
+from app.r_executor import (run_r_script, arun_r_script, get_worker_pool, DEFAULT_R_BACKEND, ALLOWED_R_PACKAGES, R_EXEC_TIMEOUT,
+                             TIMEOUT_ERROR_PREFIX, OOM_ERROR_PREFIX)
+from app.r_static import IncrementalRParser, preflight_check, r_syntax_error
+from app.r_fixes import apply_fix_rules
+from app.r_patch import apply_patch, number_lines, PatchError
+from app.error_history import format_error_history, compact_stderr
+from app.data_reduction import reduce_for_render
+from app.data_ingest import start_ingest
+from app.llm_cache import get_llm_cache
+from app.llm_clients import get_openai_client, get_async_openai_client
+from app.stage_limits import stage_slot, astage_slot
+from app.image_prep import image_to_data_uri
+from app.style_cache import fingerprint_image, columns_key, get_style_cache
+
 # --- 0. LLM Vision Configuration ---
 # doubao vision model
 def encode_image_to_base64(image_path: str) -> str:
     """
-    Reads an image file and encodes it into a Base64 string.
+    Reads an image file and encodes it into a Base64 data URI.
+
+    The image is downscaled, re-encoded and stripped of metadata first (see image_prep.py).
     """
-    image_type = image_path.split('.')[-1].lower()
-    if image_type == 'jpg':
-        image_type = 'jpeg' # 标准的MIME type是jpeg
-    
-    with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-    return f"data:image/{image_type};base64,{encoded_string}"
+    return image_to_data_uri(image_path)
 
 def vision_large_model(prompt: str, image_path: str, api_key: str, model: str, base_url: str) -> str:
     """
@@ -50,48 +62,49 @@ def vision_large_model(prompt: str, image_path: str, api_key: str, model: str, b
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image file not found at: {image_path}")
 
-    client = OpenAI(
-        # 这是豆包大模型在火山引擎方舟平台上的接入点
-        base_url=base_url,
-        # 从参数中获取您的 API Key
-        api_key=api_key
-    )
-
     try:
+        # 复用共享客户端及其长连接池（base_url 为火山引擎方舟平台等接入点）；缺少密钥时在此报错
+        client = get_openai_client(base_url, api_key)
+
         # 1. 将图片编码为 Base64 data URI
         base64_image_url = encode_image_to_base64(image_path)
 
-        # 2. 发送请求
-        response = client.chat.completions.create(
-            # 指定模型 ID
-            model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                # 使用 Base64 编码后的 data URI
-                                "url": base64_image_url
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                    ],
-                }
-            ]
-        )
+        # 2. 发送请求（受进程级视觉调用并发上限约束）
+        with stage_slot("vision"):
+            response = client.chat.completions.create(
+                # 指定模型 ID
+                model=model,
+                messages=_build_vision_messages(prompt, base64_image_url)
+            )
 
         # 3. 返回模型生成的文本内容
-        print("=" * 20 + "思考过程" + "=" * 20)
-        print(f"{response.choices[0].message.reasoning_content}")
-        print("\n" + "=" * 20 + "完整回复" + "=" * 20)
+        return _vision_response_text(response)
+
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        return "Error: Image file not found."
+    except (APIError, RateLimitError) as e:
+        print(f"API call failed: {e}")
+        return f"Error: API call failed - {e}"
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return "Error: An unexpected error occurred."
 
-        #print(f"{response.choices[0].message.content}")
-        return response.choices[0].message.content
+async def avision_large_model(prompt: str, image_path: str, api_key: str, model: str, base_url: str) -> str:
+    """Async counterpart of `vision_large_model`; errors are returned the same way."""
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image file not found at: {image_path}")
+
+    try:
+        client = get_async_openai_client(base_url, api_key)
+        # 图片缩放与编码是CPU/磁盘操作，放到线程中执行，避免阻塞事件循环
+        base64_image_url = await asyncio.to_thread(encode_image_to_base64, image_path)
+        async with astage_slot("vision"):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=_build_vision_messages(prompt, base64_image_url)
+            )
+        return _vision_response_text(response)
 
     except FileNotFoundError as e:
         print(f"Error: {e}")
@@ -103,7 +116,47 @@ def vision_large_model(prompt: str, image_path: str, api_key: str, model: str, b
         print(f"An unexpected error occurred: {e}")
         return "Error: An unexpected error occurred."
 
-def text_large_model(prompt: str, api_key: str, model: str,base_url: str) -> str:
+def _build_vision_messages(prompt: str, image_url: str) -> list:
+    # 图片在前、文本在后的单轮用户消息
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        # 使用 Base64 编码后的 data URI
+                        "url": image_url
+                    },
+                },
+                {
+                    "type": "text",
+                    "text": prompt
+                },
+            ],
+        }
+    ]
+
+def _vision_response_text(response) -> str:
+    # 打印思考过程，返回模型生成的文本内容
+    print("=" * 20 + "思考过程" + "=" * 20)
+    print(f"{response.choices[0].message.reasoning_content}")
+    print("\n" + "=" * 20 + "完整回复" + "=" * 20)
+    return response.choices[0].message.content
+
+def _build_text_messages(prompt: str) -> list:
+    # 构建发送给模型的VSS
+    return [
+        {"role": "system", "content": "你是人工智能助手"},
+        {"role": "user", "content": prompt}
+    ]
+
+def _sampling_params(temperature: Optional[float]) -> dict:
+    # 未指定温度时不传该参数，保持模型默认行为
+    return {} if temperature is None else {"temperature": temperature}
+
+def text_large_model(prompt: str, api_key: str, model: str,base_url: str, use_cache: bool = False,
+                     temperature: Optional[float] = None) -> str:
     """
     使用与OpenAI API兼容的接口调用大型语言模型。
 
@@ -111,6 +164,8 @@ def text_large_model(prompt: str, api_key: str, model: str,base_url: str) -> str
         prompt (str): 要发送给模型的用户输入。
         api_key (str): 用于API调用的认证密钥。
         model (str): 要使用的模型的ID。
+        use_cache (bool): 是否使用按 (base_url, model, prompt hash) 缓存的响应。
+        temperature (float, optional): 采样温度，None 表示使用模型默认值。
 
     Returns:
         str: 模型返回的文本内容。
@@ -118,25 +173,29 @@ def text_large_model(prompt: str, api_key: str, model: str,base_url: str) -> str
     Raises:
         ValueError: 如果API调用失败或发生其他异常。
     """
-    try:
-        # 初始化OpenAI客户端
-        client = OpenAI(
-            base_url=base_url,
-            api_key=api_key,
-        )
+    if use_cache:
+        cache = get_llm_cache()
+        cache_key = cache.make_key(base_url, model, prompt, temperature=temperature)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            print("   > [CACHE] Reusing memoized LLM response.")
+            return cached_response
+        response = text_large_model(prompt, api_key, model, base_url, temperature=temperature)
+        cache.set(cache_key, response)
+        return response
 
-        # 构建发送给模型的VSS
-        messages = [
-            {"role": "system", "content": "你是人工智能助手"},
-            {"role": "user", "content": prompt}
-        ]
-
-        # 发起非流式API调用
-        completion = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=False,  # 确保为非流式调用
-        )
+    try:
+        # 获取共享的OpenAI客户端（复用HTTP长连接）
+        client = get_openai_client(base_url, api_key)
+
+        # 发起非流式API调用（受进程级文本调用并发上限约束）
+        with stage_slot("llm"):
+            completion = client.chat.completions.create(
+                model=model,
+                messages=_build_text_messages(prompt),
+                stream=False,  # 确保为非流式调用
+                **_sampling_params(temperature),
+            )
         
         # 检查响应并返回结果
         if completion.choices and completion.choices[0].message:
@@ -149,7 +208,139 @@ def text_large_model(prompt: str, api_key: str, model: str,base_url: str) -> str
         # 捕获并抛出所有异常，以便上层调用者处理
         raise ValueError(f"调用API时发生异常: {e}")
 
+def text_large_model_stream(prompt: str, api_key: str, model: str, base_url: str, use_cache: bool = False,
+                            temperature: Optional[float] = None) -> Iterator[str]:
+    """
+    以流式方式调用大型语言模型，逐个产出文本片段。
+
+    Args:
+        prompt (str): 要发送给模型的用户输入。
+        api_key (str): 用于API调用的认证密钥。
+        model (str): 要使用的模型的ID。
+        use_cache (bool): 命中缓存时一次性产出完整响应，未命中时在流结束后写入缓存。
+        temperature (float, optional): 采样温度，None 表示使用模型默认值。
+
+    Yields:
+        str: 模型返回的文本片段。关闭生成器会中止请求。
+
+    Raises:
+        ValueError: 如果API调用失败或发生其他异常。
+    """
+    if use_cache:
+        cache = get_llm_cache()
+        cache_key = cache.make_key(base_url, model, prompt, temperature=temperature)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            print("   > [CACHE] Reusing memoized LLM response.")
+            yield cached_response
+            return
+        parts = []
+        for token in text_large_model_stream(prompt, api_key, model, base_url, temperature=temperature):
+            parts.append(token)
+            yield token
+        cache.set(cache_key, "".join(parts))
+        return
+
+    # 流式调用在整个生成期间占用一个文本调用名额
+    with stage_slot("llm"):
+        try:
+            client = get_openai_client(base_url, api_key)
+            stream = client.chat.completions.create(
+                model=model,
+                messages=_build_text_messages(prompt),
+                stream=True,
+                **_sampling_params(temperature),
+            )
+        except Exception as e:
+            raise ValueError(f"调用API时发生异常: {e}")
+
+        # 退出 with 块时关闭HTTP响应，因此提前关闭生成器即可中止生成
+        with stream:
+            try:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                raise ValueError(f"流式调用API时发生异常: {e}")
+
+async def atext_large_model(prompt: str, api_key: str, model: str, base_url: str, use_cache: bool = False,
+                            temperature: Optional[float] = None) -> str:
+    """
+    `text_large_model` 的异步版本，使用 AsyncOpenAI，等待期间不占用线程。
+
+    Raises:
+        ValueError: 如果API调用失败或发生其他异常。
+    """
+    if use_cache:
+        cache = get_llm_cache()
+        cache_key = cache.make_key(base_url, model, prompt, temperature=temperature)
+        cached_response = await asyncio.to_thread(cache.get, cache_key)
+        if cached_response is not None:
+            print("   > [CACHE] Reusing memoized LLM response.")
+            return cached_response
+        response = await atext_large_model(prompt, api_key, model, base_url, temperature=temperature)
+        await asyncio.to_thread(cache.set, cache_key, response)
+        return response
+
+    try:
+        client = get_async_openai_client(base_url, api_key)
+        async with astage_slot("llm"):
+            completion = await client.chat.completions.create(
+                model=model,
+                messages=_build_text_messages(prompt),
+                stream=False,
+                **_sampling_params(temperature),
+            )
+        if completion.choices and completion.choices[0].message:
+            return completion.choices[0].message.content
+        else:
+            raise ValueError("API响应无效：未找到有效的choices。")
+
+    except Exception as e:
+        raise ValueError(f"调用API时发生异常: {e}")
+
+async def atext_large_model_stream(prompt: str, api_key: str, model: str, base_url: str, use_cache: bool = False,
+                                   temperature: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    `text_large_model_stream` 的异步版本。
 
+    Yields:
+        str: 模型返回的文本片段。关闭（aclose）生成器会中止请求。
+    """
+    if use_cache:
+        cache = get_llm_cache()
+        cache_key = cache.make_key(base_url, model, prompt, temperature=temperature)
+        cached_response = await asyncio.to_thread(cache.get, cache_key)
+        if cached_response is not None:
+            print("   > [CACHE] Reusing memoized LLM response.")
+            yield cached_response
+            return
+        parts = []
+        async for token in atext_large_model_stream(prompt, api_key, model, base_url, temperature=temperature):
+            parts.append(token)
+            yield token
+        await asyncio.to_thread(cache.set, cache_key, "".join(parts))
+        return
+
+    async with astage_slot("llm"):
+        try:
+            client = get_async_openai_client(base_url, api_key)
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=_build_text_messages(prompt),
+                stream=True,
+                **_sampling_params(temperature),
+            )
+        except Exception as e:
+            raise ValueError(f"调用API时发生异常: {e}")
+
+        async with stream:
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                raise ValueError(f"流式调用API时发生异常: {e}")
 
 
 class CustomLLM(LLM):
@@ -157,11 +348,81 @@ class CustomLLM(LLM):
     base_url: str
     api_key: str
     model_name: str
+    use_cache: bool = False  # memoize responses for deterministic prompts
+    temperature: Optional[float] = None  # None keeps the model's default
     def _call(self, prompt: str, **kwargs) -> str:
-        return text_large_model(prompt, self.api_key, self.model_name,self.base_url)
+        return text_large_model(prompt, self.api_key, self.model_name,self.base_url, use_cache=self.use_cache,
+                                temperature=self.temperature)
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> Iterator[GenerationChunk]:
+        for token in text_large_model_stream(prompt, self.api_key, self.model_name, self.base_url, use_cache=self.use_cache,
+                                             temperature=self.temperature):
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+    async def _acall(self, prompt: str, **kwargs) -> str:
+        return await atext_large_model(prompt, self.api_key, self.model_name, self.base_url, use_cache=self.use_cache,
+                                       temperature=self.temperature)
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> AsyncIterator[GenerationChunk]:
+        async for token in atext_large_model_stream(prompt, self.api_key, self.model_name, self.base_url,
+                                                    use_cache=self.use_cache, temperature=self.temperature):
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
     @property
     def _llm_type(self) -> str: return "text large model"
 
+def invoke_llm(llm: CustomLLM, prompt: str, state: dict, node_name: str) -> str:
+    """
+    Invokes the LLM, streaming tokens to the UI when `stream_tokens` is set.
+
+    Tokens are sent through LangGraph's stream writer as `{"node", "token"}` dicts and
+    are received by callers that stream the graph with `stream_mode` including "custom".
+    """
+    if not state.get("stream_tokens"):
+        return llm.invoke(prompt)
+    writer = get_stream_writer()
+    parts = []
+    for token in llm.stream(prompt):
+        parts.append(token)
+        writer({"node": node_name, "token": token})
+    return "".join(parts)
+
+def stream_r_code(llm: CustomLLM, prompt: str, state: dict, node_name: str) -> Tuple[str, Optional[str]]:
+    """
+    Streams an R script while parsing it incrementally (pipelined mode).
+
+    A pooled R worker is warmed as soon as the `library()` header arrives, so session
+    startup overlaps with the rest of the generation. If an unrecoverable syntax error
+    shows up mid-stream, the LLM call is aborted and the error is returned.
+
+    Returns:
+        The (possibly partial) completion and the syntax error, if any.
+    """
+    def warm_worker(_library: str):
+        if (state.get("r_backend") or DEFAULT_R_BACKEND) == "pool":
+            print("   > [PIPELINE] Script header received, warming an R worker.")
+            get_worker_pool(Path.cwd()).warm(1)
+
+    parser = IncrementalRParser(on_library=warm_worker, completion=True)
+    writer = get_stream_writer() if state.get("stream_tokens") else None
+    parts = []
+    tokens = llm.stream(prompt)
+    for token in tokens:
+        parts.append(token)
+        if writer:
+            writer({"node": node_name, "token": token})
+        if parser.feed(token):
+            tokens.close()  # stop paying for tokens of a script that cannot parse
+            print(f"   > [PIPELINE] Aborted generation early: {parser.error}")
+            return "".join(parts), parser.error
+    # The complete answer is judged on the script that will actually run
+    response = "".join(parts)
+    return response, r_syntax_error(clean_r_code(response))
+
 # --- 2. Graph State Definition ---
 class GraphState(TypedDict):
     """Represents the state of our graph, including the full script and error history."""
@@ -169,10 +430,19 @@ class GraphState(TypedDict):
     user_request: str
     file_path: str
     reference_image_path: Optional[str]
+    reference_style_spec: Optional[str]  # request-independent description of the reference image
+    style_cache: bool  # reuse style specs of previously analyzed reference images (see style_cache.py)
     output_figure_path: str
     output_pdf_path: str
     output_code_path: str
-    dataframe_head: str
+    data_profile: str  # bounded schema summary and preview of the uploaded data (see data_profiler.py)
+    available_columns: List[str]
+    columnar_data_path: Optional[str]  # Feather copy of the data loaded via __INPUT_DATA__ (see data_ingest.py)
+    columnar_columns: Optional[List[str]]  # its sanitized column names
+    downsample_for_render: bool  # thin dense scatter/volcano regions before rendering
+    data_reduction: Optional[str]  # description of the thinning applied, if any
+    original_row_count: Optional[int]
+    render_row_count: Optional[int]  # rows actually fed to R
     plot_plan: Optional[str]
     bypass_confirmation: bool
     full_r_script: str
@@ -189,17 +459,56 @@ class GraphState(TypedDict):
     vision_model: Optional[str]
     current_step: Optional[str]  # To track the current status for streaming
     max_retries: int
+    r_backend: Optional[str]  # "pool" (warm R sessions) or "docker" (one container per attempt)
+    llm_cache: bool  # memoize validator, planner and coder responses
+    stream_tokens: bool  # emit coder/debugger tokens through the graph's "custom" stream
+    two_phase_render: bool  # attempts render a low-dpi PNG draft; the 300 dpi PNG and the PDF only after QA
+    draft_dpi: Optional[int]
+    parallel_candidates: int  # >1: generate this many scripts concurrently and race them (best-of-N)
+    candidate_scripts: Optional[List[str]]
+    parallel_planning: bool  # validate the data while the plan is generated (speculative planning)
+    debug_patch_mode: bool  # debugger returns line edits to the current script; full rewrite as fallback
+    r_timeout: Optional[float]  # wall-clock limit per R execution, in seconds
+    pipelined_execution: bool  # parse the coder stream incrementally, warm a worker early, abort on syntax errors
+    preflight_failures: Annotated[List[str], operator.add]  # names of the static checks that fired
+    applied_fix_rules: Annotated[List[str], operator.add]  # "rule: error" signatures of deterministic fixes applied
 
 # --- 3. Graph Nodes (Copied directly from your script, no changes needed) ---
 
+def get_available_columns(state: GraphState) -> List[str]:
+    """Returns the data column names recorded by the profiler."""
+    return list(state.get('available_columns') or [])
+
 def qa_image_checker_node(state: GraphState) -> dict:
     print("--- Step 6: Performing QA check on the generated image...")
-    user_request, image_path = state['user_request'], state['plot_image_path']
+    return review_plot_image(state, state['plot_image_path'])
+
+def review_plot_image(state: GraphState, image_path: Optional[str]) -> dict:
+    """
+    Asks the vision model whether the image at `image_path` fulfils the user request.
+
+    Returns:
+        State updates: `qa_feedback` is None when the image passed; `error_message` is set otherwise.
+    """
     if not image_path or not os.path.exists(image_path):
         return {"error_message": "QA Check Failed: Plot image not found for review."}
-    api_key = state["vision_api_key"]
-    vision_model = state["vision_model"]
-    base_url = state["vision_base_url"]
+    try:
+        response = vision_large_model(build_qa_prompt(state), image_path, state["vision_api_key"],
+                                      state["vision_model"], state["vision_base_url"])
+        return parse_qa_response(response)
+    except Exception as e:
+        print(f"   > [ERROR] An exception occurred during QA check: {e}")
+        return {"error_message": f"QA Vision API call failed: {e}"}
+
+def build_qa_prompt(state: GraphState) -> str:
+    user_request = state['user_request']
+    reduction_note = ""
+    if is_two_phase_render(state):
+        reduction_note = "Note: this is a low-resolution draft; judge content and layout, not sharpness.\n"
+    if state.get("data_reduction"):
+        reduction_note += (f"Note: to speed up rendering, the plot was drawn from {state.get('render_row_count')} of "
+                          f"{state.get('original_row_count')} rows. {state['data_reduction']} "
+                          "Do not flag the number of points as an issue.")
     qa_prompt = f"""
 ## YOUR ROLE
 You are a bioinformatics chart quality assurance expert.
@@ -220,51 +529,91 @@ Your response MUST be startwith `MATCH` or `MISMATCH:`. In brief:
 **THE USER REQUEST TO VERIFY:**
 {user_request}
 
+{reduction_note}
 Importantly, avoid any text label being truncated, especially ensembl ID or gene name. You should know the ensembl ID or gene name, double check. Also, text lable must be kept in plot box. Check for horizontal/vertical dashed lines only, do not compare their matched x/y value with user request.
 Now, analyze the attached image and generate your response in the specified format.
 """
-    
-    try:
-        response = vision_large_model(qa_prompt, image_path, api_key, vision_model,base_url).strip()
-        print(response)
-        if response.upper().startswith("MATCH"):
-            print("   > [SUCCESS] QA Check Passed.")
-            return {"qa_feedback": None, "error_message": None}
-        elif response.upper().startswith("MISMATCH:"):
-            feedback = response[len("MISMATCH:"):].strip()
-            print(f"   > [FAILURE] QA Check Failed. Reason: {feedback}")
-            return {"qa_feedback": feedback, "error_message": f"Visual Mismatch: {feedback}"}
-        else:
-            print(f"   > [WARNING] QA Check returned ambiguous response: '{response}'. Assuming mismatch.")
-            return {"qa_feedback": response, "error_message": f"Ambiguous QA Feedback: {response}"}
-    except Exception as e:
-        print(f"   > [ERROR] An exception occurred during QA check: {e}")
-        return {"error_message": f"QA Vision API call failed: {e}"}
+    return qa_prompt
+
+def parse_qa_response(response: str) -> dict:
+    """Turns the vision model's MATCH / MISMATCH verdict into state updates."""
+    response = response.strip()
+    print(response)
+    if response.upper().startswith("MATCH"):
+        print("   > [SUCCESS] QA Check Passed.")
+        return {"qa_feedback": None, "error_message": None}
+    elif response.upper().startswith("MISMATCH:"):
+        feedback = response[len("MISMATCH:"):].strip()
+        print(f"   > [FAILURE] QA Check Failed. Reason: {feedback}")
+        return {"qa_feedback": feedback, "error_message": f"Visual Mismatch: {feedback}"}
+    else:
+        print(f"   > [WARNING] QA Check returned ambiguous response: '{response}'. Assuming mismatch.")
+        return {"qa_feedback": response, "error_message": f"Ambiguous QA Feedback: {response}"}
 
-def image_understanding_node_wrapper(state: GraphState) -> dict:
-    print("--- Step 0: Analyzing reference image and fusing with user request...")
-    image_path, initial_prompt = state.get("reference_image_path"), state['user_request']
+def style_extraction_node(state: GraphState) -> dict:
+    """Describes the reference image's style once; repeat uploads of the same figure are served from the style cache."""
+    print("--- Step 0: Extracting the style of the reference image...")
+    image_path = state.get("reference_image_path")
     api_key = state["vision_api_key"]
     vision_model = state["vision_model"]
     base_url = state["vision_base_url"]
-    try:
-        df_preview = pd.read_csv(StringIO(state['dataframe_head']), sep=r'\s{2,}', engine='python')
-        available_columns = df_preview.columns.tolist()
-    except Exception:
-        available_columns = state['dataframe_head'].split('\n')[0].split()
-    vision_prompt = f"""Analyze the user's text request and the reference image. Your mission is to fuse them into a structured, specific plotting specification. This specification will serve as the sole input for the next agent (the "Planning Agent") to devise a detailed, step-by-step plotting plan. Your job is to define the requirements, not to execute the plan.
+    available_columns = get_available_columns(state)
+    current_status = "Step 0: Analyzing reference image..."
+
+    use_cache = state.get("style_cache", True)
+    fingerprint = fingerprint_image(image_path) if use_cache else None
+    cache_key = columns_key(available_columns, vision_model or "")
+    if fingerprint is not None:
+        cached_spec = get_style_cache().get(fingerprint, cache_key)
+        if cached_spec:
+            print(f"   > [CACHE HIT] Reused the style of a previously analyzed reference image (image {fingerprint.sha256[:12]}).")
+            return {"reference_style_spec": cached_spec, "current_step": current_status}
+
+    style_spec = vision_large_model(build_style_prompt(available_columns), image_path, api_key, vision_model, base_url)
+    if fingerprint is not None and style_spec and not style_spec.startswith("Error:"):
+        get_style_cache().set(fingerprint, cache_key, style_spec)
+    print(f"   > [SUCCESS] Reference image style extracted:\n{'-'*20}\n{style_spec}\n{'-'*20}\n")
+    return {"reference_style_spec": style_spec, "current_step": current_status}
+
+def build_style_prompt(available_columns: List[str]) -> str:
+    return f"""Analyze the attached reference chart and describe its visual style as a structured specification that another agent will combine with a user's request. Describe what the figure looks like, not what the user wants.
+
+**Available Data Columns:** `{', '.join(available_columns)}`
+
+**Describe:**
+- Chart type and every layer (points, lines, bars, labels, reference lines), including how each could map onto the available columns.
+- Colors (as standard R color names) and what they encode, point shapes/sizes and transparency.
+- Horizontal/vertical reference lines, their line types and colors. Pay special attention to dashed lines so they are not overlooked.
+- Text: title, axis titles, labelled items and how labels are placed, legend position and content.
+- Theme: background, grid lines, panel border, aspect ratio.
+
+Use the default font in R. Do not specify x/y-axis ranges.
+"""
+
+def image_understanding_node_wrapper(state: GraphState) -> dict:
+    print("--- Step 0.5: Fusing the reference image style with the user request...")
+    llm = CustomLLM(api_key=state["api_key"], model_name=state["model_name"], base_url=state["base_url"],
+                    use_cache=state.get("llm_cache", False))
+    return fusion_result(llm.invoke(build_fusion_prompt(state)))
+
+def build_fusion_prompt(state: GraphState) -> str:
+    initial_prompt = state['user_request']
+    available_columns = get_available_columns(state)
+    return f"""Fuse the user's text request and the style specification of their reference image into a structured, specific plotting specification. This specification will serve as the sole input for the next agent (the "Planning Agent") to devise a detailed, step-by-step plotting plan. Your job is to define the requirements, not to execute the plan.
 
 **Inputs:**
 - **User's Core Request:** "{initial_prompt}"
-- **The Reference Image:** (attached)
+- **Style Specification of the Reference Image:**
+{state.get('reference_style_spec') or 'Not available.'}
 - **Available Data Columns:** `{', '.join(available_columns)}`
 
 **Output:**
-A Structured Plotting Specification.
+A Structured Plotting Specification. Where the request and the reference image disagree, the user's request wins.
 
 Importantly, color names should be standard R color names, use the default font in R, pay special attention to the dashed lines in the image to ensure they are not overlooked. Unless explicitly stated in user's text request, do not specify x/y-axis ranges. 
 """
-    detailed_request = vision_large_model(vision_prompt, image_path, api_key, vision_model,base_url)
+
+def fusion_result(detailed_request: str) -> dict:
     print(f"   > [SUCCESS] Image and user request fused into a new, detailed plan:\n{'-'*20}\n{detailed_request}\n{'-'*20}\n")
     return {
         "user_request": detailed_request,
@@ -273,12 +622,18 @@ Importantly, color names should be standard R color names, use the default font
 
 def data_validator_node(state: GraphState) -> dict:
     print("--- Step 1: Validating data against user request...")
-    try:
-        df_preview = pd.read_csv(StringIO(state['dataframe_head']), sep=r'\s{2,}', engine='python')
-        available_columns = df_preview.columns.tolist()
-    except Exception:
-        available_columns = state['dataframe_head'].split('\n')[0].split()
-    validator_prompt = f"""You are an expert bioinformatician's assistant. Your task is to determine if the user's plotting request can be fulfilled with the provided data columns. If some column is missing, must check if the information can be preprocessed to create based on provided data.
+    # 1. Get text model settings from the state
+    base_url = state["base_url"]
+    api_key = state["api_key"]
+    model_name = state["model_name"]
+    
+    # 2. Create a temporary, request-specific LLM instance
+    llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url, use_cache=state.get("llm_cache", False))
+    return validation_result(llm.invoke(build_validator_prompt(state)))
+
+def build_validator_prompt(state: GraphState) -> str:
+    available_columns = get_available_columns(state)
+    return f"""You are an expert bioinformatician's assistant. Your task is to determine if the user's plotting request can be fulfilled with the provided data columns. If some column is missing, must check if the information can be preprocessed to create based on provided data.
 
 **User's Request:**
 "{state['user_request']}"
@@ -298,14 +653,9 @@ def data_validator_node(state: GraphState) -> dict:
 - If all necessary information is present (considering synonyms and derivations), respond with only the word: `OK`
 - If a fundamental piece of information is missing, respond with `ERROR:` followed by a brief explanation of what is missing. Example: `ERROR: The request requires a measure of statistical significance (like a p-value or FDR), which is not present in the data.`
 """
-    # 1. Get text model settings from the state
-    base_url = state["base_url"]
-    api_key = state["api_key"]
-    model_name = state["model_name"]
-    
-    # 2. Create a temporary, request-specific LLM instance
-    llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url)
-    response = llm.invoke(validator_prompt).strip()
+
+def validation_result(response: str) -> dict:
+    response = response.strip()
     current_status = "Step 1: Validating data against user request..."
     if response.upper().startswith("ERROR:"):
         error_message = response[len("ERROR:"):].strip()
@@ -317,10 +667,20 @@ def data_validator_node(state: GraphState) -> dict:
 
 def plan_generation_node(state: GraphState) -> dict:
     print("--- Step 2: Generating a full analysis and plotting plan...")
-    planner_prompt = f"""You are a senior R data scientist specializing in the **Grammar of Graphics**. Create a comprehensive, two-part plan based on the user's request and data.
+    # 1. Get text model settings from the state
+    base_url = state["base_url"]
+    api_key = state["api_key"]
+    model_name = state["model_name"]
+    
+    # 2. Create a temporary, request-specific LLM instance
+    llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url, use_cache=state.get("llm_cache", False))
+    return plan_result(llm.invoke(build_planner_prompt(state)))
+
+def build_planner_prompt(state: GraphState) -> str:
+    return f"""You are a senior R data scientist specializing in the **Grammar of Graphics**. Create a comprehensive, two-part plan based on the user's request and data.
 
 **User's Request:** "{state['user_request']}"
-**Data Preview:** "{state['dataframe_head']}"
+**Data Preview:** "{state['data_profile']}"
 
 **Your Task:**
 **Part 1: Data Preprocessing Plan**
@@ -336,20 +696,68 @@ def plan_generation_node(state: GraphState) -> dict:
 
 **CRITICAL CONSTRAINT:** Your entire plan must ONLY rely on functions from the `tidyverse` suite (which includes `ggplot2`, `dplyr`, etc.) and the `ggrepel` package. **Do not suggest any other packages like `ggpubr` or `patchwork` at this stage.** The final output must use column names present in the Data Preview.
 """
-    # 1. Get text model settings from the state
-    base_url = state["base_url"]
-    api_key = state["api_key"]
-    model_name = state["model_name"]
-    
-    # 2. Create a temporary, request-specific LLM instance
-    llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url)
-    plan = llm.invoke(planner_prompt)
+
+def plan_result(plan: str) -> dict:
     print("   > Full plan generated.")
     return {
         "plot_plan": plan,
         "current_step": "Step 2: Generating analysis and plotting plan..."
     }
 
+def speculative_planning_node(state: GraphState) -> dict:
+    """
+    Runs data validation concurrently with planning and discards the plan if validation fails.
+
+    With a reference image, the whole style extraction -> fusion -> planning chain runs
+    alongside the validator, which then checks the user's original request.
+
+    Cost: when validation fails, the tokens the planning branch generated until then are
+    still billed. The plan is streamed so the request is closed as soon as validation
+    fails, and the remaining steps of the branch are skipped; a vision or fusion call
+    already in flight runs to completion in the background.
+    """
+    print("--- Step 1-2: Validating data and generating the plan concurrently...")
+    discarded = threading.Event()
+    def plan_branch() -> dict:
+        updates = {}
+        if state.get("reference_image_path"):
+            for node in (style_extraction_node, image_understanding_node_wrapper):
+                if discarded.is_set():
+                    return updates
+                updates.update(node({**state, **updates}))
+        if discarded.is_set():
+            return updates
+        print("--- Step 2: Generating a full analysis and plotting plan...")
+        planning_state = {**state, **updates}
+        parts = []
+        # Closing the stream aborts the request
+        with closing(text_large_model_stream(build_planner_prompt(planning_state), planning_state["api_key"],
+                                             planning_state["model_name"], planning_state["base_url"],
+                                             use_cache=planning_state.get("llm_cache", False))) as tokens:
+            for token in tokens:
+                if discarded.is_set():
+                    print("   > [INFO] Speculative planning stopped mid-generation.")
+                    return updates
+                parts.append(token)
+        updates.update(plan_result("".join(parts)))
+        return updates
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        validation = executor.submit(data_validator_node, state)
+        planning = executor.submit(plan_branch)
+        validation_result = validation.result()
+        if validation_result.get("error_message"):
+            # The speculative plan is thrown away; stop generating it instead of waiting for it
+            print("   > [INFO] Discarding the speculative plan.")
+            return validation_result
+        plan_updates = planning.result()
+    finally:
+        # A no-op once the plan is done; otherwise the branch stops at its next token or step
+        discarded.set()
+        executor.shutdown(wait=False)
+    return {**plan_updates, "current_step": "Step 2: Data validated and plan generated..."}
+
 def user_confirmation_node(state: GraphState) -> dict:
     print("\n" + "="*60 + "\n          PLEASE CONFIRM THE FULL ANALYSIS PLAN\n" + "="*60 + f"\n{state['plot_plan']}\n" + "="*60)
     if state.get("bypass_confirmation", False):
@@ -361,9 +769,68 @@ def user_confirmation_node(state: GraphState) -> dict:
         if proceed == 'y': return {}
         elif proceed == 'n': return {"error_message": "Task aborted by user."}
 
-def generate_r_code_node(state: GraphState) -> dict:
-    print("--- Step 4: Generating complete R script from the plan...")
-    coder_system_prompt = f"""You are an expert R programmer who writes clean, efficient, and self-contained code. Your task is to convert the following plan into a complete R script.
+def data_reduction_node(state: GraphState) -> dict:
+    """Optionally thins dense regions of large scatter/volcano data before anything is rendered."""
+    if not state.get("downsample_for_render"):
+        return {}
+    print("--- Step 3.5: Checking whether the data can be thinned for rendering...")
+    current_status = "Step 3: Reducing dense data for faster rendering..."
+    try:
+        result = reduce_for_render(state['file_path'], state.get('plot_plan') or "", str(Path(state['output_figure_path']).parent),
+                                   request=state.get('user_request') or "")
+    except Exception as e:
+        print(f"   > [WARNING] Data reduction skipped: {e}")
+        return {"current_step": current_status}
+    if result is None:
+        print("   > No reduction applied; rendering every row.")
+        return {"current_step": current_status}
+    print(f"   > [SUCCESS] {result.description}")
+    return {
+        "file_path": result.file_path,
+        "columnar_data_path": result.columnar_path,
+        "original_row_count": result.rows_in,
+        "render_row_count": result.rows_out,
+        "data_reduction": result.description,
+        "current_step": current_status
+    }
+
+CANDIDATE_TEMPERATURES = (0.2, 0.7, 1.0, 0.45, 0.85)
+
+def generate_candidate_scripts(llm: CustomLLM, prompt: str, num_candidates: int) -> List[str]:
+    """Requests `num_candidates` scripts concurrently, each with a different temperature, and drops failed or duplicate ones."""
+    temperatures = candidate_temperatures(num_candidates)
+    def generate(temperature: float) -> Optional[str]:
+        try:
+            candidate_llm = CustomLLM(api_key=llm.api_key, model_name=llm.model_name, base_url=llm.base_url,
+                                      use_cache=llm.use_cache, temperature=temperature)
+            return clean_r_code(candidate_llm.invoke(prompt))
+        except Exception as e:
+            print(f"   > [WARNING] Candidate generation at temperature {temperature} failed: {e}")
+            return None
+    with ThreadPoolExecutor(max_workers=num_candidates) as executor:
+        scripts = list(executor.map(generate, temperatures))
+    return unique_scripts(scripts)
+
+def candidate_temperatures(num_candidates: int) -> List[float]:
+    return [CANDIDATE_TEMPERATURES[i % len(CANDIDATE_TEMPERATURES)] for i in range(num_candidates)]
+
+def unique_scripts(scripts: List[Optional[str]]) -> List[str]:
+    unique = []
+    for script in scripts:
+        if script and script not in unique:
+            unique.append(script)
+    return unique
+
+def build_coder_prompt(state: GraphState) -> str:
+    if state.get("columnar_data_path"):
+        # The upload was converted once to Feather with read.csv-compatible column names
+        data_input_instruction = (
+            'Read the data using `data <- as.data.frame(arrow::read_feather("__INPUT_DATA__"))`. '
+            f"The loaded data frame has exactly these column names: {', '.join(state.get('columnar_columns') or [])}."
+        )
+    else:
+        data_input_instruction = 'Read the data using `read.csv("__INPUT_FILE__")`.'
+    return f"""You are an expert R programmer who writes clean, efficient, and self-contained code. Your task is to convert the following plan into a complete R script.
 
 **Confirmed Plan:** "{state['plot_plan']}"
 
@@ -374,51 +841,150 @@ def generate_r_code_node(state: GraphState) -> dict:
     library(ggrepel)
     ```
     **DO NOT include any other `library()` calls.**
-2.  **Data Input:** Read the data using `read.csv("__INPUT_FILE__")`.
+2.  **Data Input:** {data_input_instruction}
 3.  **Plot Object:** The final ggplot object MUST be named `final_plot`.
 4.  **Output Files:** You MUST save the final plot in TWO formats using `ggsave()`:
     - **PNG:** `ggsave("__OUTPUT_PNG_FILE__", plot = final_plot, width = 8, height = 6, dpi = 300)`
     - **PDF:** `ggsave("__OUTPUT_PDF_FILE__", plot = final_plot, width = 8, height = 6)`
 5.  **Output Format:** Return ONLY the raw R code. Do not wrap it in markdown backticks (```r...```) or provide any explanations.
 """
-    # 1. Get text model settings from the state
-    base_url = state["base_url"]
-    api_key = state["api_key"]
-    model_name = state["model_name"]
-    
-    # 2. Create a temporary, request-specific LLM instance
-    llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url)
-    response = llm.invoke(coder_system_prompt)
+
+def candidates_result(candidates: List[str]) -> dict:
+    print(f"   > {len(candidates)} candidate R scripts generated.")
+    return {
+        "full_r_script": candidates[0],
+        "candidate_scripts": candidates,
+        "retry_count": 0,
+        "error_history": [],
+        "current_step": f"Step 3: Generated {len(candidates)} candidate R scripts..."
+    }
+
+def aborted_generation_result(response: str, syntax_error: str) -> dict:
+    """The pipelined coder stopped on a syntax error: the partial script goes straight to the debugger."""
+    partial_script = clean_r_code(response)
+    error_msg = f"R syntax error detected while the script was being generated: {syntax_error}"
+    history_entry = f"ATTEMPT 1 FAILED\n--- SCRIPT (generation aborted) ---\n{partial_script}\n--- ERROR ---\n{error_msg}"
+    return {
+        "full_r_script": partial_script,
+        "retry_count": 0,
+        "error_message": error_msg,
+        "error_history": [history_entry],
+        "current_step": "Step 3: Generating R script..."
+    }
+
+def script_result(response: str) -> dict:
     full_script = clean_r_code(response)
     print(full_script)
     print("   > Complete R script generated.")
     return {
         "full_r_script": full_script,
+        "candidate_scripts": None,
         "retry_count": 0,
         "error_history": [],
         "current_step": "Step 3: Generating R script..."
     }
 
-def debug_r_code_node(state: GraphState) -> dict:
-    print(f"--- Debugging Attempt {state['retry_count'] + 1}: Analyzing error...")
+def generate_r_code_node(state: GraphState) -> dict:
+    print("--- Step 4: Generating complete R script from the plan...")
+    coder_system_prompt = build_coder_prompt(state)
+    # 1. Get text model settings from the state
+    base_url = state["base_url"]
+    api_key = state["api_key"]
+    model_name = state["model_name"]
+    
+    # 2. Create a temporary, request-specific LLM instance
+    llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url, use_cache=state.get("llm_cache", False))
+    num_candidates = int(state.get("parallel_candidates") or 1)
+    if num_candidates > 1:
+        candidates = generate_candidate_scripts(llm, coder_system_prompt, num_candidates)
+        if candidates:
+            return candidates_result(candidates)
+        print("   > [WARNING] No candidate script could be generated; falling back to a single script.")
+    if state.get("pipelined_execution"):
+        response, syntax_error = stream_r_code(llm, coder_system_prompt, state, "code_generator")
+        if syntax_error:
+            return aborted_generation_result(response, syntax_error)
+    else:
+        response = invoke_llm(llm, coder_system_prompt, state, "code_generator")
+    return script_result(response)
+
+def _failure_summary(state: GraphState) -> Tuple[str, str]:
+    """Returns the debugger's intro line and the failure description for the current attempt."""
+    qa_feedback = state.get("qa_feedback")
+    if qa_feedback:
+        return f"The script ran, but a QA check failed: '{qa_feedback}'", f"VISUAL QA FAILED\n--- FEEDBACK ---\n{qa_feedback}"
+    history = format_error_history(state.get('error_history', []), include_scripts=False)
+    return "An R script you wrote failed to execute.", history or compact_stderr(state.get('error_message') or "Unknown error.")
+
+def resource_limit_hint(state: GraphState) -> str:
+    """Extra debugger guidance when the last attempt hit the sandbox time or memory limit."""
+    error = state.get("error_message") or ""
+    if error.startswith(TIMEOUT_ERROR_PREFIX):
+        problem = "was stopped because it took too long"
+    elif error.startswith(OOM_ERROR_PREFIX):
+        problem = "was killed because it used too much memory"
+    else:
+        return ""
+    return f"""
+**RESOURCE LIMIT:** The last script {problem}. The code is not necessarily wrong, it is too expensive. Make it cheaper while keeping the requested plot: label only a small subset of points (e.g. the top 10-30 by significance) instead of all of them, give `geom_text_repel`/`geom_label_repel` a finite `max.overlaps` and `max.time`, filter or summarise the data before plotting, and avoid loops, row-wise operations and very large intermediate objects.
+"""
+
+def build_patch_debugger_prompt(state: GraphState) -> str:
+    """Asks for line-range edits against the numbered current script instead of a full rewrite."""
+    intro, failures = _failure_summary(state)
+    return f"""You are an elite R debugger. {intro} Fix the current script with the smallest possible edits.
+
+**Original Plan:** "{state['plot_plan']}"
+**Data Preview:** {state['data_profile']}
+**CURRENT SCRIPT (with line numbers):**
+```
+{number_lines(state['full_r_script'])}
+```
+**ERROR/FEEDBACK HISTORY:**
+---
+{failures}
+---
+**EXECUTION ENVIRONMENT:** Remember, the R script runs in a Docker container with ONLY the `tidyverse` and `ggrepel` packages installed. Your proposed fix MUST NOT require any other libraries.
+{resource_limit_hint(state)}
+**YOUR TASK:**
+1.  **Analyze the failure critically.** In a `<thinking>` block, explain your analysis of the error or QA feedback.
+2.  **Decide on the action:**
+    *   **If you determine the `Visual QA Feedback` is WRONG and the script is already correct:** after the thinking block, respond with ONLY the exact phrase: `NO_CHANGE_NEEDED`
+    *   **Otherwise:** after the thinking block, output ONLY edits to the current script, referring to the line numbers above, in this format (line numbers are not part of the new code):
+```
+@@ REPLACE 12-14
+<new lines replacing lines 12 to 14>
+@@ INSERT AFTER 5
+<new lines inserted after line 5>
+@@ DELETE 20-21
+@@ END
+```
+Do not repeat unchanged lines and do not rewrite the whole script.
+"""
+
+def build_rewrite_debugger_prompt(state: GraphState) -> str:
     qa_feedback = state.get("qa_feedback")
     if qa_feedback:
         error_type_intro = f"The script ran, but a QA check failed: '{qa_feedback}'"
         history_for_prompt = f"VISUAL QA FAILED\n--- FEEDBACK ---\n{qa_feedback}\n\n--- FAULTY SCRIPT ---\n{state['full_r_script']}"
     else:
         error_type_intro = "An R script you wrote failed to execute. Analyze the script, error, and history to provide a corrected, complete script."
-        history_for_prompt = "\n\n".join(state['error_history'])
+        # Errors are reduced to their relevant lines and the history is kept within a token budget;
+        # the failing script is shown in full once and referenced from the history
+        current_script = state.get('full_r_script') or ""
+        history_for_prompt = (f"--- CURRENT SCRIPT ---\n{current_script}\n\n"
+                              + format_error_history(state['error_history'], current_script=current_script))
 
-    debugger_prompt = f"""You are an elite R debugger. {error_type_intro}
+    return f"""You are an elite R debugger. {error_type_intro}
 
 **Original Plan:** "{state['plot_plan']}"
-**Data Preview:** {state['dataframe_head']}
+**Data Preview:** {state['data_profile']}
 **ERROR/FEEDBACK HISTORY:**
 ---
 {history_for_prompt}
 ---
 **EXECUTION ENVIRONMENT:** Remember, the R script runs in a Docker container with ONLY the `tidyverse` and `ggrepel` packages installed. Your proposed fix MUST NOT require any other libraries.
-
+{resource_limit_hint(state)}
 **YOUR TASK:**
 1.  **Analyze the failure critically.** In a `<thinking>` block, explain your analysis of the error or QA feedback.
 2.  **Decide on the action:**
@@ -432,6 +998,16 @@ My analysis of the failure and my correction strategy.
 # If fixing, the complete R script goes here.
 # If QA is wrong, the phrase NO_CHANGE_NEEDED goes here.
 """
+
+def _split_thinking(response: str) -> Tuple[str, str]:
+    thought = ""
+    if "<thinking>" in response:
+        thought = response.split("<thinking>")[1].split("</thinking>")[0].strip()
+        print(f"   > Debugger's thought process: {thought}")
+    return thought, response.split("</thinking>", 1)[-1]
+
+def debug_r_code_node(state: GraphState) -> dict:
+    print(f"--- Debugging Attempt {state['retry_count'] + 1}: Analyzing error...")
     # 1. Get text model settings from the state
     base_url = state["base_url"]
     api_key = state["api_key"]
@@ -439,14 +1015,35 @@ My analysis of the failure and my correction strategy.
     
     # 2. Create a temporary, request-specific LLM instance
     llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url)
-    response = llm.invoke(debugger_prompt)
-    thought = ""
-    if "<thinking>" in response:
-        thought = response.split("<thinking>")[1].split("</thinking>")[0].strip()
-        print(f"   > Debugger's thought process: {thought}")
-    
-    fixed_script_or_signal = clean_r_code(response)
-
+    fixed_script_or_signal = None
+    if state.get("debug_patch_mode") and state.get("full_r_script"):
+        response = invoke_llm(llm, build_patch_debugger_prompt(state), state, "code_debugger")
+        fixed_script_or_signal = apply_debugger_patch(state, response)
+
+    if fixed_script_or_signal is None:
+        response = invoke_llm(llm, build_rewrite_debugger_prompt(state), state, "code_debugger")
+        _split_thinking(response)
+        fixed_script_or_signal = clean_r_code(response)
+    return debugger_result(state, fixed_script_or_signal)
+
+def apply_debugger_patch(state: GraphState, response: str) -> Optional[str]:
+    """Applies a patch-mode answer; returns the patched script, "NO_CHANGE_NEEDED", or None to ask for a rewrite."""
+    _, answer = _split_thinking(response)
+    if answer.strip().strip("`").strip() == "NO_CHANGE_NEEDED":
+        return "NO_CHANGE_NEEDED"
+    try:
+        patched = apply_patch(state['full_r_script'], answer)
+        syntax_error = r_syntax_error(patched)
+        if syntax_error:
+            raise PatchError(f"patched script does not parse: {syntax_error}")
+        print(f"   > [PATCH] Applied the debugger's edits ({len(answer)} characters instead of a "
+              f"{len(patched)}-character rewrite).")
+        return patched
+    except PatchError as e:
+        print(f"   > [WARNING] Patch could not be applied ({e}); asking for a full rewrite.")
+        return None
+
+def debugger_result(state: GraphState, fixed_script_or_signal: str) -> dict:
     current_status = f"Step 6: Debugging R script (Attempt {state['retry_count'] + 1})..."
     if fixed_script_or_signal.strip() == "NO_CHANGE_NEEDED":
         print("   > [INFO] Debugger determined the code is correct and is overriding the QA feedback.")
@@ -471,69 +1068,317 @@ def clean_r_code(code_string: str) -> str:
     elif code_string.strip().startswith("```"):
         code_string = "\n".join(code_string.strip().split('\n')[1:-1])
     return code_string.strip()
-from pathlib import Path
-def execute_r_code_node(state: GraphState) -> dict:
+
+def preflight_check_node(state: GraphState) -> dict:
+    """Statically checks the script so cheap-to-find mistakes skip the docker round trip."""
     attempt_num = state.get('retry_count', 0)
-    print(f"--- Step 5 (Execution Attempt {attempt_num + 1})...")
-    full_script = state.get('full_r_script')
-    if not full_script: return {"error_message": "No R script was generated."}
-    
+    print(f"--- Step 4.5 (Pre-flight Check, Attempt {attempt_num + 1})...")
+    current_status = f"Step 4: Checking R script before execution (Attempt {attempt_num + 1})..."
+    full_script = state.get('full_r_script') or ""
+    issues = preflight_check(full_script, get_available_columns(state), ALLOWED_R_PACKAGES)
+    # The column check is heuristic: block on it once, then let the sandbox be the judge
+    if "columns" in state.get("preflight_failures", []):
+        issues = [issue for issue in issues if issue[0] != "columns"]
+    if not issues:
+        print("   > [SUCCESS] Pre-flight checks passed.")
+        return {"current_step": current_status}
+
+    fired = [name for name, _ in issues]
+    error_msg = "Pre-flight check failed:\n" + "\n".join(f"- [{name}] {message}" for name, message in issues)
+    print(f"   > [FAILURE] {error_msg}")
+    history_entry = f"ATTEMPT {attempt_num + 1} FAILED PRE-FLIGHT CHECKS\n--- SCRIPT ---\n{full_script}\n--- ERROR ---\n{error_msg}"
+    return {
+        "error_message": error_msg,
+        "error_history": [history_entry],
+        "preflight_failures": fired,
+        "current_step": current_status
+    }
+
+def rule_fixer_node(state: GraphState) -> dict:
+    """Tries deterministic fixes for known failure patterns before falling back to the LLM debugger."""
+    print("--- Step 5.5: Trying rule-based fixes for the pre-flight or execution error...")
+    current_status = "Step 5: Trying known fixes for the R error..."
+    result = apply_fix_rules(
+        state.get('full_r_script') or "",
+        state.get('error_message') or "",
+        {"available_columns": get_available_columns(state)},
+        already_applied=state.get("applied_fix_rules", [])
+    )
+    if result is None:
+        print("   > No fix rule matched; handing over to the LLM debugger.")
+        return {"current_step": current_status}
+    signature, fixed_script = result
+    print(f"   > [SUCCESS] Applied fix rule '{signature}'.")
+    return {
+        "full_r_script": fixed_script,
+        "error_message": None,
+        "applied_fix_rules": [signature],
+        "current_step": current_status
+    }
+
+DRAFT_RENDER_DPI = 100
+DRAFT_FIGURE_NAME = "draft_figure.png"
+
+# Prepended to draft attempts: PNGs are written at the draft dpi (same size in inches, so the
+# layout is unchanged) and the PDF export is skipped until the final render.
+_DRAFT_GGSAVE_PRELUDE = (
+    "ggsave <- function(filename, plot = ggplot2::last_plot(), ..., dpi = 300) "
+    "{ if (grepl('[.]pdf$', filename, ignore.case = TRUE)) return(invisible(filename)); "
+    "ggplot2::ggsave(filename, plot = plot, ..., dpi = __DRAFT_DPI__) }\n"
+)
+
+# Namespaced calls would bypass the prelude's `ggsave`, so they are routed through it
+_NAMESPACED_GGSAVE_PATTERN = re.compile(r"\bggplot2\s*::\s*ggsave\s*\(")
+
+def is_two_phase_render(state: GraphState) -> bool:
+    return bool(state.get("two_phase_render"))
+
+def draft_prelude(state: GraphState) -> str:
+    if not is_two_phase_render(state):
+        return ""
+    return _DRAFT_GGSAVE_PRELUDE.replace("__DRAFT_DPI__", str(int(state.get("draft_dpi") or DRAFT_RENDER_DPI)))
+
+def draft_figure_path(state: GraphState) -> Path:
+    return Path(state['output_figure_path']).parent / DRAFT_FIGURE_NAME
+
+def run_r_with_placeholders(state: GraphState, script: str, png_path: Path, prelude: str = "",
+                            pdf_path: Optional[Path] = None, abort: Optional[threading.Event] = None):
+    """Fills the input/output placeholders of `script`, writes it next to the outputs and runs it until done or `abort` is set."""
+    columnar_ready = columnar_ingest(state).result() if state.get("columnar_data_path") else False
+    return run_r_script(**prepare_r_run(state, script, png_path, prelude, pdf_path, columnar_ready), abort=abort)
+
+async def arun_r_with_placeholders(state: GraphState, script: str, png_path: Path, prelude: str = "",
+                                   pdf_path: Optional[Path] = None):
+    """Async counterpart of `run_r_with_placeholders`."""
+    columnar_ready = await asyncio.wrap_future(columnar_ingest(state)) if state.get("columnar_data_path") else False
+    return await arun_r_script(**prepare_r_run(state, script, png_path, prelude, pdf_path, columnar_ready))
+
+def columnar_ingest(state: GraphState):
+    """The conversion to the columnar file behind `__INPUT_DATA__`; started now if the worker did not start it."""
+    return start_ingest(state['file_path'], state['columnar_data_path'])
+
+# `read_feather("__INPUT_DATA__")` calls, replaced by a CSV read if the columnar copy could not be written
+_FEATHER_READ_PATTERN = re.compile(r"""(?:arrow::)?read_feather\(\s*["']__INPUT_DATA__["'][^)]*\)""")
+
+def prepare_r_run(state: GraphState, script: str, png_path: Path, prelude: str = "",
+                  pdf_path: Optional[Path] = None, columnar_ready: bool = True) -> dict:
+    """Writes `script` with its placeholders filled next to the outputs; returns the `run_r_script` arguments."""
     project_root_host = Path.cwd()
-    project_root_container = Path("/work")
     file_path_relative = Path(state['file_path']).relative_to(project_root_host)
-    output_figure_path_relative = Path(state['output_figure_path']).relative_to(project_root_host)
-    output_pdf_path_relative = Path(state['output_pdf_path']).relative_to(project_root_host)
-    
-    script_with_paths = full_script.replace("__INPUT_FILE__", file_path_relative.as_posix())
-    script_with_paths = script_with_paths.replace("__OUTPUT_PNG_FILE__", output_figure_path_relative.as_posix())
+    output_pdf_path_relative = Path(pdf_path or state['output_pdf_path']).relative_to(project_root_host)
+
+    if state.get("columnar_data_path") and not columnar_ready:
+        # read.csv sanitizes column names like the columnar copy would have, so the script is unaffected
+        print("   > [WARNING] Columnar data unavailable, loading the CSV instead.")
+        script = _FEATHER_READ_PATTERN.sub('read.csv("__INPUT_FILE__")', script)
+    if prelude:
+        script = _NAMESPACED_GGSAVE_PATTERN.sub("ggsave(", script)
+    script_with_paths = prelude + script.replace("__INPUT_FILE__", file_path_relative.as_posix())
+    if state.get("columnar_data_path") and columnar_ready:
+        columnar_path_relative = Path(state['columnar_data_path']).relative_to(project_root_host)
+        script_with_paths = script_with_paths.replace("__INPUT_DATA__", columnar_path_relative.as_posix())
+    script_with_paths = script_with_paths.replace("__OUTPUT_PNG_FILE__", Path(png_path).relative_to(project_root_host).as_posix())
     script_with_paths = script_with_paths.replace("__OUTPUT_PDF_FILE__", output_pdf_path_relative.as_posix())
-    
+
     temp_dir = Path(state['output_figure_path']).parent
     script_path_host = temp_dir / f"temp_script_{uuid.uuid4()}.R"
     script_path_relative = script_path_host.relative_to(project_root_host)
     with open(script_path_host, "w", encoding='utf-8') as f: f.write(script_with_paths)
 
+    # "pool" reuses a warm R session; "docker" starts a new container per attempt
+    backend = state.get("r_backend") or DEFAULT_R_BACKEND
+    timeout = float(state.get("r_timeout") or R_EXEC_TIMEOUT)
+    return {"script_path_relative": script_path_relative, "project_root": project_root_host,
+            "backend": backend, "timeout": timeout}
+
+def execution_target(state: GraphState) -> Tuple[Path, str]:
+    """PNG path and ggsave prelude of an attempt; in two-phase mode attempts only render a low-dpi PNG draft for QA."""
+    if is_two_phase_render(state):
+        return draft_figure_path(state), draft_prelude(state)
+    return Path(state['output_figure_path']), draft_prelude(state)
 
-    # R命令：先安装ggrepel（如果不存在），然后执行我们的目标脚本
-    # `repos`参数指定了CRAN镜像，可以加快下载速度
-    r_command = f"if(!require('ggrepel', quietly = TRUE)) install.packages('ggrepel'); source('{script_path_relative.as_posix()}')"
-    current_status = f"Step 4: Executing R script (Attempt {attempt_num + 1})..."    
+def execution_result(state: GraphState, result, png_path: Path) -> dict:
+    attempt_num = state.get('retry_count', 0)
+    full_script = state.get('full_r_script')
+    current_status = f"Step 4: Executing R script (Attempt {attempt_num + 1})..."
+    #print(result)
+    if result.returncode != 0:
+        error_msg = result.stderr.strip()
+        print(f"   > [FAILURE] Attempt {attempt_num + 1} failed.")
+        history_entry = f"ATTEMPT {attempt_num + 1} FAILED\n--- SCRIPT ---\n{full_script}\n--- ERROR ---\n{error_msg}"
+        return {"error_message": error_msg, "error_history": [history_entry],"current_step": current_status}
+    else:
+        print(f"   > [SUCCESS] Script executed on attempt {attempt_num + 1}.")
+        return {"plot_image_path": str(png_path), "error_message": None,"current_step": current_status}
+
+DOCKER_NOT_FOUND_ERROR = "docker command not found. Ensure Docker is installed and in your system's PATH."
+
+def execute_r_code_node(state: GraphState) -> dict:
+    attempt_num = state.get('retry_count', 0)
+    print(f"--- Step 5 (Execution Attempt {attempt_num + 1})...")
+    full_script = state.get('full_r_script')
+    if not full_script: return {"error_message": "No R script was generated."}
+
+    png_path, prelude = execution_target(state)
+    current_status = f"Step 4: Executing R script (Attempt {attempt_num + 1})..."
     try:
-        #result = subprocess.run(["Rscript", script_path], capture_output=True, text=True, check=False)
-        workdir_path_str = project_root_container.as_posix() # This will be the string "/work"
-        
-        # Construct the volume mapping string
-        volume_mapping = f"{project_root_host}:{workdir_path_str}"
-        result = subprocess.run(
-            [
-                "docker", "run", "--rm",
-                f"--volume={volume_mapping}",
-                f"--workdir={workdir_path_str}", # This now passes the pure string "/work"
-                "docker.io/rocker/tidyverse:latest",                                      
-                "R", "-e", r_command                            
-            ],
-            capture_output=True, encoding='utf-8', check=False, errors='replace'
-        )
-        #print(result)
-        if result.returncode != 0:
-            error_msg = result.stderr.strip()
-            print(f"   > [FAILURE] Attempt {attempt_num + 1} failed.")
-            history_entry = f"ATTEMPT {attempt_num + 1} FAILED\n--- SCRIPT ---\n{full_script}\n--- ERROR ---\n{error_msg}"
-            return {"error_message": error_msg, "error_history": [history_entry],"current_step": current_status}
-        else:
-            print(f"   > [SUCCESS] Script executed on attempt {attempt_num + 1}.")
-            return {"plot_image_path": state['output_figure_path'], "error_message": None,"current_step": current_status}
+        result = run_r_with_placeholders(state, full_script, png_path, prelude)
+        return execution_result(state, result, png_path)
     except FileNotFoundError:
-        return {"error_message": "Rscript command not found. Ensure R is installed and in your system's PATH.","current_step": current_status}
+        return {"error_message": DOCKER_NOT_FOUND_ERROR,"current_step": current_status}
+
+def race_candidates_node(state: GraphState) -> dict:
+    """
+    Checks, executes and reviews all candidate scripts in parallel; the first one to pass QA wins.
+
+    Once a winner is found, queued candidates are cancelled and running ones are aborted:
+    R jobs give up their "r" slot wait or are killed in their sandbox. If none passes,
+    the most promising failure (a script that rendered, else the first error) goes to the debugger.
+    """
+    candidates = state.get("candidate_scripts") or []
+    print(f"--- Step 5 (Racing {len(candidates)} candidate scripts)...")
+    temp_dir = Path(state['output_figure_path']).parent
+    winner_found = threading.Event()
+    columns = get_available_columns(state)
+
+    def attempt(index: int, script: str) -> dict:
+        label = f"Candidate {index + 1}"
+        preflight_error = candidate_preflight_error(script, columns)
+        if preflight_error:
+            return {"index": index, "stage": "preflight", "error": preflight_error}
+        if winner_found.is_set():
+            return {"index": index, "stage": "cancelled"}
+        png_path = temp_dir / f"candidate_{index + 1}.png"
+        pdf_path = temp_dir / f"candidate_{index + 1}.pdf"
+        result = run_r_with_placeholders(state, script, png_path, draft_prelude(state), pdf_path=pdf_path,
+                                         abort=winner_found)
+        if result.aborted or winner_found.is_set():
+            return {"index": index, "stage": "cancelled"}
+        if result.returncode != 0:
+            print(f"   > [FAILURE] {label} failed to execute.")
+            return {"index": index, "stage": "execution", "error": result.stderr.strip()}
+        review = review_plot_image(state, str(png_path))
+        if review.get("error_message"):
+            print(f"   > [FAILURE] {label} did not pass QA.")
+            return {"index": index, "stage": "qa", "error": review["error_message"],
+                    "qa_feedback": review.get("qa_feedback"), "png_path": png_path, "pdf_path": pdf_path}
+        winner_found.set()
+        print(f"   > [SUCCESS] {label} passed QA.")
+        return {"index": index, "stage": "passed", "png_path": png_path, "pdf_path": pdf_path}
+
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    futures = [executor.submit(attempt, i, script) for i, script in enumerate(candidates)]
+    outcomes = []
+    try:
+        for future in as_completed(futures):
+            try:
+                outcome = future.result()
+            except Exception as e:
+                outcome = {"index": futures.index(future), "stage": "execution", "error": str(e)}
+            outcomes.append(outcome)
+            if outcome["stage"] == "passed":
+                break
     finally:
-        pass
+        # Aborts the losers' R jobs (also on an error here) without waiting for their threads to wind down
+        winner_found.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    copy_winner_outputs(state, outcomes)
+    return race_result(state, candidates, outcomes)
+
+def copy_winner_outputs(state: GraphState, outcomes: List[dict]):
+    """Copies the winning candidate's PNG and PDF to the final outputs (single-phase mode only)."""
+    winner = next((o for o in outcomes if o["stage"] == "passed"), None)
+    if winner and not is_two_phase_render(state):
+        shutil.copyfile(winner["png_path"], state['output_figure_path'])
+        if Path(winner["pdf_path"]).exists():
+            shutil.copyfile(winner["pdf_path"], state['output_pdf_path'])
+
+def candidate_preflight_error(script: str, columns: List[str]) -> Optional[str]:
+    issues = [issue for issue in preflight_check(script, columns, ALLOWED_R_PACKAGES) if issue[0] != "columns"]
+    if not issues:
+        return None
+    return "Pre-flight check failed:\n" + "\n".join(f"- [{name}] {message}" for name, message in issues)
+
+def race_result(state: GraphState, candidates: List[str], outcomes: List[dict]) -> dict:
+    """Keeps the winning candidate, or hands the most promising failure to the debugger."""
+    current_status = f"Step 4: Executing {len(candidates)} candidate R scripts in parallel..."
+    winner = next((o for o in outcomes if o["stage"] == "passed"), None)
+    if winner:
+        script = candidates[winner["index"]]
+        return {
+            "full_r_script": script,
+            "plot_image_path": str(winner["png_path"]),
+            "candidate_scripts": None,
+            "qa_feedback": None,
+            "error_message": None,
+            "current_step": current_status
+        }
+
+    # Prefer a candidate that rendered (only QA feedback to address) over one that crashed
+    stage_rank = {"qa": 0, "execution": 1, "preflight": 2}
+    failures = sorted((o for o in outcomes if o["stage"] in stage_rank), key=lambda o: (stage_rank[o["stage"]], o["index"]))
+    if not failures:
+        return {"candidate_scripts": None, "error_message": "No candidate script could be executed.", "current_step": current_status}
+    best = failures[0]
+    script = candidates[best["index"]]
+    print(f"   > [FAILURE] No candidate passed; debugging candidate {best['index'] + 1} ({best['stage']}).")
+    history_entry = f"ATTEMPT 1 FAILED\n--- SCRIPT ---\n{script}\n--- ERROR ---\n{best['error']}"
+    return {
+        "full_r_script": script,
+        "plot_image_path": str(best["png_path"]) if best.get("png_path") else None,
+        "candidate_scripts": None,
+        "qa_feedback": best.get("qa_feedback"),
+        "error_message": best["error"],
+        "error_history": [history_entry],
+        "current_step": current_status
+    }
+
+def final_render_node(state: GraphState) -> dict:
+    """Renders the full-resolution PNG and the PDF once a draft has been accepted (two-phase mode only)."""
+    if not is_two_phase_render(state):
+        return {}
+    print("--- Step 6.5: Rendering the final 300 dpi PNG and PDF...")
+    current_status = "Step 5: Rendering final figure..."
+    try:
+        result = run_r_with_placeholders(state, state['full_r_script'], Path(state['output_figure_path']))
+    except FileNotFoundError:
+        return {"error_message": DOCKER_NOT_FOUND_ERROR, "current_step": current_status}
+    return final_render_result(state, result)
+
+def final_render_result(state: GraphState, result) -> dict:
+    current_status = "Step 5: Rendering final figure..."
+    if result.returncode != 0:
+        error_msg = result.stderr.strip()
+        print(f"   > [FAILURE] Final render failed: {error_msg}")
+        return {"error_message": f"Final render failed: {error_msg}", "current_step": current_status}
+    print("   > [SUCCESS] Final figure rendered.")
+    return {"plot_image_path": state['output_figure_path'], "error_message": None, "current_step": current_status}
 
 def interpret_error_for_user(state: GraphState) -> str:
     """
     Uses an LLM to interpret the final error and provide actionable advice to the user.
     """
+    try:
+        # 1. Get text model settings from the state
+        base_url = state["base_url"]
+        api_key = state["api_key"]
+        model_name = state["model_name"]
+    
+        # 2. Create a temporary, request-specific LLM instance
+        llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url)
+        user_friendly_error = llm.invoke(build_error_interpreter_prompt(state))
+        return user_friendly_error
+    except Exception as e:
+        print(f"Error while interpreting error for user: {e}")
+        return fallback_error_message(state)
+
+def fallback_error_message(state: GraphState) -> str:
+    final_error = state.get('error_message', 'Unknown error.')
+    return f"I'm sorry, I encountered an unrecoverable error. The final technical error was: {final_error}. Please check your data and request, paying close attention to column names."
+
+def build_error_interpreter_prompt(state: GraphState) -> str:
     user_request = state['user_request']
-    dataframe_head = state['dataframe_head']
+    available_columns = get_available_columns(state)
     final_error = state.get('error_message', 'Unknown error.')
     full_script = state.get('full_r_script')
 
@@ -542,7 +1387,7 @@ You are a helpful and empathetic AI assistant for a tool called `ggplotagent`. Y
 
 **Context:**
 - **User's Original Request:** "{user_request}"
-- **Data Columns Available:** `{dataframe_head.splitlines()[0]}`
+- **Data Columns Available:** `{', '.join(available_columns)}`
 - **The Final Error Message:** "{final_error}"
 - **The R Script that Failed (if any):** 
 ```R
@@ -575,26 +1420,16 @@ The R code failed because it couldn't find the column named `logFC` in your data
 
 Importantly, Output should be startwith `I'm sorry`.
 """
-    try:
-        # 1. Get text model settings from the state
-        base_url = state["base_url"]
-        api_key = state["api_key"]
-        model_name = state["model_name"]
-    
-        # 2. Create a temporary, request-specific LLM instance
-        llm = CustomLLM(api_key=api_key, model_name=model_name, base_url=base_url)
-        user_friendly_error = llm.invoke(prompt)
-        return user_friendly_error
-    except Exception as e:
-        print(f"Error while interpreting error for user: {e}")
-        return f"I'm sorry, I encountered an unrecoverable error. The final technical error was: {final_error}. Please check your data and request, paying close attention to column names."
+    return prompt
 
 
 def handle_error_node(state: GraphState) -> dict:
     """
     Handles final errors by interpreting them for the user and returning a friendly message.
     """
-    error_msg_for_user = interpret_error_for_user(state)
+    return error_result(interpret_error_for_user(state))
+
+def error_result(error_msg_for_user: str) -> dict:
     print(f"\n--- Task Ended with an Unrecoverable Error ---\nUser-Facing Message:\n{error_msg_for_user}")
     
     return {
@@ -615,59 +1450,110 @@ def save_and_finish_node(state: GraphState) -> dict:
 
 
 # --- 4. Graph Builder ---
-def create_agent_runnable():
-    """Builds and compiles the langgraph agent."""
+# Default implementation of every graph node, by node name
+AGENT_NODES = {
+    "style_extractor": style_extraction_node,
+    "image_analyzer": image_understanding_node_wrapper,
+    "data_validator": data_validator_node,
+    "plan_generator": plan_generation_node,
+    "speculative_planner": speculative_planning_node,
+    "user_confirmer": user_confirmation_node,
+    "data_reducer": data_reduction_node,
+    "code_generator": generate_r_code_node,
+    "candidate_racer": race_candidates_node,
+    "preflight_checker": preflight_check_node,
+    "code_executor": execute_r_code_node,
+    "rule_fixer": rule_fixer_node,
+    "qa_image_checker": qa_image_checker_node,
+    "code_debugger": debug_r_code_node,
+    "final_renderer": final_render_node,
+    "save_and_finish": save_and_finish_node,
+    "handle_error": handle_error_node,
+}
+
+def create_agent_runnable(node_overrides: Optional[dict] = None):
+    """
+    Builds and compiles the langgraph agent.
+
+    Args:
+        node_overrides: Replacement implementations by node name, e.g. the async nodes
+            of async_agent.py. The graph's structure and routing are unchanged.
+    """
     workflow = StateGraph(GraphState)
 
     # Add nodes
-    workflow.add_node("image_analyzer", image_understanding_node_wrapper)
-    workflow.add_node("data_validator", data_validator_node)
-    workflow.add_node("plan_generator", plan_generation_node)
-    workflow.add_node("user_confirmer", user_confirmation_node)
-    workflow.add_node("code_generator", generate_r_code_node)
-    workflow.add_node("code_executor", execute_r_code_node)
-    workflow.add_node("qa_image_checker", qa_image_checker_node)
-    workflow.add_node("code_debugger", debug_r_code_node)
-    workflow.add_node("save_and_finish", save_and_finish_node)
-    workflow.add_node("handle_error", handle_error_node)
+    nodes = dict(AGENT_NODES)
+    nodes.update(node_overrides or {})
+    for name, node in nodes.items():
+        workflow.add_node(name, node)
 
     # Define routing logic
     def initial_router(state: GraphState) -> str:
-        return "image_analyzer" if state.get("reference_image_path") else "data_validator"
+        if state.get("parallel_planning"):
+            return "speculative_planner"
+        return "style_extractor" if state.get("reference_image_path") else "data_validator"
     def route_after_validation(state: GraphState):
         return "handle_error" if state.get("error_message") else "plan_generator"
+    def route_after_speculative_planning(state: GraphState):
+        return "handle_error" if state.get("error_message") else "user_confirmer"
     def route_after_confirmation(state: GraphState):
-        return "handle_error" if state.get("error_message") else "code_generator"
+        return "handle_error" if state.get("error_message") else "data_reducer"
+    def route_after_generation(state: GraphState) -> str:
+        # Pipelined generation may abort early on a syntax error; send it straight to the debugger
+        if state.get("error_message"):
+            return "code_debugger"
+        return "candidate_racer" if len(state.get("candidate_scripts") or []) > 1 else "preflight_checker"
+    def route_after_race(state: GraphState) -> str:
+        if not state.get("error_message"):
+            return "final_renderer"
+        return "handle_error" if state.get("retry_count", 0) >= state.get("max_retries", 3) else "code_debugger"
+    def route_after_preflight(state: GraphState) -> str:
+        # Static failures such as an unquoted placeholder are often mechanical too
+        return "rule_fixer" if state.get("error_message") else "code_executor"
     def route_after_execution(state: GraphState) -> str:
+        # Known failure patterns are repaired deterministically first
+        return "rule_fixer" if state.get("error_message") else "qa_image_checker"
+    def route_after_rule_fix(state: GraphState) -> str:
         max_retries = state.get("max_retries", 3)
-        if state.get("error_message"):
-            return "handle_error" if state.get("retry_count", 0) >= max_retries else "code_debugger"
-        return "qa_image_checker"
+        if not state.get("error_message"):
+            return "preflight_checker"
+        return "handle_error" if state.get("retry_count", 0) >= max_retries else "code_debugger"
+    def route_after_final_render(state: GraphState) -> str:
+        # QA_OVERRIDE is left in error_message when two-phase rendering is off
+        error = state.get("error_message")
+        return "handle_error" if error and error != "QA_OVERRIDE" else "save_and_finish"
     def route_after_qa(state: GraphState) -> str:
         max_retries = state.get("max_retries", 3)
-        if not state.get("qa_feedback"): return "save_and_finish"
+        if not state.get("qa_feedback"): return "final_renderer"
         return "handle_error" if state.get("retry_count", 0) >= max_retries else "code_debugger"
 
     # NEW routing function to handle the debugger's decision
     def route_from_debugger(state: GraphState) -> str:
-        """If QA was overridden, finish. Otherwise, re-run the code."""
+        """If QA was overridden, render and finish. Otherwise, check and re-run the code."""
         if state.get("error_message") == "QA_OVERRIDE":
-            return "save_and_finish"
-        return "code_executor"
+            return "final_renderer"
+        return "preflight_checker"
 
     # Set entry point and define workflow
-    workflow.set_conditional_entry_point(initial_router, {"image_analyzer": "image_analyzer", "data_validator": "data_validator"})
+    workflow.set_conditional_entry_point(initial_router, {"speculative_planner": "speculative_planner", "style_extractor": "style_extractor", "data_validator": "data_validator"})
+    workflow.add_conditional_edges("speculative_planner", route_after_speculative_planning, {"user_confirmer": "user_confirmer", "handle_error": "handle_error"})
+    workflow.add_edge("style_extractor", "image_analyzer")
     workflow.add_edge("image_analyzer", "data_validator")
     workflow.add_conditional_edges("data_validator", route_after_validation, {"plan_generator": "plan_generator", "handle_error": "handle_error"})
     workflow.add_edge("plan_generator", "user_confirmer")
-    workflow.add_conditional_edges("user_confirmer", route_after_confirmation, {"code_generator": "code_generator", "handle_error": "handle_error"})
-    workflow.add_edge("code_generator", "code_executor")
-    workflow.add_conditional_edges("code_executor", route_after_execution, {"code_debugger": "code_debugger", "qa_image_checker": "qa_image_checker", "handle_error": "handle_error"})
-    workflow.add_conditional_edges("qa_image_checker", route_after_qa, {"save_and_finish": "save_and_finish", "code_debugger": "code_debugger", "handle_error": "handle_error"})
+    workflow.add_conditional_edges("user_confirmer", route_after_confirmation, {"data_reducer": "data_reducer", "handle_error": "handle_error"})
+    workflow.add_edge("data_reducer", "code_generator")
+    workflow.add_conditional_edges("code_generator", route_after_generation, {"candidate_racer": "candidate_racer", "preflight_checker": "preflight_checker", "code_debugger": "code_debugger"})
+    workflow.add_conditional_edges("candidate_racer", route_after_race, {"final_renderer": "final_renderer", "code_debugger": "code_debugger", "handle_error": "handle_error"})
+    workflow.add_conditional_edges("preflight_checker", route_after_preflight, {"code_executor": "code_executor", "rule_fixer": "rule_fixer"})
+    workflow.add_conditional_edges("code_executor", route_after_execution, {"rule_fixer": "rule_fixer", "qa_image_checker": "qa_image_checker"})
+    workflow.add_conditional_edges("rule_fixer", route_after_rule_fix, {"preflight_checker": "preflight_checker", "code_debugger": "code_debugger", "handle_error": "handle_error"})
+    workflow.add_conditional_edges("qa_image_checker", route_after_qa, {"final_renderer": "final_renderer", "code_debugger": "code_debugger", "handle_error": "handle_error"})
     workflow.add_conditional_edges("code_debugger", route_from_debugger, {
-        "code_executor": "code_executor",
-        "save_and_finish": "save_and_finish"
+        "preflight_checker": "preflight_checker",
+        "final_renderer": "final_renderer"
     })
+    workflow.add_conditional_edges("final_renderer", route_after_final_render, {"save_and_finish": "save_and_finish", "handle_error": "handle_error"})
     workflow.add_edge("save_and_finish", END)
     workflow.add_edge("handle_error", END)
     
@@ -0,0 +1,251 @@
+# app/api.py
+"""
+Headless HTTP API for plot generation.
+
+Jobs run on the API's own `JobQueue` instance (the database may be shared with the
+Streamlit app, whose jobs it never runs), so LLM and docker work happens on the
+queue's worker threads and the event loop only does uploads, SQLite lookups (in the
+thread pool) and streaming. Start with:
+
+    uvicorn app.api:app --host 0.0.0.0 --port 8000
+
+Endpoints:
+    POST   /jobs                     multipart: request, data_file, [reference_image], [settings]
+    GET    /jobs/{job_id}            status, current step and queue position
+    GET    /jobs/{job_id}/events     progress as Server-Sent Events, until the job finishes
+    GET    /jobs/{job_id}/result/{kind}  the PNG, PDF or R script (kind: png, pdf, r)
+    DELETE /jobs/{job_id}            cancels a queued or running job
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import asyncio
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+
+from app.agent_logic import create_agent_runnable
+from app.r_executor import check_runtime_image, RuntimeImageError, R_DOCKER_IMAGE
+from app.result_cache import ResultCache
+from app.job_queue import (JobQueue, JobRecord, SUCCEEDED, FINISHED_STATUSES, DEFAULT_JOB_SETTINGS,
+                           prepare_initial_state)
+
+TEMP_DIR = "temp_data"
+# Credentials used when a request does not send its own
+API_KEY = os.getenv("GGPLOTAGENT_API_KEY")
+VISION_API_KEY = os.getenv("GGPLOTAGENT_VISION_API_KEY")
+MAX_UPLOAD_BYTES = int(float(os.getenv("GGPLOTAGENT_API_MAX_UPLOAD_MB", "200")) * 1024 * 1024)
+EVENT_POLL_INTERVAL = 0.5  # seconds between job event polls of an SSE stream
+SSE_KEEPALIVE_SECONDS = 15
+
+_RESULT_FILES = {
+    "png": ("figure_path", "image/png", "output_figure.png"),
+    "pdf": ("pdf_path", "application/pdf", "output_figure.pdf"),
+    "r": ("code_path", "text/plain; charset=utf-8", "output_script.R"),
+}
+_UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Uploads are stored under fixed names, so they can neither collide with each other nor with job outputs
+_DATA_FILE_NAME = "data.csv"
+_REFERENCE_IMAGE_STEM = "reference"
+_REFERENCE_IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+# How long after a job finished its stream waits for the final status event
+_FINAL_EVENT_GRACE_SECONDS = 2.0
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    agent_runnable = create_agent_runnable()
+    try:
+        await run_in_threadpool(check_runtime_image)
+    except RuntimeImageError as e:
+        # Jobs will fail at execution time, but status and result endpoints keep working
+        print(f"   > [WARNING] R runtime check failed for '{R_DOCKER_IMAGE}': {e}")
+    app.state.job_queue = JobQueue(agent_runnable, ResultCache(Path(TEMP_DIR) / "result_cache"))
+    yield
+    app.state.job_queue.shutdown()
+
+
+app = FastAPI(title="ggplotAgent API", lifespan=lifespan)
+
+
+def _reference_image_name(upload: UploadFile) -> str:
+    """The server-side name of a reference image; its suffix must be an image format the vision step reads."""
+    suffix = Path(upload.filename or "").suffix.lower()
+    if suffix not in _REFERENCE_IMAGE_SUFFIXES:
+        raise HTTPException(status_code=415, detail=f"'reference_image' must be one of: {', '.join(_REFERENCE_IMAGE_SUFFIXES)}.")
+    return _REFERENCE_IMAGE_STEM + suffix
+
+
+def _save_upload(upload: UploadFile, path: Path) -> Path:
+    """Streams an upload to `path` in chunks, enforcing MAX_UPLOAD_BYTES."""
+    written = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = upload.file.read(_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"'{upload.filename}' exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+            f.write(chunk)
+    return path
+
+
+def _job_json(record: JobRecord, position: Optional[int]) -> dict:
+    body = {
+        "job_id": record.id,
+        "status": record.status,
+        "current_step": record.current_step,
+        "queue_position": position,
+        "created_at": record.created_at,
+        "started_at": record.started_at,
+        "finished_at": record.finished_at,
+        "error": record.error,
+    }
+    if record.status == SUCCEEDED:
+        body["results"] = {kind: f"/jobs/{record.id}/result/{kind}" for kind in _RESULT_FILES}
+    return body
+
+
+async def _get_record(request: Request, job_id: str) -> JobRecord:
+    record = await run_in_threadpool(request.app.state.job_queue.get, job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return record
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    user_request: str = Form(..., alias="request"),
+    data_file: UploadFile = File(...),
+    reference_image: Optional[UploadFile] = File(None),
+    settings: str = Form("{}", description="JSON object of per-run settings, e.g. {\"max_retries\": 5}"),
+    api_key: Optional[str] = Form(None),
+    vision_api_key: Optional[str] = Form(None),
+    use_result_cache: bool = Form(True),
+):
+    """Queues a plot generation job and returns its id."""
+    try:
+        settings_dict = json.loads(settings)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=422, detail=f"'settings' is not valid JSON: {e}")
+    if not isinstance(settings_dict, dict):
+        raise HTTPException(status_code=422, detail="'settings' must be a JSON object.")
+    unknown = set(settings_dict) - set(DEFAULT_JOB_SETTINGS)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown settings: {', '.join(sorted(unknown))}. "
+                                                    f"Supported: {', '.join(DEFAULT_JOB_SETTINGS)}.")
+
+    request_dir = Path(TEMP_DIR) / str(uuid.uuid4())
+    request_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        # The client's file names are only kept as metadata
+        uploads = {"data_file": data_file.filename}
+        data_file_path = await run_in_threadpool(_save_upload, data_file, request_dir / _DATA_FILE_NAME)
+        ref_image_path = None
+        if reference_image:
+            uploads["reference_image"] = reference_image.filename
+            ref_image_path = await run_in_threadpool(_save_upload, reference_image,
+                                                     request_dir / _reference_image_name(reference_image))
+        try:
+            initial_state = await run_in_threadpool(
+                prepare_initial_state, user_request, data_file_path, request_dir,
+                reference_image_path=ref_image_path,
+                api_key=api_key or API_KEY,
+                vision_api_key=vision_api_key or VISION_API_KEY,
+                **settings_dict
+            )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error reading provided CSV file: {e}")
+        if not initial_state["api_key"] or not initial_state["vision_api_key"]:
+            raise HTTPException(status_code=422, detail="'api_key' and 'vision_api_key' are required "
+                                                        "(or set GGPLOTAGENT_API_KEY / GGPLOTAGENT_VISION_API_KEY).")
+        job_queue = request.app.state.job_queue
+        job_id = await run_in_threadpool(job_queue.submit, initial_state, use_result_cache)
+    except HTTPException:
+        shutil.rmtree(request_dir, ignore_errors=True)
+        raise
+
+    record = await _get_record(request, job_id)
+    return {**_job_json(record, await run_in_threadpool(job_queue.position, job_id)), "uploads": uploads}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(request: Request, job_id: str):
+    record = await _get_record(request, job_id)
+    return _job_json(record, await run_in_threadpool(request.app.state.job_queue.position, job_id))
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(request: Request, job_id: str):
+    """
+    Streams the job's progress steps and status changes as Server-Sent Events.
+
+    Every event carries its sequence number as the SSE id, so a reconnecting client
+    (sending Last-Event-ID) only receives events it has not seen. The stream ends
+    after the job's final status event.
+    """
+    await _get_record(request, job_id)
+    job_queue = request.app.state.job_queue
+    try:
+        last_seq = int(request.headers.get("last-event-id", "0"))
+    except ValueError:
+        last_seq = 0
+
+    async def event_stream():
+        nonlocal last_seq
+        idle = 0.0
+        while not await request.is_disconnected():
+            events = await run_in_threadpool(job_queue.events, job_id, last_seq)
+            for event in events:
+                last_seq = event.seq
+                data = json.dumps({"message": event.message, "created_at": event.created_at})
+                yield f"id: {event.seq}\nevent: {event.kind}\ndata: {data}\n\n"
+                if event.kind == "status" and event.message in FINISHED_STATUSES:
+                    return
+            record = await run_in_threadpool(job_queue.get, job_id)
+            # Jobs failed by a restart have no final status event
+            if record is None or (record.finished and time.time() - record.finished_at > _FINAL_EVENT_GRACE_SECONDS):
+                return
+            if events:
+                idle = 0.0
+            elif idle >= SSE_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+            idle += EVENT_POLL_INTERVAL
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/jobs/{job_id}/result/{kind}")
+async def download_result(request: Request, job_id: str, kind: str):
+    if kind not in _RESULT_FILES:
+        raise HTTPException(status_code=404, detail=f"Unknown result '{kind}'; expected one of {', '.join(_RESULT_FILES)}.")
+    record = await _get_record(request, job_id)
+    if record.status != SUCCEEDED:
+        raise HTTPException(status_code=409, detail=f"Job is {record.status}; results are only available for succeeded jobs.")
+    key, media_type, filename = _RESULT_FILES[kind]
+    path = record.result.get(key)
+    if not path or not Path(path).exists():
+        raise HTTPException(status_code=410, detail=f"The {kind} result of this job is no longer available.")
+    return FileResponse(path, media_type=media_type, filename=filename)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(request: Request, job_id: str):
+    await _get_record(request, job_id)
+    cancelled = await run_in_threadpool(request.app.state.job_queue.cancel, job_id)
+    if not cancelled:
+        raise HTTPException(status_code=409, detail="Job has already finished.")
+    record = await _get_record(request, job_id)
+    return _job_json(record, None)
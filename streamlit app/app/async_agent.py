@@ -0,0 +1,329 @@
+# app/async_agent.py
+"""
+Async variant of the agent graph.
+
+The nodes that wait on the network or on docker are replaced by coroutines that use
+`AsyncOpenAI` (through `CustomLLM.ainvoke` / `astream`) and asyncio subprocesses, so a
+run waiting on a model or on R holds no thread and hundreds of runs fit in one event
+loop. Prompts, response parsing and routing are shared with agent_logic.py; CPU-only
+nodes (pre-flight checks, rule fixes, data reduction) stay synchronous and are run by
+LangGraph in its thread pool. Process-wide stage limits (stage_limits.py) apply to
+both graphs alike.
+
+Use it with `ainvoke` / `astream`:
+
+    runnable = create_async_agent_runnable()
+    final_state = await runnable.ainvoke(initial_state)
+"""
+
+import asyncio
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from langgraph.types import StreamWriter
+
+from app.agent_logic import (
+    GraphState, CustomLLM, avision_large_model, clean_r_code, get_available_columns,
+    build_qa_prompt, parse_qa_response, build_style_prompt, build_fusion_prompt, fusion_result,
+    build_validator_prompt, validation_result, build_planner_prompt, plan_result,
+    build_coder_prompt, candidates_result, aborted_generation_result, script_result,
+    candidate_temperatures, unique_scripts, build_patch_debugger_prompt, build_rewrite_debugger_prompt,
+    apply_debugger_patch, debugger_result, _split_thinking, execution_target, execution_result,
+    arun_r_with_placeholders, draft_prelude, is_two_phase_render, candidate_preflight_error,
+    copy_winner_outputs, race_result, final_render_result, build_error_interpreter_prompt, fallback_error_message, error_result,
+    create_agent_runnable, DOCKER_NOT_FOUND_ERROR,
+)
+from app.r_executor import get_worker_pool, DEFAULT_R_BACKEND
+from app.r_static import IncrementalRParser, r_syntax_error
+from app.style_cache import fingerprint_image, columns_key, get_style_cache
+
+
+def _text_llm(state: GraphState, use_cache: bool = False, temperature: Optional[float] = None) -> CustomLLM:
+    return CustomLLM(api_key=state["api_key"], model_name=state["model_name"], base_url=state["base_url"],
+                     use_cache=use_cache, temperature=temperature)
+
+
+async def ainvoke_llm(llm: CustomLLM, prompt: str, state: dict, node_name: str, writer: Optional[StreamWriter]) -> str:
+    """Async counterpart of `invoke_llm`; tokens go to `writer` when `stream_tokens` is set."""
+    if not state.get("stream_tokens") or writer is None:
+        return await llm.ainvoke(prompt)
+    parts = []
+    async for token in llm.astream(prompt):
+        parts.append(token)
+        writer({"node": node_name, "token": token})
+    return "".join(parts)
+
+
+async def astream_r_code(llm: CustomLLM, prompt: str, state: dict, node_name: str,
+                         writer: Optional[StreamWriter]) -> Tuple[str, Optional[str]]:
+    """Async counterpart of `stream_r_code` (pipelined mode): parses while streaming and aborts on a syntax error."""
+    def warm_worker(_library: str):
+        if (state.get("r_backend") or DEFAULT_R_BACKEND) == "pool":
+            print("   > [PIPELINE] Script header received, warming an R worker.")
+            get_worker_pool(Path.cwd()).warm(1)
+
+    parser = IncrementalRParser(on_library=warm_worker, completion=True)
+    writer = writer if state.get("stream_tokens") else None
+    parts = []
+    tokens = llm.astream(prompt)
+    async for token in tokens:
+        parts.append(token)
+        if writer:
+            writer({"node": node_name, "token": token})
+        if parser.feed(token):
+            await tokens.aclose()  # stop paying for tokens of a script that cannot parse
+            print(f"   > [PIPELINE] Aborted generation early: {parser.error}")
+            return "".join(parts), parser.error
+    response = "".join(parts)
+    return response, r_syntax_error(clean_r_code(response))
+
+
+# --- Async nodes ---
+
+async def areview_plot_image(state: GraphState, image_path: Optional[str]) -> dict:
+    """Async counterpart of `review_plot_image`."""
+    if not image_path or not Path(image_path).exists():
+        return {"error_message": "QA Check Failed: Plot image not found for review."}
+    try:
+        response = await avision_large_model(build_qa_prompt(state), image_path, state["vision_api_key"],
+                                             state["vision_model"], state["vision_base_url"])
+        return parse_qa_response(response)
+    except Exception as e:
+        print(f"   > [ERROR] An exception occurred during QA check: {e}")
+        return {"error_message": f"QA Vision API call failed: {e}"}
+
+
+async def aqa_image_checker_node(state: GraphState) -> dict:
+    print("--- Step 6: Performing QA check on the generated image...")
+    return await areview_plot_image(state, state['plot_image_path'])
+
+
+async def astyle_extraction_node(state: GraphState) -> dict:
+    print("--- Step 0: Extracting the style of the reference image...")
+    image_path = state.get("reference_image_path")
+    vision_model = state["vision_model"]
+    available_columns = get_available_columns(state)
+    current_status = "Step 0: Analyzing reference image..."
+
+    fingerprint = await asyncio.to_thread(fingerprint_image, image_path) if state.get("style_cache", True) else None
+    cache_key = columns_key(available_columns, vision_model or "")
+    if fingerprint is not None:
+        cached_spec = await asyncio.to_thread(get_style_cache().get, fingerprint, cache_key)
+        if cached_spec:
+            print(f"   > [CACHE HIT] Reused the style of a previously analyzed reference image (image {fingerprint.sha256[:12]}).")
+            return {"reference_style_spec": cached_spec, "current_step": current_status}
+
+    style_spec = await avision_large_model(build_style_prompt(available_columns), image_path, state["vision_api_key"],
+                                           vision_model, state["vision_base_url"])
+    if fingerprint is not None and style_spec and not style_spec.startswith("Error:"):
+        await asyncio.to_thread(get_style_cache().set, fingerprint, cache_key, style_spec)
+    print(f"   > [SUCCESS] Reference image style extracted:\n{'-'*20}\n{style_spec}\n{'-'*20}\n")
+    return {"reference_style_spec": style_spec, "current_step": current_status}
+
+
+async def aimage_understanding_node(state: GraphState) -> dict:
+    print("--- Step 0.5: Fusing the reference image style with the user request...")
+    llm = _text_llm(state, use_cache=state.get("llm_cache", False))
+    return fusion_result(await llm.ainvoke(build_fusion_prompt(state)))
+
+
+async def adata_validator_node(state: GraphState) -> dict:
+    print("--- Step 1: Validating data against user request...")
+    llm = _text_llm(state, use_cache=state.get("llm_cache", False))
+    return validation_result(await llm.ainvoke(build_validator_prompt(state)))
+
+
+async def aplan_generation_node(state: GraphState) -> dict:
+    print("--- Step 2: Generating a full analysis and plotting plan...")
+    llm = _text_llm(state, use_cache=state.get("llm_cache", False))
+    return plan_result(await llm.ainvoke(build_planner_prompt(state)))
+
+
+async def aspeculative_planning_node(state: GraphState) -> dict:
+    """
+    Async counterpart of `speculative_planning_node`; a failed validation cancels the planning
+    branch, which aborts its in-flight model request. Tokens generated until then are still billed.
+    """
+    print("--- Step 1-2: Validating data and generating the plan concurrently...")
+    async def plan_branch() -> dict:
+        updates = {}
+        if state.get("reference_image_path"):
+            for node in (astyle_extraction_node, aimage_understanding_node):
+                updates.update(await node({**state, **updates}))
+        updates.update(await aplan_generation_node({**state, **updates}))
+        return updates
+
+    async def discard_plan():
+        # Waits for the cancellation to land so the task does not outlive the node unobserved
+        planning.cancel()
+        await asyncio.gather(planning, return_exceptions=True)
+
+    planning = asyncio.ensure_future(plan_branch())
+    try:
+        validation = await adata_validator_node(state)
+    except BaseException:
+        await discard_plan()
+        raise
+    if validation.get("error_message"):
+        print("   > [INFO] Discarding the speculative plan.")
+        await discard_plan()
+        return validation
+    plan_updates = await planning
+    return {**plan_updates, "current_step": "Step 2: Data validated and plan generated..."}
+
+
+async def agenerate_candidate_scripts(state: GraphState, prompt: str, num_candidates: int) -> List[str]:
+    """Async counterpart of `generate_candidate_scripts`."""
+    async def generate(temperature: float) -> Optional[str]:
+        try:
+            llm = _text_llm(state, use_cache=state.get("llm_cache", False), temperature=temperature)
+            return clean_r_code(await llm.ainvoke(prompt))
+        except Exception as e:
+            print(f"   > [WARNING] Candidate generation at temperature {temperature} failed: {e}")
+            return None
+    scripts = await asyncio.gather(*(generate(t) for t in candidate_temperatures(num_candidates)))
+    return unique_scripts(scripts)
+
+
+async def agenerate_r_code_node(state: GraphState, writer: StreamWriter) -> dict:
+    print("--- Step 4: Generating complete R script from the plan...")
+    coder_system_prompt = build_coder_prompt(state)
+    llm = _text_llm(state, use_cache=state.get("llm_cache", False))
+    num_candidates = int(state.get("parallel_candidates") or 1)
+    if num_candidates > 1:
+        candidates = await agenerate_candidate_scripts(state, coder_system_prompt, num_candidates)
+        if candidates:
+            return candidates_result(candidates)
+        print("   > [WARNING] No candidate script could be generated; falling back to a single script.")
+    if state.get("pipelined_execution"):
+        response, syntax_error = await astream_r_code(llm, coder_system_prompt, state, "code_generator", writer)
+        if syntax_error:
+            return aborted_generation_result(response, syntax_error)
+    else:
+        response = await ainvoke_llm(llm, coder_system_prompt, state, "code_generator", writer)
+    return script_result(response)
+
+
+async def adebug_r_code_node(state: GraphState, writer: StreamWriter) -> dict:
+    print(f"--- Debugging Attempt {state['retry_count'] + 1}: Analyzing error...")
+    llm = _text_llm(state)
+    fixed_script_or_signal = None
+    if state.get("debug_patch_mode") and state.get("full_r_script"):
+        response = await ainvoke_llm(llm, build_patch_debugger_prompt(state), state, "code_debugger", writer)
+        fixed_script_or_signal = apply_debugger_patch(state, response)
+
+    if fixed_script_or_signal is None:
+        response = await ainvoke_llm(llm, build_rewrite_debugger_prompt(state), state, "code_debugger", writer)
+        _split_thinking(response)
+        fixed_script_or_signal = clean_r_code(response)
+    return debugger_result(state, fixed_script_or_signal)
+
+
+async def aexecute_r_code_node(state: GraphState) -> dict:
+    attempt_num = state.get('retry_count', 0)
+    print(f"--- Step 5 (Execution Attempt {attempt_num + 1})...")
+    full_script = state.get('full_r_script')
+    if not full_script: return {"error_message": "No R script was generated."}
+
+    png_path, prelude = execution_target(state)
+    try:
+        result = await arun_r_with_placeholders(state, full_script, png_path, prelude)
+        return execution_result(state, result, png_path)
+    except FileNotFoundError:
+        return {"error_message": DOCKER_NOT_FOUND_ERROR, "current_step": f"Step 4: Executing R script (Attempt {attempt_num + 1})..."}
+
+
+async def arace_candidates_node(state: GraphState) -> dict:
+    """
+    Async counterpart of `race_candidates_node`.
+
+    Candidates run as tasks; once one passes QA the others are cancelled, which also
+    kills their one-shot containers or pooled sessions.
+    """
+    candidates = state.get("candidate_scripts") or []
+    print(f"--- Step 5 (Racing {len(candidates)} candidate scripts)...")
+    temp_dir = Path(state['output_figure_path']).parent
+    columns = get_available_columns(state)
+
+    async def attempt(index: int, script: str) -> dict:
+        label = f"Candidate {index + 1}"
+        preflight_error = candidate_preflight_error(script, columns)
+        if preflight_error:
+            return {"index": index, "stage": "preflight", "error": preflight_error}
+        png_path = temp_dir / f"candidate_{index + 1}.png"
+        pdf_path = temp_dir / f"candidate_{index + 1}.pdf"
+        try:
+            result = await arun_r_with_placeholders(state, script, png_path, draft_prelude(state), pdf_path=pdf_path)
+        except Exception as e:
+            return {"index": index, "stage": "execution", "error": str(e)}
+        if result.returncode != 0:
+            print(f"   > [FAILURE] {label} failed to execute.")
+            return {"index": index, "stage": "execution", "error": result.stderr.strip()}
+        review = await areview_plot_image(state, str(png_path))
+        if review.get("error_message"):
+            print(f"   > [FAILURE] {label} did not pass QA.")
+            return {"index": index, "stage": "qa", "error": review["error_message"],
+                    "qa_feedback": review.get("qa_feedback"), "png_path": png_path, "pdf_path": pdf_path}
+        print(f"   > [SUCCESS] {label} passed QA.")
+        return {"index": index, "stage": "passed", "png_path": png_path, "pdf_path": pdf_path}
+
+    tasks = [asyncio.ensure_future(attempt(i, script)) for i, script in enumerate(candidates)]
+    pending = set(tasks)
+    outcomes = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    outcomes.append(task.result())
+                except Exception as e:
+                    outcomes.append({"index": tasks.index(task), "stage": "execution", "error": str(e)})
+            if any(outcome["stage"] == "passed" for outcome in outcomes):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    await asyncio.to_thread(copy_winner_outputs, state, outcomes)
+    return race_result(state, candidates, outcomes)
+
+
+async def afinal_render_node(state: GraphState) -> dict:
+    if not is_two_phase_render(state):
+        return {}
+    print("--- Step 6.5: Rendering the final 300 dpi PNG and PDF...")
+    try:
+        result = await arun_r_with_placeholders(state, state['full_r_script'], Path(state['output_figure_path']))
+    except FileNotFoundError:
+        return {"error_message": DOCKER_NOT_FOUND_ERROR, "current_step": "Step 5: Rendering final figure..."}
+    return final_render_result(state, result)
+
+
+async def ahandle_error_node(state: GraphState) -> dict:
+    try:
+        llm = _text_llm(state)
+        message = await llm.ainvoke(build_error_interpreter_prompt(state))
+    except Exception as e:
+        print(f"Error while interpreting error for user: {e}")
+        message = fallback_error_message(state)
+    return error_result(message)
+
+
+ASYNC_NODES = {
+    "style_extractor": astyle_extraction_node,
+    "image_analyzer": aimage_understanding_node,
+    "data_validator": adata_validator_node,
+    "plan_generator": aplan_generation_node,
+    "speculative_planner": aspeculative_planning_node,
+    "code_generator": agenerate_r_code_node,
+    "candidate_racer": arace_candidates_node,
+    "code_executor": aexecute_r_code_node,
+    "qa_image_checker": aqa_image_checker_node,
+    "code_debugger": adebug_r_code_node,
+    "final_renderer": afinal_render_node,
+    "handle_error": ahandle_error_node,
+}
+
+
+def create_async_agent_runnable():
+    """Builds and compiles the agent graph with async nodes; drive it with `ainvoke` / `astream`."""
+    return create_agent_runnable(node_overrides=ASYNC_NODES)
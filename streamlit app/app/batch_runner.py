@@ -0,0 +1,224 @@
+# app/batch_runner.py
+"""
+Batch mode: runs every task of a prompt file against its dataset in one invocation.
+
+A task folder (e.g. `benchmark/dataset1`) holds a prompt file with one request per
+line and a CSV. The CSV is profiled and converted once and shared by all tasks, the
+tasks run concurrently on the async graph, and each successful task is written as
+`task_N_agent.{R,png,pdf}` next to the existing outputs, with a `batch_summary.csv`.
+
+Run it from the app folder, which is mounted into the R sandbox:
+
+    python -m app.batch_runner ../benchmark/dataset1 --parallel 4
+    python -m app.batch_runner ../qwen3_outputs --prompts qwen3-prompt.txt --tasks 1-3 --overwrite
+"""
+
+import os
+import csv
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import argparse
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import List, Optional
+
+from app.async_agent import create_async_agent_runnable
+from app.llm_clients import aclose_openai_clients
+from app.data_ingest import start_ingest
+from app.job_queue import DEFAULT_JOB_SETTINGS, PreparedData, prepare_data, build_initial_state
+
+TEMP_DIR = "temp_data"
+BATCH_PARALLELISM = int(os.getenv("GGPLOTAGENT_BATCH_PARALLELISM", "4"))
+SUMMARY_FILE_NAME = "batch_summary.csv"
+
+# Graph outputs and the benchmark file names they are published under
+_OUTPUTS = {
+    "output_code_path": "task_{n}_agent.R",
+    "output_figure_path": "task_{n}_agent.png",
+    "output_pdf_path": "task_{n}_agent.pdf",
+}
+
+
+@dataclass
+class TaskResult:
+    """One row of the batch summary."""
+    task: int
+    status: str  # "succeeded", "failed" or "skipped"
+    seconds: float
+    retries: int
+    outputs: str
+    prompt: str
+    error: str = ""
+
+
+def read_prompts(path: Path) -> List[str]:
+    """One task per non-empty line; task N is the N-th non-empty line."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_task_selection(selection: Optional[str], count: int) -> List[int]:
+    """Parses "1,3-5" into task numbers; None selects every task."""
+    if not selection:
+        return list(range(1, count + 1))
+    tasks = set()
+    for part in selection.split(","):
+        start, _, end = part.strip().partition("-")
+        tasks.update(range(int(start), int(end or start) + 1))
+    invalid = sorted(t for t in tasks if not 1 <= t <= count)
+    if invalid:
+        raise ValueError(f"Tasks {invalid} do not exist; the prompt file has {count} tasks.")
+    return sorted(tasks)
+
+
+def find_task_file(folder: Path, pattern: str, what: str) -> Path:
+    """The single file of a task folder matching `pattern`."""
+    matches = sorted(folder.glob(pattern))
+    if len(matches) != 1:
+        raise ValueError(f"Expected exactly one {what} in {folder}, found {len(matches)}; pass it explicitly.")
+    return matches[0]
+
+
+async def run_task(agent_runnable, number: int, prompt: str, data: PreparedData, work_dir: Path, output_dir: Path,
+                   settings: dict, semaphore: asyncio.Semaphore) -> TaskResult:
+    async with semaphore:
+        print(f"--- [BATCH] Task {number} started: {prompt[:80]}")
+        task_dir = work_dir / f"task_{number}"
+        task_dir.mkdir(parents=True, exist_ok=True)
+        initial_state = build_initial_state(prompt, data, task_dir, **settings)
+        # Tokens are only useful to an interactive client
+        initial_state["stream_tokens"] = False
+        started = time.monotonic()
+        final_state, error = {}, ""
+        try:
+            final_state = await agent_runnable.ainvoke(initial_state)
+        except Exception as e:
+            error = f"Agent run failed: {e}"
+        seconds = round(time.monotonic() - started, 1)
+
+    retries = int(final_state.get("retry_count") or 0)
+    if not error and Path(initial_state["output_figure_path"]).exists() and Path(initial_state["output_code_path"]).exists():
+        published = []
+        for key, name in _OUTPUTS.items():
+            source = Path(initial_state[key])
+            if source.exists():
+                target = output_dir / name.format(n=number)
+                shutil.copyfile(source, target)
+                published.append(target.name)
+        print(f"   > [SUCCESS] Task {number} finished in {seconds}s.")
+        return TaskResult(number, "succeeded", seconds, retries, " ".join(published), prompt)
+
+    if not error:
+        messages = final_state.get("messages") or []
+        error = messages[-1].content if messages else "An unknown error occurred."
+    print(f"   > [FAILURE] Task {number} failed after {seconds}s.")
+    return TaskResult(number, "failed", seconds, retries, "", prompt, error.strip().split("\n", 1)[0][:300])
+
+
+async def run_batch(prompts: List[str], tasks: List[int], data_file: Path, output_dir: Path, settings: dict,
+                    parallel: int = BATCH_PARALLELISM, overwrite: bool = False, keep_work_dir: bool = False) -> List[TaskResult]:
+    """Runs the selected tasks concurrently and returns their results, in task order."""
+    # Scripts run in a sandbox that only sees the working directory, so the data is staged under it
+    work_dir = Path(TEMP_DIR) / f"batch_{uuid.uuid4().hex[:12]}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+    staged_data = work_dir / data_file.name
+    shutil.copyfile(data_file, staged_data)
+    data = prepare_data(staged_data, work_dir)
+    if data.columnar_path:
+        # Shared by every task; converted while the first tasks validate and plan
+        start_ingest(data.file_path, data.columnar_path)
+    print(f"--- [BATCH] {data_file.name}: {len(data.profile.columns)} columns profiled.")
+
+    results, pending = [], []
+    for number in tasks:
+        existing = [name.format(n=number) for name in _OUTPUTS.values() if (output_dir / name.format(n=number)).exists()]
+        if existing and not overwrite:
+            results.append(TaskResult(number, "skipped", 0.0, 0, " ".join(existing), prompts[number - 1],
+                                      "outputs exist (use --overwrite)"))
+        else:
+            pending.append(number)
+
+    agent_runnable = create_async_agent_runnable()
+    semaphore = asyncio.Semaphore(max(1, parallel))
+    try:
+        results += await asyncio.gather(*(
+            run_task(agent_runnable, number, prompts[number - 1], data, work_dir, output_dir, settings, semaphore)
+            for number in pending
+        ))
+    finally:
+        await aclose_openai_clients()
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return sorted(results, key=lambda r: r.task)
+
+
+def write_summary(results: List[TaskResult], path: Path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(TaskResult.__dataclass_fields__))
+        writer.writeheader()
+        for result in results:
+            writer.writerow(asdict(result))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run every task of a benchmark prompt file against its dataset.")
+    parser.add_argument("folder", type=Path, help="Task folder holding the prompt file and the CSV.")
+    parser.add_argument("--prompts", type=Path, help="Prompt file, one task per line (default: the folder's *prompt*.txt).")
+    parser.add_argument("--data", type=Path, help="CSV file (default: the folder's only *.csv).")
+    parser.add_argument("--output-dir", type=Path, help="Where task_N_agent.* files go (default: the task folder).")
+    parser.add_argument("--tasks", help="Tasks to run, e.g. '1,3-5' (default: all).")
+    parser.add_argument("--parallel", type=int, default=BATCH_PARALLELISM, help="Tasks running at the same time.")
+    parser.add_argument("--settings", default="{}",
+                        help=f"JSON object of per-run settings; keys: {', '.join(DEFAULT_JOB_SETTINGS)}.")
+    parser.add_argument("--overwrite", action="store_true", help="Replace existing task_N_agent.* outputs.")
+    parser.add_argument("--keep-work-dir", action="store_true", help="Keep the intermediate files under temp_data.")
+    args = parser.parse_args(argv)
+
+    folder = args.folder
+    try:
+        # Explicit file names are looked up in the task folder first
+        prompt_file = folder / args.prompts if args.prompts else find_task_file(folder, "*prompt*.txt", "prompt file")
+        data_file = folder / args.data if args.data else find_task_file(folder, "*.csv", "CSV file")
+    except ValueError as e:
+        parser.error(str(e))
+    if args.prompts and not prompt_file.exists():
+        prompt_file = args.prompts
+    if args.data and not data_file.exists():
+        data_file = args.data
+    output_dir = args.output_dir or folder
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    settings = json.loads(args.settings)
+    unknown = set(settings) - set(DEFAULT_JOB_SETTINGS)
+    if unknown:
+        parser.error(f"Unknown settings: {', '.join(sorted(unknown))}")
+    settings["api_key"] = os.getenv("GGPLOTAGENT_API_KEY")
+    settings["vision_api_key"] = os.getenv("GGPLOTAGENT_VISION_API_KEY")
+    if not settings["api_key"] or not settings["vision_api_key"]:
+        parser.error("Set GGPLOTAGENT_API_KEY and GGPLOTAGENT_VISION_API_KEY.")
+
+    prompts = read_prompts(prompt_file)
+    try:
+        tasks = parse_task_selection(args.tasks, len(prompts))
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"--- [BATCH] {len(tasks)} of {len(prompts)} tasks from {prompt_file}, {args.parallel} at a time.")
+
+    results = asyncio.run(run_batch(prompts, tasks, data_file, output_dir, settings, parallel=args.parallel,
+                                    overwrite=args.overwrite, keep_work_dir=args.keep_work_dir))
+    summary_path = output_dir / SUMMARY_FILE_NAME
+    write_summary(results, summary_path)
+
+    print(f"\n{'task':>4}  {'status':<9}  {'seconds':>7}  {'retries':>7}  outputs / error")
+    for r in results:
+        print(f"{r.task:>4}  {r.status:<9}  {r.seconds:>7}  {r.retries:>7}  {r.outputs or r.error}")
+    succeeded = sum(r.status == "succeeded" for r in results)
+    print(f"\n{succeeded}/{len(results)} tasks succeeded. Summary written to {summary_path}.")
+    return 0 if all(r.status != "failed" for r in results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,706 @@
+# app/benchmark.py
+"""
+Benchmark harness over the `benchmark/dataset*/prompt.txt` tasks.
+
+Every task runs on the async graph and is measured: end-to-end and per-node latency,
+debugging retries, model calls and prompt/completion tokens, R executions and their
+time, and whether a figure was produced. Each run is written as a JSON report and a
+CSV (one row per task) so runs can be compared over time.
+
+Model responses and R executions can be recorded and replayed, so a run can be
+repeated offline and deterministically:
+
+    python -m app.benchmark --mode record                # live run, saves every response
+    python -m app.benchmark --mode replay                # no API key, no network
+    python -m app.benchmark --mode replay --stub-executor --tasks 1-3 ../benchmark/dataset2
+    python -m app.benchmark --stub-model --stub-executor       # no recording, API key or docker
+
+Recordings are keyed like the LLM cache (base_url, model, prompt hash, temperature)
+and R executions by script hash. Task work directories are deterministic, so a replay
+sends the same prompts and scripts as the recorded run as long as the agent behaves
+the same; a response that was never recorded fails the call and is counted as a miss.
+
+With `--stub-model`, model calls get canned answers instead (the validator says OK,
+QA says MATCH and the coder returns a fixed scatter plot script), which measures the
+pipeline's own overhead; in replay mode only unrecorded calls are stubbed.
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import base64
+import shutil
+import asyncio
+import hashlib
+import inspect
+import argparse
+import threading
+import functools
+import subprocess
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from app.agent_logic import AGENT_NODES, create_agent_runnable
+from app.async_agent import ASYNC_NODES
+from app.batch_runner import read_prompts, parse_task_selection, find_task_file
+from app.job_queue import DEFAULT_JOB_SETTINGS, prepare_data, build_initial_state
+from app.llm_cache import LLMCache
+from app.llm_clients import set_client_wrapper, aclose_openai_clients
+from app.data_ingest import reset_ingest, start_ingest
+from app.r_executor import RExecutionHook, RExecutionResult, set_r_execution_hook
+
+TEMP_DIR = "temp_data"
+BENCHMARK_DIR = os.getenv("GGPLOTAGENT_BENCHMARK_DIR", os.path.join("..", "benchmark"))
+BENCHMARK_RESULTS_DIR = os.getenv("GGPLOTAGENT_BENCHMARK_RESULTS_DIR", os.path.join(BENCHMARK_DIR, "results"))
+BENCHMARK_RECORDING_PATH = os.getenv("GGPLOTAGENT_BENCHMARK_RECORDING",
+                                     os.path.join(BENCHMARK_DIR, "recordings", "responses.json"))
+MODES = ("live", "record", "replay")
+# Caches would hide the work being measured; explicit --settings still win
+BENCHMARK_SETTINGS = {"llm_cache": False, "style_cache": False}
+
+# Project paths are part of prompts and scripts; recordings must not depend on where the repo lives
+_ROOT_PATHS = tuple({str(Path.cwd()), Path.cwd().as_posix()})
+_OUTPUT_FILE_PATTERN = re.compile(r"""["']([^"'\n]+\.(?:png|pdf))["']""")
+
+
+# Canned answers of --stub-model; the script passes the pre-flight checks on any data
+STUB_PLAN = ("Part 1: No data preprocessing is needed.\n"
+             "Part 2: geom_point of every row against its row number, theme_bw(), default labels.")
+STUB_STYLE_SPEC = "A scatter plot with black points on a white background (theme_bw), no reference lines."
+STUB_R_SCRIPT = """library(ggplot2)
+data <- dplyr::mutate(read.csv("__INPUT_FILE__"), row_index = dplyr::row_number())
+final_plot <- ggplot(data, aes(x = row_index, y = row_index)) + geom_point() + theme_bw()
+ggsave("__OUTPUT_PNG_FILE__", plot = final_plot, width = 8, height = 6, dpi = 300)
+ggsave("__OUTPUT_PDF_FILE__", plot = final_plot, width = 8, height = 6)
+"""
+
+
+class RecordingMissError(RuntimeError):
+    """Raised in replay mode for a request that was never recorded."""
+
+
+@dataclass
+class TaskMetrics:
+    """Measurements of one benchmark task."""
+    dataset: str
+    task: int
+    prompt: str
+    passed: bool = False
+    seconds: float = 0.0
+    retries: int = 0
+    llm_calls: int = 0
+    vision_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    r_runs: int = 0
+    r_seconds: float = 0.0
+    replay_misses: int = 0
+    node_seconds: Dict[str, float] = field(default_factory=dict)
+    node_calls: Dict[str, int] = field(default_factory=dict)
+    error: str = ""
+
+
+# Metrics of the task running in the current context (asyncio task or LangGraph executor thread)
+_task_metrics: ContextVar[Optional[TaskMetrics]] = ContextVar("benchmark_task_metrics", default=None)
+_metrics_lock = threading.Lock()
+
+
+def _update_metrics(**increments):
+    metrics = _task_metrics.get()
+    if metrics is None:
+        return
+    with _metrics_lock:
+        for name, value in increments.items():
+            setattr(metrics, name, getattr(metrics, name) + value)
+
+
+def _record_node(name: str, seconds: float):
+    metrics = _task_metrics.get()
+    if metrics is None:
+        return
+    with _metrics_lock:
+        metrics.node_seconds[name] = round(metrics.node_seconds.get(name, 0.0) + seconds, 3)
+        metrics.node_calls[name] = metrics.node_calls.get(name, 0) + 1
+
+
+def timed_node(name: str, node):
+    """Wraps a graph node to add its run time to the current task's metrics; keeps its signature."""
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def timed(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await node(*args, **kwargs)
+            finally:
+                _record_node(name, time.monotonic() - started)
+    else:
+        @functools.wraps(node)
+        def timed(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return node(*args, **kwargs)
+            finally:
+                _record_node(name, time.monotonic() - started)
+    return timed
+
+
+def create_benchmark_runnable():
+    """The async graph with every node timed."""
+    nodes = {**AGENT_NODES, **ASYNC_NODES}
+    return create_agent_runnable(node_overrides={name: timed_node(name, node) for name, node in nodes.items()})
+
+
+# --- Recordings ---
+
+class RecordingStore:
+    """
+    Recorded model responses and R executions, in one JSON file.
+
+    Every key holds the responses in the order they were received; a replay hands them
+    out in the same order (repeating the last one if a key is requested more often).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[dict]] = {}
+        self._positions: Dict[str, int] = {}
+        self._recorded_keys = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+
+    def record(self, key: str, entry: dict):
+        with self._lock:
+            # A new recording of a key replaces the one from an earlier run
+            if key not in self._recorded_keys:
+                self._recorded_keys.add(key)
+                self._entries[key] = []
+            self._entries[key].append(entry)
+
+    def replay(self, key: str) -> dict:
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise RecordingMissError(f"No recorded response for request {key[:12]}.")
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            return entries[min(position, len(entries) - 1)]
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with self._lock, open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+
+def _without_root(text: str) -> str:
+    for root in _ROOT_PATHS:
+        text = text.replace(root, "<root>")
+    return text
+
+
+def _usage_dict(usage) -> dict:
+    return {"prompt_tokens": getattr(usage, "prompt_tokens", None) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", None) or 0}
+
+
+def _is_vision_request(messages: list) -> bool:
+    return any(isinstance(m.get("content"), list) and any(part.get("type") == "image_url" for part in m["content"])
+               for m in messages)
+
+
+def _prompt_text(messages: list) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts += [part.get("text") or "" for part in content if part.get("type") == "text"]
+        else:
+            parts.append(content or "")
+    return "\n".join(parts)
+
+
+def stub_model_entry(messages: list) -> dict:
+    """A canned answer to a chat request, picked by the prompt it answers, as a recording entry."""
+    prompt = _prompt_text(messages)
+    if _is_vision_request(messages):
+        content = "MATCH" if "`MATCH`" in prompt else STUB_STYLE_SPEC
+    elif "respond with only the word: `OK`" in prompt:
+        content = "OK"
+    elif "ggsave" in prompt or "R script" in prompt:
+        content = f"```r\n{STUB_R_SCRIPT}```"
+    else:
+        content = STUB_PLAN
+    return {"content": content, "reasoning": None, "chunks": None,
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0}, "seconds": 0.0}
+
+
+class _ReplayStream:
+    """Replays recorded chunks through the (async) context manager and iterator protocol of an OpenAI stream."""
+
+    def __init__(self, chunks: List[str]):
+        self._chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+                        for text in chunks]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+class _RecordingStream:
+    """Passes an OpenAI stream through and reports its text chunks and usage once it is closed."""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self._chunks: List[str] = []
+        self._usage = None
+
+    def _collect(self, chunk):
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            self._chunks.append(chunk.choices[0].delta.content)
+        if getattr(chunk, "usage", None):
+            self._usage = chunk.usage
+
+    def __enter__(self):
+        self._stream.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            return self._stream.__exit__(*exc_info)
+        finally:
+            self._on_close(self._chunks, self._usage)
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._collect(chunk)
+            yield chunk
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            return await self._stream.__aexit__(*exc_info)
+        finally:
+            self._on_close(self._chunks, self._usage)
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._collect(chunk)
+            yield chunk
+
+
+class ModelCallRecorder:
+    """
+    Installed as the llm_clients wrapper: meters every chat completion into the current
+    task's metrics and, depending on the mode, records it or replays a recorded one.
+    With `stub`, calls that are not replayed get a canned answer and never reach the endpoint.
+    """
+
+    def __init__(self, mode: str, store: Optional[RecordingStore], replay_latency: bool = False, stub: bool = False):
+        self.mode = mode
+        self.store = store
+        self.replay_latency = replay_latency
+        self.stub = stub
+
+    def wrap(self, client, base_url: str):
+        is_async = inspect.iscoroutinefunction(client.chat.completions.create)
+        create = functools.partial(self._acreate if is_async else self._create, client, base_url)
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    @staticmethod
+    def request_key(base_url: str, request: dict) -> str:
+        messages = _without_root(json.dumps(request["messages"], ensure_ascii=False, sort_keys=True))
+        return "llm:" + LLMCache.make_key(base_url, request["model"], messages, temperature=request.get("temperature"))
+
+    def _offline_entry(self, key: str, request: dict) -> Optional[dict]:
+        """The recorded or stubbed answer to a request, or None when it goes to the endpoint."""
+        if self.mode == "replay":
+            try:
+                entry = self.store.replay(key)
+            except RecordingMissError:
+                _update_metrics(replay_misses=1)
+                if not self.stub:
+                    raise
+                entry = stub_model_entry(request["messages"])
+        elif self.stub:
+            entry = stub_model_entry(request["messages"])
+        else:
+            return None
+        self._meter(request, entry["usage"])
+        return entry
+
+    @staticmethod
+    def _response(entry: dict, stream: bool):
+        if stream:
+            return _ReplayStream(entry.get("chunks") or [entry["content"]])
+        message = SimpleNamespace(content=entry["content"], reasoning_content=entry.get("reasoning"))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+    def _prepare_live(self, request: dict) -> dict:
+        if request.get("stream"):
+            # Token usage of a stream is only reported when asked for, in a final chunk
+            request = {**request, "stream_options": {"include_usage": True}}
+        return request
+
+    def _completed(self, key: str, request: dict, started: float, content: str, usage,
+                   reasoning: Optional[str] = None, chunks: Optional[List[str]] = None):
+        entry = {"content": content, "reasoning": reasoning, "chunks": chunks, "usage": _usage_dict(usage),
+                 "seconds": round(time.monotonic() - started, 3)}
+        self._meter(request, entry["usage"])
+        if self.mode == "record":
+            self.store.record(key, entry)
+
+    def _on_stream_closed(self, key: str, request: dict, started: float):
+        return lambda chunks, usage: self._completed(key, request, started, "".join(chunks), usage, chunks=chunks)
+
+    @staticmethod
+    def _meter(request: dict, usage: dict):
+        calls = {"vision_calls": 1} if _is_vision_request(request["messages"]) else {"llm_calls": 1}
+        _update_metrics(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"], **calls)
+
+    def _create(self, client, base_url: str, **request):
+        key = self.request_key(base_url, request)
+        entry = self._offline_entry(key, request)
+        if entry is not None:
+            if self.replay_latency:
+                time.sleep(entry["seconds"])
+            return self._response(entry, request.get("stream"))
+        started = time.monotonic()
+        response = client.chat.completions.create(**self._prepare_live(request))
+        if request.get("stream"):
+            return _RecordingStream(response, self._on_stream_closed(key, request, started))
+        message = response.choices[0].message if response.choices else None
+        self._completed(key, request, started, message.content if message else None, response.usage,
+                        reasoning=getattr(message, "reasoning_content", None))
+        return response
+
+    async def _acreate(self, client, base_url: str, **request):
+        key = self.request_key(base_url, request)
+        entry = self._offline_entry(key, request)
+        if entry is not None:
+            if self.replay_latency:
+                await asyncio.sleep(entry["seconds"])
+            return self._response(entry, request.get("stream"))
+        started = time.monotonic()
+        response = await client.chat.completions.create(**self._prepare_live(request))
+        if request.get("stream"):
+            return _RecordingStream(response, self._on_stream_closed(key, request, started))
+        message = response.choices[0].message if response.choices else None
+        self._completed(key, request, started, message.content if message else None, response.usage,
+                        reasoning=getattr(message, "reasoning_content", None))
+        return response
+
+
+class BenchmarkExecutionHook(RExecutionHook):
+    """
+    Times every R execution into the current task's metrics and records or replays it,
+    including the PNG/PDF files it wrote. With `stub`, scripts are not run at all: they
+    "succeed" and get blank placeholder figures (no docker needed).
+    """
+
+    def __init__(self, mode: str, store: Optional[RecordingStore], stub: bool = False, replay_latency: bool = False):
+        self.mode = mode
+        self.store = store
+        self.stub = stub
+        self.replay_latency = replay_latency
+
+    @staticmethod
+    def _describe(script_path_relative: Path, project_root: Path):
+        script = (project_root / script_path_relative).read_text(encoding="utf-8")
+        key = "r:" + hashlib.sha256(_without_root(script).encode("utf-8")).hexdigest()
+        outputs = [project_root / path for path in _OUTPUT_FILE_PATTERN.findall(script)]
+        return key, outputs
+
+    @staticmethod
+    def _restore(entry: dict, project_root: Path) -> RExecutionResult:
+        for path, content in entry["files"].items():
+            target = project_root / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(base64.b64decode(content))
+        return RExecutionResult(**entry["result"])
+
+    @staticmethod
+    def _stub_run(outputs: List[Path]) -> RExecutionResult:
+        from PIL import Image
+        for path in outputs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            Image.new("RGB", (800, 600), "white").save(path, "PDF" if path.suffix == ".pdf" else "PNG")
+        return RExecutionResult(0, "", "", "stub")
+
+    def _completed(self, key: str, result: RExecutionResult, outputs: List[Path], project_root: Path, started: float):
+        seconds = time.monotonic() - started
+        _update_metrics(r_runs=1, r_seconds=round(seconds, 3))
+        if self.mode != "record":
+            return
+        files = {}
+        for path in outputs:
+            # Only what this run wrote; a failed run may leave older outputs behind
+            if path.exists() and path.stat().st_mtime >= time.time() - seconds - 1:
+                files[path.relative_to(project_root).as_posix()] = base64.b64encode(path.read_bytes()).decode("ascii")
+        self.store.record(key, {"result": asdict(result), "files": files, "seconds": round(seconds, 3)})
+
+    def _replay_entry(self, key: str) -> Optional[dict]:
+        if self.mode != "replay":
+            return None
+        try:
+            return self.store.replay(key)
+        except RecordingMissError:
+            # Unrecorded scripts are stubbed or, without --stub-executor, executed for real
+            _update_metrics(replay_misses=1)
+            print(f"   > [BENCHMARK] No recorded R execution for script {key[2:14]}.")
+            return None
+
+    def run(self, execute, script_path_relative: Path, project_root: Path) -> RExecutionResult:
+        key, outputs = self._describe(script_path_relative, project_root)
+        started = time.monotonic()
+        entry = self._replay_entry(key)
+        if entry is not None:
+            if self.replay_latency:
+                time.sleep(entry["seconds"])
+            result = self._restore(entry, project_root)
+        else:
+            result = self._stub_run(outputs) if self.stub else execute()
+        self._completed(key, result, outputs, project_root, started)
+        return result
+
+    async def arun(self, execute, script_path_relative: Path, project_root: Path) -> RExecutionResult:
+        key, outputs = self._describe(script_path_relative, project_root)
+        started = time.monotonic()
+        entry = self._replay_entry(key)
+        if entry is not None:
+            if self.replay_latency:
+                await asyncio.sleep(entry["seconds"])
+            result = self._restore(entry, project_root)
+        else:
+            result = self._stub_run(outputs) if self.stub else await execute()
+        self._completed(key, result, outputs, project_root, started)
+        return result
+
+
+# --- Running ---
+
+async def run_task(agent_runnable, dataset: str, number: int, prompt: str, data, task_dir: Path, settings: dict,
+                   semaphore: asyncio.Semaphore) -> TaskMetrics:
+    metrics = TaskMetrics(dataset=dataset, task=number, prompt=prompt)
+    async with semaphore:
+        print(f"--- [BENCHMARK] {dataset} task {number}: {prompt[:80]}")
+        # The same directory on every run keeps prompts and scripts, and so recording keys, stable
+        shutil.rmtree(task_dir, ignore_errors=True)
+        task_dir.mkdir(parents=True)
+        initial_state = build_initial_state(prompt, data, task_dir, **settings)
+        initial_state["stream_tokens"] = False
+        token = _task_metrics.set(metrics)
+        started = time.monotonic()
+        final_state = {}
+        try:
+            final_state = await agent_runnable.ainvoke(initial_state)
+        except Exception as e:
+            metrics.error = f"Agent run failed: {e}"
+        finally:
+            metrics.seconds = round(time.monotonic() - started, 3)
+            _task_metrics.reset(token)
+
+    metrics.retries = int(final_state.get("retry_count") or 0)
+    metrics.passed = (not metrics.error and Path(initial_state["output_figure_path"]).exists()
+                      and Path(initial_state["output_code_path"]).exists())
+    if not metrics.passed and not metrics.error:
+        messages = final_state.get("messages") or []
+        metrics.error = messages[-1].content if messages else "An unknown error occurred."
+    metrics.error = metrics.error.strip().split("\n", 1)[0][:300]
+    metrics.r_seconds = round(metrics.r_seconds, 3)
+    print(f"   > [{'SUCCESS' if metrics.passed else 'FAILURE'}] {dataset} task {number}: {metrics.seconds:.1f}s, "
+          f"{metrics.retries} retries, {metrics.prompt_tokens + metrics.completion_tokens} tokens.")
+    return metrics
+
+
+async def run_benchmark(folders: List[Path], task_selection: Optional[str], settings: dict,
+                        parallel: int = 1) -> List[TaskMetrics]:
+    """Runs the selected tasks of every folder; hooks must already be installed."""
+    agent_runnable = create_benchmark_runnable()
+    semaphore = asyncio.Semaphore(max(1, parallel))
+    runs = []
+    for folder in folders:
+        dataset = folder.name
+        prompts = read_prompts(find_task_file(folder, "*prompt*.txt", "prompt file"))
+        data_file = find_task_file(folder, "*.csv", "CSV file")
+        work_dir = Path(TEMP_DIR) / "benchmark" / dataset
+        work_dir.mkdir(parents=True, exist_ok=True)
+        staged_data = work_dir / data_file.name
+        shutil.copyfile(data_file, staged_data)
+        data = prepare_data(staged_data, work_dir)
+        if data.columnar_path:
+            # The copy of an earlier run may be of a different CSV
+            reset_ingest(data.columnar_path)
+            start_ingest(data.file_path, data.columnar_path)
+        for number in parse_task_selection(task_selection, len(prompts)):
+            runs.append(run_task(agent_runnable, dataset, number, prompts[number - 1], data,
+                                 work_dir / f"task_{number}", settings, semaphore))
+    try:
+        return list(await asyncio.gather(*runs))
+    finally:
+        await aclose_openai_clients()
+
+
+def summarize(results: List[TaskMetrics]) -> dict:
+    """Totals over all tasks."""
+    seconds = sorted(r.seconds for r in results)
+    node_seconds: Dict[str, float] = {}
+    for r in results:
+        for name, value in r.node_seconds.items():
+            node_seconds[name] = round(node_seconds.get(name, 0.0) + value, 3)
+    passed = sum(r.passed for r in results)
+    return {
+        "tasks": len(results),
+        "passed": passed,
+        "pass_rate": round(passed / len(results), 3) if results else 0.0,
+        "seconds": round(sum(seconds), 3),
+        "median_seconds": seconds[len(seconds) // 2] if seconds else 0.0,
+        "retries": sum(r.retries for r in results),
+        "llm_calls": sum(r.llm_calls for r in results),
+        "vision_calls": sum(r.vision_calls for r in results),
+        "prompt_tokens": sum(r.prompt_tokens for r in results),
+        "completion_tokens": sum(r.completion_tokens for r in results),
+        "r_runs": sum(r.r_runs for r in results),
+        "r_seconds": round(sum(r.r_seconds for r in results), 3),
+        "replay_misses": sum(r.replay_misses for r in results),
+        "node_seconds": node_seconds,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_reports(results: List[TaskMetrics], report: dict, output_dir: Path, name: str):
+    """Writes `<name>.json` (metadata, totals and tasks) and `<name>.csv` (one row per task)."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / f"{name}.json", "w", encoding="utf-8") as f:
+        json.dump({**report, "totals": summarize(results), "tasks": [asdict(r) for r in results]},
+                  f, ensure_ascii=False, indent=2)
+
+    scalar_fields = [key for key in TaskMetrics.__dataclass_fields__ if key not in ("node_seconds", "node_calls")]
+    node_fields = [f"{node}_s" for node in AGENT_NODES]
+    with open(output_dir / f"{name}.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=scalar_fields + node_fields)
+        writer.writeheader()
+        for r in results:
+            row = {key: value for key, value in asdict(r).items() if key in scalar_fields}
+            row.update({f"{node}_s": r.node_seconds.get(node, 0.0) for node in AGENT_NODES})
+            writer.writerow(row)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the agent on the benchmark prompt files.")
+    parser.add_argument("folders", nargs="*", type=Path,
+                        help=f"Task folders (default: every {BENCHMARK_DIR}/dataset*).")
+    parser.add_argument("--mode", choices=MODES, default="live",
+                        help="live: real calls; record: real calls, saved; replay: recorded responses only.")
+    parser.add_argument("--recording", default=BENCHMARK_RECORDING_PATH, help="Recorded responses file.")
+    parser.add_argument("--replay-latency", action="store_true",
+                        help="When replaying, wait as long as the recorded call took.")
+    parser.add_argument("--stub-executor", action="store_true",
+                        help="Do not run R: scripts succeed with blank figures (unless a recording exists in replay mode).")
+    parser.add_argument("--stub-model", action="store_true",
+                        help="Do not call the models: canned answers and a fixed script (unless a recording exists in replay mode).")
+    parser.add_argument("--tasks", help="Tasks to run in every folder, e.g. '1,3-5' (default: all).")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Tasks running at the same time (default 1, for undisturbed latencies).")
+    parser.add_argument("--settings", default="{}",
+                        help=f"JSON object of per-run settings; keys: {', '.join(DEFAULT_JOB_SETTINGS)}.")
+    parser.add_argument("--output-dir", type=Path, default=Path(BENCHMARK_RESULTS_DIR), help="Where reports go.")
+    parser.add_argument("--label", default="", help="Free-text label stored in the report, e.g. the change being measured.")
+    args = parser.parse_args(argv)
+
+    folders = args.folders or sorted(p for p in Path(BENCHMARK_DIR).glob("dataset*") if p.is_dir())
+    if not folders:
+        parser.error(f"No task folders found in {BENCHMARK_DIR}.")
+    settings = {**BENCHMARK_SETTINGS, **json.loads(args.settings)}
+    unknown = set(settings) - set(DEFAULT_JOB_SETTINGS)
+    if unknown:
+        parser.error(f"Unknown settings: {', '.join(sorted(unknown))}")
+    if args.stub_model and args.mode == "record":
+        parser.error("--stub-model answers every call itself, so there is nothing to record.")
+    if args.mode == "replay" or args.stub_model:
+        # Replayed and stubbed calls never reach the endpoint
+        settings["api_key"] = settings["vision_api_key"] = "replay" if args.mode == "replay" else "stub"
+    else:
+        settings["api_key"] = os.getenv("GGPLOTAGENT_API_KEY")
+        settings["vision_api_key"] = os.getenv("GGPLOTAGENT_VISION_API_KEY")
+        if not settings["api_key"] or not settings["vision_api_key"]:
+            parser.error("Set GGPLOTAGENT_API_KEY and GGPLOTAGENT_VISION_API_KEY (or use --mode replay or --stub-model).")
+    if args.mode == "replay" and not os.path.exists(args.recording):
+        parser.error(f"No recording at {args.recording}; create one with --mode record.")
+
+    store = RecordingStore(args.recording) if args.mode != "live" else None
+    set_client_wrapper(ModelCallRecorder(args.mode, store, args.replay_latency, stub=args.stub_model).wrap)
+    set_r_execution_hook(BenchmarkExecutionHook(args.mode, store, stub=args.stub_executor,
+                                                replay_latency=args.replay_latency))
+    started_at = datetime.now()
+    try:
+        results = asyncio.run(run_benchmark(folders, args.tasks, settings, parallel=args.parallel))
+    finally:
+        set_client_wrapper(None)
+        set_r_execution_hook(None)
+        if args.mode == "record":
+            store.save()
+            print(f"--- [BENCHMARK] Recording saved to {args.recording}.")
+
+    report = {
+        "label": args.label,
+        "mode": args.mode,
+        "stub_executor": args.stub_executor,
+        "stub_model": args.stub_model,
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "folders": [str(folder) for folder in folders],
+        "settings": {key: value for key, value in settings.items() if key not in ("api_key", "vision_api_key")},
+    }
+    name = f"run_{started_at:%Y%m%d-%H%M%S}_{args.mode}"
+    write_reports(results, report, args.output_dir, name)
+
+    totals = summarize(results)
+    print(f"\n{'dataset':<10} {'task':>4}  {'pass':<4}  {'seconds':>8}  {'retries':>7}  {'tokens':>7}  {'r_s':>6}")
+    for r in results:
+        print(f"{r.dataset:<10} {r.task:>4}  {'yes' if r.passed else 'no':<4}  {r.seconds:>8.1f}  {r.retries:>7}  "
+              f"{r.prompt_tokens + r.completion_tokens:>7}  {r.r_seconds:>6.1f}")
+    print(f"\n{totals['passed']}/{totals['tasks']} passed, {totals['seconds']:.1f}s total, "
+          f"{totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion tokens"
+          f"{', ' + str(totals['replay_misses']) + ' replay misses' if totals['replay_misses'] else ''}.")
+    print(f"Reports written to {args.output_dir / name}.json and .csv.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
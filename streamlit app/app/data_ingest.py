@@ -0,0 +1,131 @@
+# app/data_ingest.py
+"""
+One-time conversion of the uploaded CSV into a columnar Feather (Arrow IPC) file.
+
+The Feather file is what generated scripts load through the `__INPUT_DATA__`
+placeholder, so every execution attempt memory-maps typed columns instead of
+re-parsing the CSV with base R. Column names are sanitized up front exactly as
+`read.csv` would sanitize them, so scripts see the same names in both modes.
+
+Reading the whole CSV takes time proportional to its size, so uploads are not
+converted on the request path: `start_ingest` converts in a background thread while
+the agent validates and plans, and the executor only waits for it (`start_ingest(...)
+.result()`) when an R script is about to load the file. The file is written under a
+temporary name and renamed into place, so an existing file is always complete; a
+failed conversion leaves a `.failed` marker next to it so it is not retried.
+"""
+
+import os
+import threading
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from app.r_static import r_make_names
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # columnar hand-off is optional; scripts fall back to read.csv
+    pa = None
+    feather = None
+
+COLUMNAR_FILE_NAME = "input_data.feather"
+_FAILED_SUFFIX = ".failed"
+INGEST_WORKERS = int(os.getenv("GGPLOTAGENT_INGEST_WORKERS", "2"))
+
+_ingest_executor = ThreadPoolExecutor(max_workers=max(1, INGEST_WORKERS), thread_name_prefix="ggplotagent-ingest")
+# Conversions running in this process, by target file; finished ones are found on disk
+_ingests: Dict[str, Future] = {}
+_ingests_lock = threading.Lock()
+
+
+@dataclass
+class IngestedData:
+    """A columnar copy of the uploaded data."""
+    path: str
+    columns: List[str]  # sanitized names, as seen from R
+    rows: int
+
+
+def columnar_available() -> bool:
+    return feather is not None
+
+
+def columnar_path_for(output_dir: str) -> Optional[str]:
+    """Where `ingest_csv` writes the columnar copy for `output_dir`, or None if it cannot."""
+    if not columnar_available():
+        return None
+    return str((Path(output_dir) / COLUMNAR_FILE_NAME).absolute())
+
+
+def start_ingest(csv_path: str, columnar_path: str) -> Future:
+    """
+    Converts `csv_path` to `columnar_path` in a background thread, at most once per target.
+
+    Returns:
+        A future resolving to True once the file is ready, or False if conversion failed.
+    """
+    with _ingests_lock:
+        future = _ingests.get(columnar_path)
+        if future is not None:
+            return future
+        if Path(columnar_path).exists() or Path(columnar_path + _FAILED_SUFFIX).exists():
+            # Converted (or given up on) earlier, possibly by another process
+            future = Future()
+            future.set_result(Path(columnar_path).exists())
+            return future
+        future = _ingest_executor.submit(_convert, csv_path, columnar_path)
+        _ingests[columnar_path] = future
+    # Outside the lock: the callback runs right away if the conversion already finished
+    future.add_done_callback(partial(_forget_ingest, columnar_path))
+    return future
+
+
+def reset_ingest(columnar_path: str):
+    """Deletes the columnar copy and any failure marker, so the next `start_ingest` converts again."""
+    Path(columnar_path).unlink(missing_ok=True)
+    Path(columnar_path + _FAILED_SUFFIX).unlink(missing_ok=True)
+
+
+def _convert(csv_path: str, columnar_path: str) -> bool:
+    if ingest_csv(csv_path, str(Path(columnar_path).parent)) is not None:
+        return True
+    Path(columnar_path + _FAILED_SUFFIX).touch()
+    return False
+
+
+def _forget_ingest(columnar_path: str, future: Future):
+    with _ingests_lock:
+        if _ingests.get(columnar_path) is future:
+            del _ingests[columnar_path]
+
+
+def ingest_csv(csv_path: str, output_dir: str) -> Optional[IngestedData]:
+    """
+    Converts a CSV file to Feather with R-compatible column names.
+
+    Returns:
+        The ingested file, or None when pyarrow is not installed or conversion fails,
+        in which case callers keep handing the CSV to R.
+    """
+    if not columnar_available():
+        return None
+    output_path = Path(output_dir) / COLUMNAR_FILE_NAME
+    temp_path = output_path.with_name(output_path.name + ".tmp")
+    try:
+        df = pd.read_csv(csv_path)
+        df.columns = r_make_names([str(c) for c in df.columns])
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # Uncompressed files are memory-mapped by R without a decode step
+        feather.write_feather(table, str(temp_path), compression="uncompressed")
+        os.replace(temp_path, output_path)
+    except Exception as e:
+        temp_path.unlink(missing_ok=True)
+        print(f"   > [WARNING] Could not convert data to a columnar file, using CSV instead: {e}")
+        return None
+    return IngestedData(path=str(output_path.absolute()), columns=list(df.columns), rows=len(df))
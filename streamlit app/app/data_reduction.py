@@ -0,0 +1,233 @@
+# app/data_reduction.py
+"""
+Optional, density-aware thinning of large scatter/volcano datasets before rendering.
+
+Points are binned on a regular grid over the plotted axes; sparse bins are kept in
+full and dense bins keep at most `max_per_bin` points, so overplotted regions look
+the same while the PNG/PDF carry far fewer objects. Significant points (volcano
+plots), rows named in the plan or request, and the most extreme points, which are
+the likely labels, are always kept.
+"""
+
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.data_ingest import ingest_csv
+
+REDUCTION_MIN_ROWS = 5_000
+REDUCTION_GRID_BINS = 200
+REDUCTION_MAX_PER_BIN = 3
+REDUCTION_TOP_LABELS = 50
+# Used when the plan and request state no cut-off: every point a usual threshold
+# (p or FDR below 0.05 or 0.1, with or without a fold-change cut-off) would highlight is kept
+FALLBACK_SIGNIFICANCE_P = 0.1
+FALLBACK_ABS_FC = 0.0
+
+_FOLD_CHANGE = re.compile(r"^(log2?)?(fc|foldchange|fold_?change|log2foldchange)$")
+_P_VALUE = re.compile(r"^(p\.?adj|padj|adj\.?p\.?val|fdr|q\.?val(ue)?|p\.?val(ue)?)$")
+# Plans that aggregate or estimate densities would be distorted by thinning
+_AGGREGATING_PLAN = re.compile(
+    r"summari[sz]e|mean\(|median\(|geom_smooth|stat_|geom_density|geom_hex|geom_bin|histogram|geom_bar|geom_col|"
+    r"geom_boxplot|geom_violin|count\(|cor\(|lm\(|n\(\)", re.IGNORECASE)
+_THRESHOLD_OPERATOR = r"\s*\)?\s*(?:{ops}|(?:cut-?off|threshold|of)(?:\s+of)?)\s*(\d*\.?\d+(?:e-?\d+)?)"
+# "padj < 0.01", "FDR of 0.1", "p-value cutoff 0.05", "df$pvalue <= 1e-3"
+_P_THRESHOLD = re.compile(
+    r"(?<![\w.])[`'\"]?(?:p[\s._-]?adj\w*|adj\w*[\s._-]?p\w*|fdr|q[\s._-]?val\w*|p[\s._-]?val\w*|p)[`'\"]?"
+    + _THRESHOLD_OPERATOR.format(ops=r"<=?|≤|=|below|less than|under"), re.IGNORECASE)
+# "abs(log2FoldChange) > 1", "|log2FC| >= 0.58", "fold change above 2"
+_FC_THRESHOLD = re.compile(
+    r"(?<![\w.])(?:abs\s*\(\s*|\|\s*)?[`'\"]?(?:log2?[\s._-]?f(?:old)?[\s._-]?c(?:hange)?|l(?:og)?fc|fold[\s._-]?change|fc)[`'\"]?\s*\|?"
+    + _THRESHOLD_OPERATOR.format(ops=r">=?|≥|=|above|greater than|over"), re.IGNORECASE)
+_NAME_TOKEN = re.compile(r"[A-Za-z0-9][\w.\-]*[A-Za-z0-9]")
+_AES_XY = re.compile(r"aes\s*\(\s*(?:x\s*=\s*)?`?([\w.]+)`?\s*,\s*(?:y\s*=\s*)?`?([\w.]+)`?", re.IGNORECASE)
+
+
+@dataclass
+class ReductionResult:
+    """Where the thinned data was written and how much it was reduced."""
+    file_path: str
+    columnar_path: Optional[str]
+    rows_in: int
+    rows_out: int
+    description: str
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[\s_\-]", "", str(name).lower())
+
+
+def _find_column(columns: List[str], pattern: re.Pattern) -> Optional[str]:
+    return next((c for c in columns if pattern.match(_normalize(c))), None)
+
+
+def _find_columns(columns: List[str], pattern: re.Pattern) -> List[str]:
+    return [c for c in columns if pattern.match(_normalize(c))]
+
+
+def significance_thresholds(text: str) -> Tuple[Optional[float], Optional[float]]:
+    """
+    The (p-value, |fold change|) cut-offs stated in the plan or request, None where none is stated.
+
+    When several are stated the most inclusive one wins, and a fold change written
+    without "log" (e.g. "fold change above 2") is taken as a ratio and converted to log2.
+    """
+    p_values = [float(m.group(1)) for m in _P_THRESHOLD.finditer(text)]
+    p_values = [v for v in p_values if 0 < v < 1]
+    fold_changes = []
+    for match in _FC_THRESHOLD.finditer(text):
+        value = float(match.group(1))
+        if "log" not in match.group(0).lower() and value > 1:
+            value = float(np.log2(value))
+        fold_changes.append(value)
+    return (max(p_values) if p_values else None), (min(fold_changes) if fold_changes else None)
+
+
+def named_rows(df: pd.DataFrame, text: str) -> np.ndarray:
+    """Rows whose identifier (e.g. a gene symbol) is mentioned in `text`, the points a plan asks to label."""
+    tokens = set(_NAME_TOKEN.findall(text))
+    keep = np.zeros(len(df), dtype=bool)
+    if not tokens:
+        return keep
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            continue
+        # Only identifier-like columns, so a word such as "up" does not select a whole category
+        if values.nunique() < len(df) / 2:
+            continue
+        keep |= values.astype(str).isin(tokens).to_numpy()
+    return keep
+
+
+def thin_by_density(x: np.ndarray, y: np.ndarray, keep: np.ndarray, bins: int = REDUCTION_GRID_BINS,
+                    max_per_bin: int = REDUCTION_MAX_PER_BIN, seed: int = 0) -> np.ndarray:
+    """
+    Returns a boolean mask selecting at most `max_per_bin` points per grid cell, plus every point in `keep`.
+
+    Non-finite coordinates are always kept so nothing silently disappears from the plot.
+    """
+    finite = np.isfinite(x) & np.isfinite(y)
+    mask = keep | ~finite
+    if finite.sum() == 0:
+        return mask
+
+    def bin_index(values):
+        lo, hi = np.nanmin(values[finite]), np.nanmax(values[finite])
+        span = hi - lo if hi > lo else 1.0
+        return np.clip(((values - lo) / span * bins).astype(int, copy=False), 0, bins - 1)
+
+    with np.errstate(invalid="ignore"):
+        cell = bin_index(x) * bins + bin_index(y)
+    candidates = np.flatnonzero(finite & ~keep)
+    # Random order within each cell, so the kept points are an unbiased sample of it
+    order = np.random.default_rng(seed).permutation(len(candidates))
+    candidates = candidates[order]
+    cells = cell[candidates]
+    sort = np.argsort(cells, kind="stable")
+    candidates, cells = candidates[sort], cells[sort]
+    first_of_cell = np.r_[0, np.flatnonzero(np.diff(cells)) + 1]
+    rank = np.arange(len(cells)) - np.repeat(first_of_cell, np.diff(np.r_[first_of_cell, len(cells)]))
+    mask[candidates[rank < max_per_bin]] = True
+    return mask
+
+
+def write_rows(file_path: str, mask: np.ndarray, output_path: Path) -> bool:
+    """
+    Copies the rows of `file_path` selected by `mask` to `output_path` without re-serialising them.
+
+    Fields are read and written back as the original strings, so "NA", empty cells,
+    number formatting and the header (duplicate names included) stay as in the
+    source; only the quoting of fields may differ. Returns False, writing nothing,
+    if the file does not split into as many rows as `mask`.
+    """
+    header = pd.read_csv(file_path, header=None, nrows=1, dtype=str, na_filter=False).iloc[0].tolist()
+    raw = pd.read_csv(file_path, header=None, skiprows=1, dtype=str, na_filter=False)
+    if len(raw) != len(mask) or raw.shape[1] != len(header):
+        return False
+    raw[mask].to_csv(output_path, index=False, header=header)
+    return True
+
+
+def reduce_for_render(file_path: str, plot_plan: str, output_dir: str, request: str = "",
+                      min_rows: int = REDUCTION_MIN_ROWS) -> Optional[ReductionResult]:
+    """
+    Thins a large scatter or volcano dataset, or returns None when the plot should see all rows.
+
+    Volcano data (a fold-change and a p-value/FDR column) is binned on (fold change,
+    -log10 p) and keeps every point significant under the cut-offs stated in the plan or
+    request, or under the loose fallback ones when none is stated. Other scatter plots
+    are binned on the x/y columns of the plan's first `aes()` mapping. Rows named in the
+    plan or request are kept in both cases.
+
+    The reduced CSV is a subset of the original rows with their values unchanged
+    (see `write_rows`); R reads it exactly as it would have read the full file.
+    """
+    plan = plot_plan or ""
+    if "geom_point" not in plan or _AGGREGATING_PLAN.search(plan):
+        return None
+    df = pd.read_csv(file_path)
+    if len(df) < min_rows:
+        return None
+    columns = [str(c) for c in df.columns]
+    text = f"{plan}\n{request}"
+    named = named_rows(df, text)
+
+    fc_col = _find_column(columns, _FOLD_CHANGE)
+    p_cols = [c for c in _find_columns(columns, _P_VALUE) if pd.api.types.is_numeric_dtype(df[c])]
+    if fc_col and p_cols and pd.api.types.is_numeric_dtype(df[fc_col]):
+        stated_p, stated_fc = significance_thresholds(text)
+        p_threshold = stated_p if stated_p is not None else FALLBACK_SIGNIFICANCE_P
+        fc_threshold = stated_fc if stated_fc is not None else FALLBACK_ABS_FC
+        fc = df[fc_col].to_numpy(dtype=float)
+        keep = named.copy()
+        # The plan may threshold any of the p-value columns, so a point significant on one of them is kept
+        for p_col in p_cols:
+            p = df[p_col].to_numpy(dtype=float)
+            keep |= (p < p_threshold) & (np.abs(fc) >= fc_threshold)
+            keep[np.argsort(p)[:REDUCTION_TOP_LABELS]] = True
+        keep[np.argsort(-np.abs(fc))[:REDUCTION_TOP_LABELS]] = True
+        p_col = p_cols[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            neg_log_p = -np.log10(df[p_col].to_numpy(dtype=float))
+        x, y = fc, neg_log_p
+        source = "as stated" if stated_p is not None or stated_fc is not None else "fallback cut-offs"
+        description = (f"volcano layout ({fc_col} vs -log10({p_col})); all points with {' or '.join(p_cols)} < {p_threshold} "
+                       f"and |{fc_col}| >= {fc_threshold} kept ({source})")
+    else:
+        match = _AES_XY.search(plan)
+        if not match or match.group(1) not in columns or match.group(2) not in columns:
+            return None
+        x_col, y_col = match.group(1), match.group(2)
+        if not (pd.api.types.is_numeric_dtype(df[x_col]) and pd.api.types.is_numeric_dtype(df[y_col])):
+            return None
+        x, y = df[x_col].to_numpy(dtype=float), df[y_col].to_numpy(dtype=float)
+        keep = named.copy()
+        for values in (x, y):
+            keep[np.argsort(-np.abs(np.nan_to_num(values - np.nanmedian(values))))[:REDUCTION_TOP_LABELS]] = True
+        description = f"scatter layout ({x_col} vs {y_col}); the most extreme points kept"
+    if named.any():
+        description += f"; {int(named.sum())} rows named in the plan or request kept"
+
+    mask = thin_by_density(x, y, keep)
+    if mask.all():
+        return None
+    output_path = Path(output_dir) / f"render_{Path(file_path).name}"
+    if not write_rows(file_path, mask, output_path):
+        print("   > [WARNING] Could not copy the rows verbatim; rendering all of them.")
+        return None
+    rows_out = int(mask.sum())
+    columnar_dir = Path(output_dir) / "render"
+    columnar_dir.mkdir(exist_ok=True)
+    ingested = ingest_csv(str(output_path), str(columnar_dir))
+    return ReductionResult(
+        file_path=str(output_path.absolute()),
+        columnar_path=ingested.path if ingested else None,
+        rows_in=len(df),
+        rows_out=rows_out,
+        description=f"Dense non-significant regions thinned from {len(df)} to {rows_out} rows ({description}).",
+    )
@@ -0,0 +1,129 @@
+# app/error_history.py
+"""
+Compaction of failed attempts before they are shown to the debugger.
+
+R's stderr is reduced to the error and traceback lines (package start-up and conflict
+messages are dropped), scripts repeated across attempts are shown once, and the
+rendered history is kept within a token budget by dropping the oldest attempts first,
+so debugger prompts stay roughly the same size however many retries there are.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+ERROR_HISTORY_TOKEN_BUDGET = int(os.getenv("GGPLOTAGENT_ERROR_HISTORY_TOKENS", "3000"))
+STDERR_MAX_LINES = int(os.getenv("GGPLOTAGENT_STDERR_MAX_LINES", "25"))
+
+_NOISE = re.compile(
+    r"^\s*(?:── Attaching|── Conflicts|✔ |✖ |ℹ |v |x |Attaching package|Loading required package|"
+    r"The following objects? (?:is|are) masked|\s*filter, lag|\s*intersect, setdiff|Registered S3 method|"
+    r"Use the conflicted package|\(Use `conflicted|Rows: \d+ Columns: \d+|Column specification|Delimiter:|"
+    r"chr \(|dbl \(|lgl \(|Use `spec\(\)`|Specify the column types)"
+)
+_ERROR_START = re.compile(r"^(?:Error|Fehler|Execution halted|Calls:|Backtrace:|In addition:|Warning message|EXECUTION|OUT OF MEMORY|R syntax error|Pre-flight)|error", re.IGNORECASE)
+_CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token), good enough for budgeting."""
+    return len(text) // _CHARS_PER_TOKEN + 1
+
+
+def compact_stderr(stderr: str, max_lines: int = STDERR_MAX_LINES) -> str:
+    """Keeps the R error, its call stack and trailing context; drops start-up noise."""
+    lines = [line.rstrip() for line in (stderr or "").splitlines() if line.strip()]
+    start = next((i for i, line in enumerate(lines) if _ERROR_START.search(line) and not _NOISE.match(line)), None)
+    if start is not None:
+        # Everything from the error on is kept: rlang errors put the details on ℹ/✖ lines
+        lines = lines[start:]
+    else:
+        lines = [line for line in lines if not _NOISE.match(line)]
+    if len(lines) > max_lines:
+        head = max_lines - max_lines // 3
+        lines = lines[:head] + [f"... ({len(lines) - max_lines} lines omitted) ..."] + lines[-(max_lines - head):]
+    return "\n".join(lines)
+
+
+def _cut_middle(text: str, max_chars: int) -> str:
+    """Keeps the head and tail of `text` within about `max_chars`, like `compact_stderr` does with lines."""
+    if len(text) <= max_chars:
+        return text
+    head = max(max_chars - max_chars // 3, 0)
+    tail = max(max_chars - head, 0)
+    return f"{text[:head]}\n... ({len(text) - head - tail} characters omitted) ...\n{text[len(text) - tail:] if tail else ''}"
+
+
+def _first_line(text: str) -> str:
+    return text.split("\n", 1)[0] if text else "unknown error"
+
+
+@dataclass
+class FailedAttempt:
+    """One parsed `error_history` entry."""
+    header: str
+    script: Optional[str]
+    error: str
+
+
+def parse_history_entry(entry: str) -> FailedAttempt:
+    """Splits an "ATTEMPT n FAILED\\n--- SCRIPT ---\\n...\\n--- ERROR ---\\n..." entry."""
+    header, _, rest = entry.partition("\n")
+    script, error = None, rest
+    if "--- ERROR ---" in rest:
+        before, _, error = rest.partition("--- ERROR ---")
+        match = re.match(r"\s*--- SCRIPT[^\n]*---\n(.*)", before, re.DOTALL)
+        script = match.group(1).strip() if match else None
+    return FailedAttempt(header=header.strip(), script=script, error=error.strip())
+
+
+def format_error_history(entries: List[str], current_script: Optional[str] = None,
+                         token_budget: int = ERROR_HISTORY_TOKEN_BUDGET, include_scripts: bool = True) -> str:
+    """
+    Renders `error_history` compactly for a debugger prompt.
+
+    Scripts identical to the current one or to a later attempt are replaced by a
+    reference. Attempts are added newest first until `token_budget` is reached; older
+    ones are reduced to a single line listing their first error line. If the newest
+    attempt alone is over budget, its script is replaced by a reference and only its
+    error is cut, keeping the head and tail; a script is never cut.
+    """
+    attempts = [parse_history_entry(entry) for entry in entries]
+    # A repeated script is printed with its newest attempt, which is the last to be dropped
+    newest = {attempt.script: number for number, attempt in enumerate(attempts, start=1) if attempt.script}
+    blocks = []
+    for number, attempt in enumerate(attempts, start=1):
+        script_part = None
+        if include_scripts and attempt.script:
+            if current_script is not None and attempt.script == current_script.strip():
+                script_part = "--- SCRIPT ---\n(identical to the current script)"
+            elif newest[attempt.script] != number:
+                script_part = f"--- SCRIPT ---\n(identical to the script of attempt {newest[attempt.script]})"
+            else:
+                script_part = f"--- SCRIPT ---\n{attempt.script}"
+        blocks.append((attempt, script_part, compact_stderr(attempt.error)))
+
+    kept, used = [], 0
+    for attempt, script_part, error in reversed(blocks):
+        block = "\n".join(part for part in (attempt.header, script_part, f"--- ERROR ---\n{error}") if part)
+        cost = estimate_tokens(block)
+        if kept and used + cost > token_budget:
+            break
+        if not kept and cost > token_budget:
+            # Even the newest attempt is too large on its own: drop its script, then shorten its error
+            if script_part and "(identical to" not in script_part:
+                script_part = "--- SCRIPT ---\n(omitted to fit the prompt; see the current script)"
+            head = "\n".join(part for part in (attempt.header, script_part, "--- ERROR ---") if part)
+            error = _cut_middle(error, max(token_budget * _CHARS_PER_TOKEN - len(head) - 50, 200))
+            block = f"{head}\n{error}"
+            cost = estimate_tokens(block)
+        kept.append(block)
+        used += cost
+    kept.reverse()
+
+    omitted = attempts[:len(attempts) - len(kept)]
+    if omitted:
+        summary = "; ".join(f"{a.header}: {_first_line(compact_stderr(a.error))[:200]}" for a in omitted)
+        kept.insert(0, f"({len(omitted)} earlier attempt(s) summarized) {summary}")
+    return "\n\n".join(kept)
@@ -0,0 +1,112 @@
+# app/image_prep.py
+"""
+Shrinks images before they are sent to the vision model.
+
+Reference images and rendered plots are downscaled to a maximum edge, re-encoded
+(PNG, JPEG or WebP) and stripped of metadata, so data URIs stay small. Byte sizes
+before and after are logged to help tune `VISION_MAX_EDGE` against QA accuracy.
+"""
+
+import base64
+import io
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow the original file is sent unchanged
+    Image = None
+
+VISION_MAX_EDGE = int(os.getenv("GGPLOTAGENT_VISION_MAX_EDGE", "1568"))
+VISION_IMAGE_FORMAT = os.getenv("GGPLOTAGENT_VISION_IMAGE_FORMAT", "webp").lower()  # png, jpeg or webp
+VISION_IMAGE_QUALITY = int(os.getenv("GGPLOTAGENT_VISION_IMAGE_QUALITY", "90"))  # jpeg/webp only
+
+_MIME_TYPES = {"png": "png", "jpg": "jpeg", "jpeg": "jpeg", "webp": "webp", "gif": "gif", "bmp": "bmp"}
+
+
+@dataclass
+class PreparedImage:
+    """Encoded image bytes ready to be embedded in a data URI."""
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+    def to_data_uri(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+
+def _read_unchanged(path: Path) -> PreparedImage:
+    data = path.read_bytes()
+    mime = _MIME_TYPES.get(path.suffix.lower().lstrip("."), "png")
+    return PreparedImage(data=data, mime_type=f"image/{mime}", original_bytes=len(data))
+
+
+def _flatten(image, image_format: str):
+    """Converts to a mode the target format can store, compositing transparency onto white for JPEG."""
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    if image_format == "jpeg":
+        if image.mode in ("RGBA", "LA"):
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            return background
+        return image.convert("RGB") if image.mode != "RGB" else image
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        return image.convert("RGBA")
+    return image
+
+
+def prepare_image(image_path: str, max_edge: int = VISION_MAX_EDGE, image_format: str = VISION_IMAGE_FORMAT,
+                  quality: int = VISION_IMAGE_QUALITY) -> PreparedImage:
+    """
+    Resizes an image to fit within `max_edge` pixels and re-encodes it without metadata.
+
+    The original bytes are kept when Pillow is unavailable, the file cannot be decoded,
+    or re-encoding would not make an unresized image smaller.
+    """
+    path = Path(image_path)
+    if Image is None:
+        return _read_unchanged(path)
+    image_format = "jpeg" if image_format == "jpg" else image_format
+    original_bytes = path.stat().st_size
+    try:
+        with Image.open(path) as source:
+            source.load()
+            image = source.copy()
+        resized = max(image.size) > max_edge
+        if resized:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        image = _flatten(image, image_format)
+        image.info = {}  # drop EXIF, text chunks and ICC profiles
+
+        buffer = io.BytesIO()
+        if image_format == "png":
+            image.save(buffer, format="PNG", optimize=True)
+        elif image_format == "jpeg":
+            image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+        elif image_format == "webp":
+            image.save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            raise ValueError(f"Unsupported vision image format: {image_format}")
+    except Exception as e:
+        print(f"   > [WARNING] Could not prepare image '{path.name}', sending it unchanged: {e}")
+        return _read_unchanged(path)
+
+    data = buffer.getvalue()
+    if not resized and len(data) >= original_bytes:
+        return _read_unchanged(path)
+    return PreparedImage(data=data, mime_type=f"image/{image_format}", original_bytes=original_bytes,
+                         width=image.size[0], height=image.size[1])
+
+
+def image_to_data_uri(image_path: str, **kwargs) -> str:
+    """Prepares an image for the vision model and logs how many bytes were saved."""
+    prepared = prepare_image(image_path, **kwargs)
+    size = f", {prepared.width}x{prepared.height}" if prepared.width else ""
+    print(f"   > [IMAGE] {Path(image_path).name}: {prepared.original_bytes} -> {len(prepared.data)} bytes "
+          f"({prepared.mime_type}{size})")
+    return prepared.to_data_uri()
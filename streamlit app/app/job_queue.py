@@ -0,0 +1,466 @@
+# app/job_queue.py
+"""
+Persistent job queue and a fixed pool of agent workers.
+
+Front ends submit an initial graph state and get a job id back; a bounded number
+of worker threads run the graph, so concurrency is set by `num_workers` (and by
+the per-stage limits in stage_limits.py) instead of by the number of open browser
+tabs. Job status, progress steps and results live in a SQLite file, so a client can
+reconnect to a job by id after a page refresh.
+
+Several processes (e.g. the Streamlit app and the HTTP API) may share the database.
+Every queue instance only runs the jobs submitted to it, since API keys are never
+written to disk but kept in the submitting process's memory until the job starts.
+Instances heartbeat into the database; the unfinished jobs of an instance that
+stopped heartbeating (its process exited or crashed) are marked as failed by the
+other instances and have to be resubmitted.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.result_cache import ResultCache, cached_stream
+from app.r_executor import R_EXEC_TIMEOUT
+from app.data_profiler import DataProfile, profile_csv
+from app.data_ingest import columnar_path_for, start_ingest
+from app.r_static import r_make_names
+
+JOB_QUEUE_PATH = os.getenv("GGPLOTAGENT_JOB_QUEUE_PATH", os.path.join("temp_data", "jobs.sqlite"))
+JOB_WORKERS = int(os.getenv("GGPLOTAGENT_JOB_WORKERS", "4"))
+# Seconds between an instance's heartbeats, and without one after which its jobs are failed
+QUEUE_HEARTBEAT_SECONDS = 10.0
+QUEUE_INSTANCE_TIMEOUT_SECONDS = 60.0
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+DEFAULT_BASE_URL = "https://ark.cn-beijing.volces.com/api/v3"
+DEFAULT_MODEL = "deepseek-v3-250324"
+DEFAULT_VISION_MODEL = "doubao-1-5-thinking-vision-pro-250428"
+
+# Per-run settings accepted by `prepare_initial_state`, with their defaults
+DEFAULT_JOB_SETTINGS = {
+    "base_url": DEFAULT_BASE_URL,
+    "model_name": DEFAULT_MODEL,
+    "vision_base_url": DEFAULT_BASE_URL,
+    "vision_model": DEFAULT_VISION_MODEL,
+    "max_retries": 3,
+    "r_backend": "pool",
+    "r_timeout": R_EXEC_TIMEOUT,
+    "llm_cache": False,
+    "pipelined_execution": False,
+    "downsample_for_render": False,
+    "style_cache": True,
+    "parallel_candidates": 1,
+    "parallel_planning": False,
+    "debug_patch_mode": False,
+    "two_phase_render": False,
+    "draft_dpi": 100,
+}
+
+# State keys holding credentials; kept out of the database
+_SECRET_KEYS = ("api_key", "vision_api_key")
+# Live token output kept per running job, for clients showing the script as it is generated
+_MAX_LIVE_CHARS = 20_000
+
+
+@dataclass
+class JobRecord:
+    """Status and outcome of a submitted job."""
+    id: str
+    status: str
+    current_step: Optional[str]
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Dict = field(default_factory=dict)  # figure_path, pdf_path, code_path on success
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+
+@dataclass
+class JobEvent:
+    """One progress step of a job."""
+    seq: int
+    kind: str  # "step", "status"
+    message: str
+    created_at: float
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class PreparedData:
+    """An uploaded CSV, profiled once; may be shared by several jobs."""
+    file_path: str
+    profile: DataProfile
+    columnar_path: Optional[str]  # where the columnar copy is (or will be) written, if pyarrow is available
+    columnar_columns: Optional[List[str]]
+
+
+def prepare_data(data_file_path: Path, output_dir: Path) -> PreparedData:
+    """
+    Profiles a CSV and picks the path of its columnar copy.
+
+    The copy itself is written later, off the request path (see `start_ingest`).
+
+    Raises:
+        Exception: whatever `profile_csv` raises for an unreadable CSV.
+    """
+    # Bounded read: only the first rows are parsed, whatever the file size
+    data_profile = profile_csv(str(data_file_path))
+    columnar_path = columnar_path_for(str(output_dir))
+    return PreparedData(
+        file_path=str(Path(data_file_path).absolute()), profile=data_profile, columnar_path=columnar_path,
+        # The same names ingest_csv gives the columns, known from the header alone
+        columnar_columns=r_make_names([str(c) for c in data_profile.columns]) if columnar_path else None,
+    )
+
+
+def build_initial_state(user_request: str, data: PreparedData, output_dir: Path,
+                        reference_image_path: Optional[Path] = None, api_key: Optional[str] = None,
+                        vision_api_key: Optional[str] = None, **settings) -> dict:
+    """
+    Builds the graph's initial state for prepared data; outputs are written to `output_dir`.
+
+    `settings` override `DEFAULT_JOB_SETTINGS`.
+
+    Raises:
+        ValueError: if a setting is unknown.
+    """
+    unknown = set(settings) - set(DEFAULT_JOB_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    return {
+        **DEFAULT_JOB_SETTINGS,
+        **settings,
+        "user_request": user_request,
+        "file_path": data.file_path,
+        "reference_image_path": str(Path(reference_image_path).absolute()) if reference_image_path else None,
+        "data_profile": data.profile.summary,
+        "available_columns": data.profile.columns,
+        "columnar_data_path": data.columnar_path,
+        "columnar_columns": data.columnar_columns,
+        "output_code_path": str((Path(output_dir) / "output_script.R").absolute()),
+        "output_figure_path": str((Path(output_dir) / "output_figure.png").absolute()),
+        "output_pdf_path": str((Path(output_dir) / "output_figure.pdf").absolute()),
+        "retry_count": 0,
+        "bypass_confirmation": True,
+        "error_history": [],
+        "api_key": api_key,
+        "vision_api_key": vision_api_key,
+        "stream_tokens": True,
+    }
+
+
+def prepare_initial_state(user_request: str, data_file_path: Path, output_dir: Path,
+                          reference_image_path: Optional[Path] = None, api_key: Optional[str] = None,
+                          vision_api_key: Optional[str] = None, **settings) -> dict:
+    """
+    Profiles an uploaded CSV and builds the graph's initial state.
+
+    Outputs are written to `output_dir`. `settings` override `DEFAULT_JOB_SETTINGS`.
+
+    Raises:
+        ValueError: if a setting is unknown.
+        Exception: whatever `profile_csv` raises for an unreadable CSV.
+    """
+    return build_initial_state(user_request, prepare_data(data_file_path, output_dir), output_dir,
+                               reference_image_path=reference_image_path, api_key=api_key,
+                               vision_api_key=vision_api_key, **settings)
+
+
+class JobQueue:
+    """SQLite-backed queue drained by `num_workers` threads running the agent graph."""
+
+    def __init__(self, agent_runnable, result_cache: Optional[ResultCache] = None, path: str = JOB_QUEUE_PATH,
+                 num_workers: int = JOB_WORKERS):
+        self.agent_runnable = agent_runnable
+        self.result_cache = result_cache
+        self.path = path
+        self.num_workers = max(1, num_workers)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._events_lock = threading.Lock()
+        self._secrets: Dict[str, dict] = {}
+        self._cancel_requested = set()
+        self._live_output: Dict[str, str] = defaultdict(str)
+        self._stopping = False
+        # Bumped on every submit so an idle worker never sleeps through a job queued while it polled
+        self._submissions = 0
+        self._stopped = threading.Event()
+        # Identifies this instance's jobs in a database shared with other processes
+        self.instance_id = uuid.uuid4().hex
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, current_step TEXT, state TEXT NOT NULL, "
+                "use_result_cache INTEGER NOT NULL, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                "job_id TEXT NOT NULL, seq INTEGER NOT NULL, kind TEXT NOT NULL, message TEXT NOT NULL, "
+                "created_at REAL NOT NULL, PRIMARY KEY (job_id, seq))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS queue_instances (id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+            # Databases created before jobs had an owner
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            if "cancel_requested" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            conn.execute("INSERT INTO queue_instances (id, heartbeat_at) VALUES (?, ?)", (self.instance_id, time.time()))
+            self._fail_orphaned_jobs(conn)
+        self._workers = [threading.Thread(target=self._work, name=f"ggplotagent-job-worker-{i}", daemon=True)
+                         for i in range(self.num_workers)]
+        self._workers.append(threading.Thread(target=self._heartbeat, name="ggplotagent-job-heartbeat", daemon=True))
+        for worker in self._workers:
+            worker.start()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # commits on success
+                yield conn
+        finally:
+            conn.close()
+
+    # --- Client API ---
+
+    def submit(self, initial_state: dict, use_result_cache: bool = True) -> str:
+        """Queues a graph run and returns its job id."""
+        job_id = uuid.uuid4().hex
+        secrets = {k: initial_state[k] for k in _SECRET_KEYS if k in initial_state}
+        public_state = {k: v for k, v in initial_state.items() if k not in _SECRET_KEYS and k != "messages"}
+        now = time.time()
+        with self._wakeup:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO jobs (id, status, current_step, state, use_result_cache, created_at, owner) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, QUEUED, "Waiting for a free worker...", json.dumps(public_state), int(use_result_cache), now,
+                     self.instance_id)
+                )
+            self._secrets[job_id] = secrets
+            self._submissions += 1
+            self._wakeup.notify()
+        self._add_event(job_id, "status", QUEUED)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, current_step, created_at, started_at, finished_at, result, error FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return JobRecord(id=row[0], status=row[1], current_step=row[2], created_at=row[3], started_at=row[4],
+                         finished_at=row[5], result=json.loads(row[6]) if row[6] else {}, error=row[7])
+
+    def events(self, job_id: str, after_seq: int = 0) -> List[JobEvent]:
+        """Progress events of a job with a sequence number greater than `after_seq`."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT seq, kind, message, created_at FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after_seq)
+            ).fetchall()
+        return [JobEvent(*row) for row in rows]
+
+    def live_output(self, job_id: str) -> str:
+        """Tokens streamed by the coder/debugger since the job's last progress step."""
+        with self._lock:
+            return self._live_output.get(job_id, "")
+
+    def position(self, job_id: str) -> Optional[int]:
+        """Number of queued jobs ahead of this one in its owner's queue, or None if it is not queued."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT created_at, owner FROM jobs WHERE id = ? AND status = ?", (job_id, QUEUED)).fetchone()
+            if row is None:
+                return None
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND owner = ? AND created_at < ?",
+                                (QUEUED, row[1], row[0])).fetchone()[0]
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a queued job, or asks a running job to stop at its next step.
+
+        Running jobs of another instance are flagged in the database and stopped by
+        their owner at its next heartbeat.
+        """
+        with self._lock:
+            with self._connect() as conn:
+                updated = conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                    (CANCELLED, time.time(), job_id, QUEUED)
+                ).rowcount
+                if not updated:
+                    flagged = conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                                           (job_id, RUNNING)).rowcount
+            if updated:
+                self._secrets.pop(job_id, None)
+            elif flagged:
+                self._cancel_requested.add(job_id)
+        if updated:
+            self._add_event(job_id, "status", CANCELLED)
+            return True
+        return bool(flagged)
+
+    def shutdown(self):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        self._stopped.set()
+
+    # --- Workers ---
+
+    def _add_event(self, job_id: str, kind: str, message: str):
+        with self._events_lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO job_events (job_id, seq, kind, message, created_at) "
+                "SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM job_events WHERE job_id = ?",
+                (job_id, kind, message, time.time(), job_id)
+            )
+
+    def _fail_orphaned_jobs(self, conn):
+        """Fails the unfinished jobs of instances that stopped heartbeating; their credentials are gone."""
+        live_after = time.time() - QUEUE_INSTANCE_TIMEOUT_SECONDS
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?) AND (owner IS NULL OR owner "
+            "NOT IN (SELECT id FROM queue_instances WHERE heartbeat_at >= ?))",
+            (FAILED, "The server restarted before this job finished. Please submit it again.", time.time(),
+             QUEUED, RUNNING, live_after)
+        )
+        conn.execute("DELETE FROM queue_instances WHERE heartbeat_at < ?", (live_after,))
+
+    def _heartbeat(self):
+        while not self._stopped.wait(QUEUE_HEARTBEAT_SECONDS):
+            try:
+                with self._connect() as conn:
+                    conn.execute("UPDATE queue_instances SET heartbeat_at = ? WHERE id = ?", (time.time(), self.instance_id))
+                    self._fail_orphaned_jobs(conn)
+                    # Cancellations of this instance's running jobs requested by other processes
+                    flagged = conn.execute("SELECT id FROM jobs WHERE owner = ? AND status = ? AND cancel_requested = 1",
+                                           (self.instance_id, RUNNING)).fetchall()
+            except sqlite3.Error as e:
+                print(f"   > [WARNING] Job queue heartbeat failed: {e}")
+                continue
+            if flagged:
+                with self._lock:
+                    self._cancel_requested.update(row[0] for row in flagged)
+
+    def _claim_next(self) -> Optional[tuple]:
+        """
+        Blocks until one of this instance's jobs is queued, marks it running and returns (id, state, use_result_cache).
+
+        The database is polled without holding `_lock`, which `live_output`, `cancel` and the
+        progress events need; the lock only guards `_secrets` and the wait.
+        """
+        while True:
+            with self._lock:
+                if self._stopping:
+                    return None
+                submissions = self._submissions
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT id, state, use_result_cache FROM jobs WHERE status = ? AND owner = ? "
+                    "ORDER BY created_at LIMIT 1", (QUEUED, self.instance_id)
+                ).fetchone()
+                # Only succeeds if the job was not cancelled or claimed in the meantime
+                claimed = row is not None and conn.execute(
+                    "UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?",
+                    (RUNNING, time.time(), row[0], QUEUED)
+                ).rowcount == 1
+            with self._wakeup:
+                if claimed:
+                    state = {**json.loads(row[1]), **self._secrets.pop(row[0], {})}
+                    return row[0], state, bool(row[2])
+                if row is not None:
+                    # Cancelled through another instance before it started
+                    self._secrets.pop(row[0], None)
+                elif submissions == self._submissions and not self._stopping:
+                    self._wakeup.wait(timeout=5)
+
+    def _work(self):
+        while True:
+            claimed = self._claim_next()
+            if claimed is None:
+                return
+            job_id, state, use_result_cache = claimed
+            self._add_event(job_id, "status", RUNNING)
+            try:
+                self._run(job_id, state, use_result_cache)
+            except JobCancelled:
+                self._finish(job_id, CANCELLED, error="Cancelled by the user.")
+            except Exception as e:
+                print(f"   > [ERROR] Job {job_id} crashed: {e}")
+                self._finish(job_id, FAILED, error=f"Error processing your request: {e}")
+            finally:
+                with self._lock:
+                    self._cancel_requested.discard(job_id)
+                    self._live_output.pop(job_id, None)
+
+    def _run(self, job_id: str, state: dict, use_result_cache: bool):
+        state["messages"] = [HumanMessage(content=state.get("user_request", ""))]
+        if state.get("columnar_data_path"):
+            # Converted while the agent validates and plans; the executor waits for it
+            start_ingest(state["file_path"], state["columnar_data_path"])
+        last_message = None
+        for stream_mode, chunk in cached_stream(self.agent_runnable, state, self.result_cache,
+                                                bypass=not use_result_cache, stream_mode=["updates", "custom"]):
+            if job_id in self._cancel_requested:
+                raise JobCancelled()
+            if stream_mode == "custom":
+                with self._lock:
+                    self._live_output[job_id] = (self._live_output[job_id] + chunk.get("token", ""))[-_MAX_LIVE_CHARS:]
+                continue
+            with self._lock:
+                self._live_output[job_id] = ""
+            for node_output in chunk.values():
+                if not isinstance(node_output, dict):
+                    continue
+                for message in node_output.get("messages") or []:
+                    if isinstance(message, AIMessage):
+                        last_message = message.content
+                step = node_output.get("current_step")
+                if step:
+                    with self._connect() as conn:
+                        conn.execute("UPDATE jobs SET current_step = ? WHERE id = ?", (step, job_id))
+                    self._add_event(job_id, "step", step)
+
+        figure, code = Path(state["output_figure_path"]), Path(state["output_code_path"])
+        if figure.exists() and code.exists():
+            self._finish(job_id, SUCCEEDED, result={
+                "figure_path": str(figure), "pdf_path": state["output_pdf_path"], "code_path": str(code)
+            })
+        else:
+            self._finish(job_id, FAILED, error=last_message or "An unknown error occurred.")
+
+    def _finish(self, job_id: str, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result else None, error, time.time(), job_id)
+            )
+        self._add_event(job_id, "status", status)
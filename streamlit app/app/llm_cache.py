@@ -0,0 +1,133 @@
+# app/llm_cache.py
+"""
+Opt-in memoization of text LLM responses.
+
+Responses are keyed on (base_url, model, prompt hash) and kept in a pluggable
+store. The default store is a SQLite file with TTL expiry and LRU eviction.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+LLM_CACHE_PATH = os.getenv("GGPLOTAGENT_LLM_CACHE_PATH", os.path.join("temp_data", "llm_cache.sqlite"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("GGPLOTAGENT_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("GGPLOTAGENT_LLM_CACHE_MAX_ENTRIES", "5000"))
+
+
+class LLMResponseStore:
+    """Interface for response stores. Subclass and pass to `LLMCache` to plug in another backend."""
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, response: str) -> None:
+        raise NotImplementedError
+
+
+class SQLiteLLMStore(LLMResponseStore):
+    """On-disk store with a time-to-live and least-recently-used eviction."""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # commits on success
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (key, response, now, now))
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+
+class LLMCache:
+    """Memoizes LLM responses in a store and counts hits and misses."""
+
+    def __init__(self, store: Optional[LLMResponseStore] = None):
+        self._store = store
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def store(self) -> LLMResponseStore:
+        # Created lazily so importing the module never touches the disk
+        with self._lock:
+            if self._store is None:
+                self._store = SQLiteLLMStore()
+            return self._store
+
+    @staticmethod
+    def make_key(base_url: str, model: str, prompt: str, **params) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        extra = "|".join(f"{k}={params[k]}" for k in sorted(params) if params[k] is not None)
+        return hashlib.sha256(f"{base_url}|{model}|{prompt_hash}|{extra}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        response = self.store.get(key)
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def set(self, key: str, response: str) -> None:
+        self.store.set(key, response)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+_llm_cache = LLMCache()
+
+
+def get_llm_cache() -> LLMCache:
+    """Returns the process-wide LLM response cache."""
+    return _llm_cache
+
+
+def set_llm_cache(cache: LLMCache) -> None:
+    """Replaces the process-wide LLM response cache, e.g. to use a different store."""
+    global _llm_cache
+    _llm_cache = cache
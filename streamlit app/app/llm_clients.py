@@ -0,0 +1,142 @@
+# app/llm_clients.py
+"""
+Process-wide registry of OpenAI-compatible clients.
+
+Clients are keyed by (base_url, api_key hash) and share a keep-alive HTTP
+connection pool, so every node and every Streamlit session talking to the same
+endpoint reuses warm TLS connections instead of opening new ones per call.
+
+Async clients (used by the async graph) are additionally kept per event loop,
+since their connections belong to the loop that opened them. The loop is held by a
+weak reference, so a client is never handed to a new loop that reuses the address
+of a closed one.
+"""
+
+import os
+import atexit
+import asyncio
+import hashlib
+import threading
+import weakref
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("GGPLOTAGENT_OPENAI_MAX_CONNECTIONS", "50"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GGPLOTAGENT_OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("GGPLOTAGENT_OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("GGPLOTAGENT_OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_READ_TIMEOUT = float(os.getenv("GGPLOTAGENT_OPENAI_READ_TIMEOUT", "600"))
+
+_clients: Dict[Tuple[str, str], OpenAI] = {}
+_clients_lock = threading.Lock()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]]" = \
+    weakref.WeakKeyDictionary()
+# Optional wrapper applied to every client handed out, e.g. to meter or replay calls
+_client_wrapper: Optional[Callable[[Any, str], Any]] = None
+
+
+def _client_key(base_url: str, api_key: Optional[str]) -> Tuple[str, str]:
+    # Only a hash of the key is kept as the registry key; without a key the client falls back to OPENAI_API_KEY
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest() if api_key is not None else ""
+    return base_url.rstrip("/"), key_hash
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+
+def get_openai_client(base_url: str, api_key: Optional[str]) -> OpenAI:
+    """Returns the shared client for an endpoint and key, creating it on first use."""
+    key = _client_key(base_url, api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                timeout=_http_timeout(),
+                http_client=httpx.Client(limits=_http_limits(), timeout=_http_timeout()),
+            )
+            _clients[key] = client
+    return _client_wrapper(client, base_url) if _client_wrapper else client
+
+
+def get_async_openai_client(base_url: str, api_key: Optional[str]) -> AsyncOpenAI:
+    """Returns the shared async client for an endpoint and key on the running event loop."""
+    loop = asyncio.get_running_loop()
+    key = _client_key(base_url, api_key)
+    with _clients_lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                timeout=_http_timeout(),
+                http_client=httpx.AsyncClient(limits=_http_limits(), timeout=_http_timeout()),
+            )
+            loop_clients[key] = client
+    return _client_wrapper(client, base_url) if _client_wrapper else client
+
+
+def set_client_wrapper(wrapper: Optional[Callable[[Any, str], Any]]) -> None:
+    """
+    Makes `get_openai_client` / `get_async_openai_client` return `wrapper(client, base_url)`
+    instead of the shared client; None removes the wrapper. Used by the benchmark to
+    count tokens and to record or replay model responses.
+    """
+    global _client_wrapper
+    _client_wrapper = wrapper
+
+
+async def aclose_openai_clients():
+    """Closes the async clients of the running event loop; call before the loop shuts down."""
+    with _clients_lock:
+        clients = list(_async_clients.pop(asyncio.get_running_loop(), {}).values())
+    for client in clients:
+        await client.close()
+
+
+def configure_client_pool(max_connections: Optional[int] = None, max_keepalive_connections: Optional[int] = None,
+                          connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None):
+    """
+    Changes pool sizes and timeouts for every client created afterwards.
+
+    The registry is swapped for an empty one rather than closed: other sessions may be
+    mid-request on the current clients, which keep working and are garbage-collected
+    once the last caller lets go of them.
+    """
+    global OPENAI_MAX_CONNECTIONS, OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT
+    global _clients, _async_clients
+    if max_connections is not None:
+        OPENAI_MAX_CONNECTIONS = max_connections
+    if max_keepalive_connections is not None:
+        OPENAI_MAX_KEEPALIVE_CONNECTIONS = max_keepalive_connections
+    if connect_timeout is not None:
+        OPENAI_CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        OPENAI_READ_TIMEOUT = read_timeout
+    with _clients_lock:
+        _clients = {}
+        _async_clients = weakref.WeakKeyDictionary()
+
+
+@atexit.register
+def close_openai_clients():
+    """Closes every shared sync client; only safe once no request is in flight, e.g. at exit."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        # Async clients can only be closed on their own loop; their connections are dropped with it
+        _async_clients.clear()
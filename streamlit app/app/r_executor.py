@@ -0,0 +1,543 @@
+# app/r_executor.py
+"""
+Execution backends for running generated R scripts inside the Docker sandbox.
+
+Two backends are available:
+- "pool":   a pool of long-lived R sessions (one container each) with tidyverse and
+            ggrepel already loaded. Every script is sourced into a fresh environment,
+            and a session is recycled after a number of jobs or when it crashes.
+- "docker": the original one-shot `docker run --rm ... R -e` per attempt.
+
+Every container is capped in CPU, memory and process count, and every script in
+wall-clock time. A script that breaches a limit is killed (its container, for the
+pool, is replaced) and reported with a distinct error prefix the debugger can act on.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import queue
+import atexit
+import threading
+import subprocess
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.stage_limits import ABORT_POLL_SECONDS, StageAborted, stage_slot, astage_slot
+
+# Built from r-runtime/Dockerfile; every package the coder prompt may use is baked in
+R_DOCKER_IMAGE = os.getenv("GGPLOTAGENT_R_IMAGE", "ggplotagent-r:4.4.2")
+CONTAINER_WORKDIR = "/work"
+
+# Packages generated scripts are allowed to load
+ALLOWED_R_PACKAGES = ("tidyverse", "ggrepel")
+# Packages the runtime needs in addition (arrow reads the columnar copy of the data)
+RUNTIME_R_PACKAGES = ALLOWED_R_PACKAGES + ("arrow",)
+
+# Pool settings, overridable from the environment
+R_POOL_SIZE = int(os.getenv("GGPLOTAGENT_R_POOL_SIZE", "2"))
+R_POOL_MAX_JOBS_PER_SESSION = int(os.getenv("GGPLOTAGENT_R_POOL_MAX_JOBS", "20"))
+R_POOL_STARTUP_TIMEOUT = float(os.getenv("GGPLOTAGENT_R_POOL_STARTUP_TIMEOUT", "180"))
+
+# Per-container resource limits and per-script wall-clock limit
+R_EXEC_TIMEOUT = float(os.getenv("GGPLOTAGENT_R_TIMEOUT", "120"))
+R_CPUS = os.getenv("GGPLOTAGENT_R_CPUS", "1")
+R_MEMORY = os.getenv("GGPLOTAGENT_R_MEMORY", "2g")
+R_PIDS_LIMIT = os.getenv("GGPLOTAGENT_R_PIDS_LIMIT", "256")
+
+# Prefixes of the errors reported when a limit is breached
+TIMEOUT_ERROR_PREFIX = "EXECUTION TIMEOUT:"
+OOM_ERROR_PREFIX = "OUT OF MEMORY:"
+ABORTED_ERROR_PREFIX = "EXECUTION ABORTED:"
+_SIGKILL_EXIT_CODE = 137
+
+DEFAULT_R_BACKEND = "pool"
+R_BACKENDS = ("pool", "docker")
+
+_READY_SENTINEL = "__GGPLOTAGENT_READY__"
+_DONE_SENTINEL = "__GGPLOTAGENT_DONE__"
+
+# R program run by every pooled session: load the packages once, then source each
+# job (one tab-separated line on stdin: job id, script path, log path) into a fresh
+# environment, capturing its output, messages and warnings into the job's log file.
+_R_SERVER_CODE = f"""
+suppressPackageStartupMessages({{ {'; '.join(f'library({p})' for p in ALLOWED_R_PACKAGES)} }})
+invisible(requireNamespace('arrow', quietly = TRUE))
+con <- file('stdin', open = 'r')
+cat('{_READY_SENTINEL}\\n'); flush(stdout())
+while (length(line <- readLines(con, n = 1)) > 0) {{
+  job <- strsplit(line, '\\t', fixed = TRUE)[[1]]
+  log_con <- file(job[3], open = 'wt')
+  sink(log_con); sink(log_con, type = 'message')
+  status <- tryCatch({{
+    withCallingHandlers(
+      source(job[2], local = new.env(parent = globalenv())),
+      warning = function(w) {{ message('Warning: ', conditionMessage(w)); invokeRestart('muffleWarning') }}
+    )
+    0L
+  }}, error = function(e) {{
+    call <- conditionCall(e)
+    if (is.null(call)) message('Error: ', conditionMessage(e))
+    else message('Error in ', deparse(call)[1], ' : ', conditionMessage(e))
+    1L
+  }})
+  sink(type = 'message'); sink()
+  close(log_con)
+  graphics.off()
+  setwd('{CONTAINER_WORKDIR}')
+  cat(sprintf('{_DONE_SENTINEL}\\t%s\\t%d\\n', job[1], status)); flush(stdout())
+}}
+"""
+
+
+@dataclass
+class RExecutionResult:
+    """Outcome of one R script execution."""
+    returncode: int
+    stdout: str
+    stderr: str
+    backend: str
+    timed_out: bool = False
+    oom_killed: bool = False
+    aborted: bool = False
+
+
+class RWorkerStartupError(RuntimeError):
+    """Raised when a pooled R session cannot be started."""
+
+
+class RuntimeImageError(RuntimeError):
+    """Raised when the configured R image is unavailable or lacks an allowed package."""
+
+
+def _sandbox_args(project_root: Path) -> list:
+    # No network: scripts must only rely on packages baked into the image.
+    # Swap is capped at the memory limit so a runaway script is killed instead of thrashing.
+    return ["--network=none", f"--cpus={R_CPUS}", f"--memory={R_MEMORY}", f"--memory-swap={R_MEMORY}",
+            f"--pids-limit={R_PIDS_LIMIT}", f"--volume={project_root}:{CONTAINER_WORKDIR}", f"--workdir={CONTAINER_WORKDIR}"]
+
+
+def _kill_container(name: str):
+    subprocess.run(["docker", "kill", name], capture_output=True, check=False)
+
+
+def _timeout_result(timeout: float, output: str, backend: str) -> RExecutionResult:
+    message = (f"{TIMEOUT_ERROR_PREFIX} the script did not finish within {timeout:.0f} seconds and was stopped. "
+               "It is too slow for the sandbox.")
+    return RExecutionResult(1, "", f"{message}\n{output}".strip(), backend, timed_out=True)
+
+
+def _oom_result(output: str, backend: str) -> RExecutionResult:
+    message = (f"{OOM_ERROR_PREFIX} the R process was killed after exceeding the sandbox memory limit "
+               f"({R_MEMORY}).")
+    return RExecutionResult(1, "", f"{message}\n{output}".strip(), backend, oom_killed=True)
+
+
+def _aborted_result(backend: str) -> RExecutionResult:
+    return RExecutionResult(1, "", f"{ABORTED_ERROR_PREFIX} the script was stopped because its result is no longer needed.",
+                            backend, aborted=True)
+
+
+def check_runtime_image(image: str = R_DOCKER_IMAGE, packages=RUNTIME_R_PACKAGES) -> None:
+    """
+    Verifies that the R image exists locally and provides every allowed and runtime package.
+
+    Raises:
+        RuntimeImageError: If docker or the image is unavailable, or packages are missing.
+    """
+    pkg_vector = ", ".join(f"'{p}'" for p in packages)
+    r_check = (f"pkgs <- c({pkg_vector}); "
+               "missing <- pkgs[!vapply(pkgs, requireNamespace, logical(1), quietly = TRUE)]; "
+               "cat('MISSING:', paste(missing, collapse = ','), '\\n')")
+    try:
+        result = subprocess.run(
+            ["docker", "run", "--rm", "--network=none", "--pull=never", image, "Rscript", "-e", r_check],
+            capture_output=True, encoding='utf-8', check=False, errors='replace', timeout=120
+        )
+    except FileNotFoundError:
+        raise RuntimeImageError("docker command not found. Ensure Docker is installed and in your system's PATH.")
+    except subprocess.TimeoutExpired:
+        raise RuntimeImageError(f"Timed out while checking the R image '{image}'.")
+    marker = [line for line in result.stdout.splitlines() if line.startswith("MISSING:")]
+    if result.returncode != 0 or not marker:
+        raise RuntimeImageError(
+            f"R image '{image}' is not available. Build it with `docker build -t {image} r-runtime/`.\n{result.stderr.strip()}")
+    missing: List[str] = [p for p in marker[0][len("MISSING:"):].strip().split(",") if p]
+    if missing:
+        raise RuntimeImageError(f"R image '{image}' is missing required packages: {', '.join(missing)}")
+
+
+def run_r_script_oneshot(script_path_relative: Path, project_root: Path, image: str = R_DOCKER_IMAGE,
+                         timeout: float = R_EXEC_TIMEOUT, abort: Optional[threading.Event] = None) -> RExecutionResult:
+    """
+    Runs a script in a brand-new container, paying container and R startup every time.
+
+    Args:
+        script_path_relative: Path of the script relative to `project_root`.
+        project_root: Host directory mounted as the container working directory.
+        image: The Docker image to run.
+        timeout: Wall-clock limit in seconds; the container is killed when it is exceeded.
+        abort: Once set, the container is killed and an aborted result returned.
+    """
+    r_command = f"source('{script_path_relative.as_posix()}')"
+    name = f"ggplotagent-r-{uuid.uuid4().hex[:12]}"
+    process = subprocess.Popen(
+        ["docker", "run", "--rm", f"--name={name}", *_sandbox_args(project_root), image, "R", "-e", r_command],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', errors='replace'
+    )
+    deadline = time.monotonic() + timeout
+    while True:
+        wait = max(deadline - time.monotonic(), 0)
+        if abort is not None:
+            wait = min(wait, ABORT_POLL_SECONDS)
+        try:
+            stdout, stderr = process.communicate(timeout=wait)
+            break
+        except subprocess.TimeoutExpired:
+            aborted = abort is not None and abort.is_set()
+            if not aborted and time.monotonic() < deadline:
+                continue
+        # Killing the docker client leaves the container running; kill the container itself
+        _kill_container(name)
+        process.kill()
+        _, output = process.communicate()
+        return _aborted_result("docker") if aborted else _timeout_result(timeout, output, "docker")
+    if process.returncode == _SIGKILL_EXIT_CODE:
+        return _oom_result(stderr, "docker")
+    return RExecutionResult(process.returncode, stdout, stderr, "docker")
+
+
+async def _akill_container(name: str, process: asyncio.subprocess.Process):
+    # Killing the docker client leaves the container running; kill the container itself
+    kill = await asyncio.create_subprocess_exec("docker", "kill", name, stdout=asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.DEVNULL)
+    await kill.wait()
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+
+
+async def arun_r_script_oneshot(script_path_relative: Path, project_root: Path, image: str = R_DOCKER_IMAGE,
+                                timeout: float = R_EXEC_TIMEOUT) -> RExecutionResult:
+    """Async counterpart of `run_r_script_oneshot`, awaiting an asyncio subprocess instead of blocking a thread."""
+    r_command = f"source('{script_path_relative.as_posix()}')"
+    name = f"ggplotagent-r-{uuid.uuid4().hex[:12]}"
+    process = await asyncio.create_subprocess_exec(
+        "docker", "run", "--rm", f"--name={name}", *_sandbox_args(project_root), image, "R", "-e", r_command,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        await _akill_container(name, process)
+        return _timeout_result(timeout, "", "docker")
+    except asyncio.CancelledError:
+        # e.g. a losing candidate of a race: don't leave its container running
+        await asyncio.shield(_akill_container(name, process))
+        raise
+    stdout, stderr = stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+    if process.returncode == _SIGKILL_EXIT_CODE:
+        return _oom_result(stderr, "docker")
+    return RExecutionResult(process.returncode, stdout, stderr, "docker")
+
+
+class RWorkerSession:
+    """A long-lived R process in its own container, fed jobs over stdin."""
+
+    def __init__(self, project_root: Path, image: str = R_DOCKER_IMAGE):
+        self.project_root = project_root
+        self.name = f"ggplotagent-r-{uuid.uuid4().hex[:12]}"
+        self.jobs_run = 0
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._recent_output = deque(maxlen=50)
+        self.process = subprocess.Popen(
+            ["docker", "run", "--rm", "-i", f"--name={self.name}", *_sandbox_args(project_root),
+             image, "Rscript", "-e", _R_SERVER_CODE],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            encoding='utf-8', errors='replace', bufsize=1
+        )
+        threading.Thread(target=self._read_output, daemon=True).start()
+        if not self._wait_for(_READY_SENTINEL, R_POOL_STARTUP_TIMEOUT):
+            self.close()
+            raise RWorkerStartupError(f"R session failed to start:\n{self.recent_output()}")
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            self._lines.put(line.rstrip("\n"))
+        self._lines.put(None)  # EOF: the session died
+
+    def _wait_for(self, prefix: str, timeout: Optional[float], abort: Optional[threading.Event] = None) -> Optional[str]:
+        """
+        Returns the first line starting with `prefix`, or None on EOF, once `timeout` seconds
+        have passed or once `abort` is set.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if abort is not None:
+                if abort.is_set():
+                    return None
+                remaining = ABORT_POLL_SECONDS if remaining is None else min(remaining, ABORT_POLL_SECONDS)
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                if abort is not None and (deadline is None or time.monotonic() < deadline):
+                    continue
+                return None
+            if line is None:
+                return None
+            if line.startswith(prefix):
+                return line
+            self._recent_output.append(line)
+
+    def recent_output(self) -> str:
+        return "\n".join(self._recent_output)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, script_path_relative: Path, timeout: float = R_EXEC_TIMEOUT,
+            abort: Optional[threading.Event] = None) -> RExecutionResult:
+        job_id = uuid.uuid4().hex
+        log_path_relative = script_path_relative.with_suffix(".log")
+        self.jobs_run += 1
+        try:
+            self.process.stdin.write(f"{job_id}\t{script_path_relative.as_posix()}\t{log_path_relative.as_posix()}\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return RExecutionResult(1, "", f"R worker session crashed:\n{self.recent_output()}", "pool")
+
+        done = self._wait_for(f"{_DONE_SENTINEL}\t{job_id}", timeout, abort)
+        aborted = done is None and self.alive and abort is not None and abort.is_set()
+        timed_out = done is None and self.alive and not aborted
+        if timed_out or aborted:
+            # The session is stuck in (or no longer wanted for) the script: kill it, the pool replaces dead sessions
+            self.kill()
+        log_path_host = self.project_root / log_path_relative
+        log = ""
+        if log_path_host.exists():
+            log = log_path_host.read_text(encoding='utf-8', errors='replace')
+            log_path_host.unlink()
+        if aborted:
+            return _aborted_result("pool")
+        if timed_out:
+            return _timeout_result(timeout, log, "pool")
+        if done is None:
+            try:
+                exit_code = self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                exit_code = None
+            if exit_code == _SIGKILL_EXIT_CODE:
+                return _oom_result(log, "pool")
+            return RExecutionResult(1, "", f"R worker session crashed:\n{log or self.recent_output()}", "pool")
+        status = int(done.rsplit("\t", 1)[-1])
+        return RExecutionResult(status, log if status == 0 else "", log if status != 0 else "", "pool")
+
+    def kill(self):
+        _kill_container(self.name)
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def close(self):
+        if self.alive:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except Exception:
+                subprocess.run(["docker", "kill", self.name], capture_output=True, check=False)
+                self.process.kill()
+
+
+class RWorkerPool:
+    """A bounded pool of warm R sessions sharing one mounted project root."""
+
+    def __init__(self, project_root: Path, size: int = R_POOL_SIZE,
+                 max_jobs_per_session: int = R_POOL_MAX_JOBS_PER_SESSION, image: str = R_DOCKER_IMAGE):
+        self.project_root = project_root
+        self.size = max(1, size)
+        self.max_jobs_per_session = max(1, max_jobs_per_session)
+        self.image = image
+        self._idle: "queue.Queue[RWorkerSession]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._total = 0
+
+    def _acquire(self) -> RWorkerSession:
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                session = None
+            if session is not None:
+                if session.alive:
+                    return session
+                self._release(session)
+                continue
+            with self._lock:
+                can_start = self._total < self.size
+                if can_start:
+                    self._total += 1
+            if can_start:
+                break
+            # The pool is full: wait for a session to be released or recycled
+            try:
+                session = self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+            if session.alive:
+                return session
+            self._release(session)
+        try:
+            return RWorkerSession(self.project_root, self.image)
+        except Exception:
+            with self._lock:
+                self._total -= 1
+            raise
+
+    def _release(self, session: RWorkerSession):
+        if session.alive and session.jobs_run < self.max_jobs_per_session:
+            self._idle.put(session)
+            return
+        # Recycle: the session crashed or has served its quota of jobs
+        session.close()
+        with self._lock:
+            self._total -= 1
+
+    def warm(self, count: int = 1):
+        """Starts up to `count` idle sessions in the background so the next job finds one ready."""
+        def start():
+            try:
+                self._release(self._acquire())
+            except Exception as e:
+                print(f"   > [WARNING] Could not warm R worker session: {e}")
+        for _ in range(min(count, self.size)):
+            threading.Thread(target=start, daemon=True).start()
+
+    def run(self, script_path_relative: Path, timeout: float = R_EXEC_TIMEOUT,
+            abort: Optional[threading.Event] = None) -> RExecutionResult:
+        session = self._acquire()
+        try:
+            if abort is not None and abort.is_set():
+                return _aborted_result("pool")
+            return session.run(script_path_relative, timeout, abort)
+        finally:
+            self._release(session)
+
+    def shutdown(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._total = 0
+
+
+_pools: Dict[Path, RWorkerPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_worker_pool(project_root: Path) -> RWorkerPool:
+    """Returns the process-wide worker pool for a project root, creating it on first use."""
+    with _pools_lock:
+        if project_root not in _pools:
+            _pools[project_root] = RWorkerPool(project_root)
+        return _pools[project_root]
+
+
+@atexit.register
+def shutdown_worker_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
+
+
+def run_r_script(script_path_relative: Path, project_root: Path, backend: str = DEFAULT_R_BACKEND,
+                 timeout: float = R_EXEC_TIMEOUT, abort: Optional[threading.Event] = None) -> RExecutionResult:
+    """
+    Executes an R script with the selected backend, stopping it after `timeout` seconds.
+
+    Falls back to the one-shot docker backend if a pooled session cannot be started.
+    At most `STAGE_LIMITS["r"]` scripts run at once across the process. Setting `abort`
+    (e.g. once another candidate of a race has won) stops the script, or gives up its
+    wait for a slot, and returns a result with `aborted` set.
+    """
+    try:
+        with stage_slot("r", abort=abort):
+            execute = partial(_run_with_backend, script_path_relative, project_root, backend, timeout, abort)
+            return _execution_hook.run(execute, script_path_relative, project_root)
+    except StageAborted:
+        return _aborted_result(backend)
+
+
+def _run_with_backend(script_path_relative: Path, project_root: Path, backend: str, timeout: float,
+                      abort: Optional[threading.Event] = None) -> RExecutionResult:
+    if abort is not None and abort.is_set():
+        return _aborted_result(backend)
+    if backend == "pool":
+        try:
+            return get_worker_pool(project_root).run(script_path_relative, timeout, abort)
+        except RWorkerStartupError as e:
+            print(f"   > [WARNING] R worker pool unavailable, falling back to one-shot docker: {e}")
+    return run_r_script_oneshot(script_path_relative, project_root, timeout=timeout, abort=abort)
+
+
+async def arun_r_script(script_path_relative: Path, project_root: Path, backend: str = DEFAULT_R_BACKEND,
+                        timeout: float = R_EXEC_TIMEOUT) -> RExecutionResult:
+    """
+    Async counterpart of `run_r_script`, sharing its process-wide `STAGE_LIMITS["r"]` slots.
+
+    The one-shot backend awaits an asyncio subprocess. Pooled sessions are driven by
+    blocking pipe reads, so a pooled job runs in a worker thread; since it only does so
+    while holding an "r" slot, at most `STAGE_LIMITS["r"]` threads are ever used.
+    Cancelling a pooled job kills its session, and the slot is released once the thread returns.
+    """
+    async with astage_slot("r"):
+        execute = partial(_arun_with_backend, script_path_relative, project_root, backend, timeout)
+        return await _execution_hook.arun(execute, script_path_relative, project_root)
+
+
+async def _arun_with_backend(script_path_relative: Path, project_root: Path, backend: str, timeout: float) -> RExecutionResult:
+    if backend == "pool":
+        abort = threading.Event()
+        job = asyncio.ensure_future(asyncio.to_thread(get_worker_pool(project_root).run, script_path_relative, timeout, abort))
+        try:
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            abort.set()
+            await asyncio.wait({job})
+            raise
+        except RWorkerStartupError as e:
+            print(f"   > [WARNING] R worker pool unavailable, falling back to one-shot docker: {e}")
+    return await arun_r_script_oneshot(script_path_relative, project_root, timeout=timeout)
+
+
+class RExecutionHook:
+    """
+    Wraps every R execution, inside its "r" slot. The default simply runs the script;
+    subclasses may time, record or replace executions (see benchmark.py).
+    """
+
+    def run(self, execute: Callable[[], RExecutionResult], script_path_relative: Path,
+            project_root: Path) -> RExecutionResult:
+        return execute()
+
+    async def arun(self, execute: Callable[[], Awaitable[RExecutionResult]], script_path_relative: Path,
+                   project_root: Path) -> RExecutionResult:
+        return await execute()
+
+
+_execution_hook = RExecutionHook()
+
+
+def set_r_execution_hook(hook: Optional[RExecutionHook]) -> None:
+    """Replaces the process-wide execution hook; None restores the default."""
+    global _execution_hook
+    _execution_hook = hook or RExecutionHook()
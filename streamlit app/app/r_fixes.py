@@ -0,0 +1,150 @@
+# app/r_fixes.py
+"""
+Deterministic repairs for common, mechanical R failures.
+
+Each rule receives the failing script, the error text and a context dict (currently
+`available_columns`) and returns a fixed script, or None when it does not apply.
+Rules are tried in registration order before the LLM debugger is called.
+"""
+
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.r_static import r_make_names
+
+FixRule = Callable[[str, str, dict], Optional[str]]
+
+_FIX_RULES: List[Tuple[str, FixRule]] = []
+
+_STRING_LITERAL = re.compile(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'")
+
+
+def register_fix_rule(name: str):
+    """Decorator adding a rule to the registry under `name`."""
+    def decorator(rule: FixRule) -> FixRule:
+        _FIX_RULES.append((name, rule))
+        return rule
+    return decorator
+
+
+def list_fix_rules() -> List[str]:
+    return [name for name, _ in _FIX_RULES]
+
+
+def _first_error_line(error: str) -> str:
+    for line in error.splitlines():
+        if "error" in line.lower() or "not found" in line.lower():
+            return line.strip()
+    return error.strip().splitlines()[0] if error.strip() else ""
+
+
+def apply_fix_rules(script: str, error: str, context: dict, already_applied=()) -> Optional[Tuple[str, str]]:
+    """
+    Tries every registered rule in order.
+
+    A rule is not applied twice to the same error, so a fix that does not help falls
+    through to the LLM debugger instead of looping.
+
+    Returns:
+        (signature, fixed script) for the first rule that changed the script, or None.
+    """
+    error_line = _first_error_line(error)
+    for name, rule in _FIX_RULES:
+        signature = f"{name}: {error_line}"
+        if signature in already_applied:
+            continue
+        try:
+            fixed = rule(script, error, context)
+        except Exception as e:
+            print(f"   > [WARNING] Fix rule '{name}' raised an exception: {e}")
+            continue
+        if fixed and fixed != script:
+            return signature, fixed
+    return None
+
+
+def _replace_outside_strings(script: str, pattern: str, replacement: str) -> str:
+    """Applies a regex substitution to code only, leaving string literals and comments untouched."""
+    result, last = [], 0
+    for match in _STRING_LITERAL.finditer(script):
+        result.append(_replace_in_code(script[last:match.start()], pattern, replacement))
+        result.append(match.group(0))
+        last = match.end()
+    result.append(_replace_in_code(script[last:], pattern, replacement))
+    return "".join(result)
+
+
+def _replace_in_code(code: str, pattern: str, replacement: str) -> str:
+    lines = []
+    for line in code.split("\n"):
+        body, hash_sign, comment = line.partition("#")
+        lines.append(re.sub(pattern, replacement, body) + hash_sign + comment)
+    return "\n".join(lines)
+
+
+def _normalize_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+@register_fix_rule("mangled_column_name")
+def fix_mangled_column_name(script: str, error: str, context: dict) -> Optional[str]:
+    """`object 'X' not found` where read.csv renamed the column (e.g. to `X.1` or `X.value`)."""
+    match = re.search(r"object '([^']+)' not found", error)
+    columns = context.get("available_columns") or []
+    if not match or not columns:
+        return None
+    missing = match.group(1)
+    read_names = r_make_names(columns)
+    if missing in read_names:
+        return None
+    candidates = [c for c in read_names if c == f"{missing}.1"]
+    if not candidates:
+        candidates = [c for c in read_names if _normalize_name(c) == _normalize_name(missing)]
+    if len(candidates) != 1:
+        return None
+    fixed = script.replace(f"`{missing}`", candidates[0])
+    return _replace_outside_strings(fixed, rf"(?<![\w.$]){re.escape(missing)}(?![\w.])", candidates[0])
+
+
+@register_fix_rule("placeholder_quoting")
+def fix_placeholder_quoting(script: str, error: str, context: dict) -> Optional[str]:
+    """Unquoted, single-quoted or double-wrapped `__INPUT_FILE__`/`__INPUT_DATA__`/`__OUTPUT_*_FILE__` placeholders."""
+    if "__" not in error and "cannot open" not in error and "IOError" not in error:
+        return None
+    return re.sub(r"[\"']*(__(?:INPUT_FILE|INPUT_DATA|OUTPUT_PNG_FILE|OUTPUT_PDF_FILE)__)[\"']*", r'"\1"', script)
+
+
+@register_fix_rule("ggrepel_namespace")
+def fix_ggrepel_namespace(script: str, error: str, context: dict) -> Optional[str]:
+    """`could not find function "geom_text_repel"`: call it through the ggrepel namespace."""
+    if not re.search(r'could not find function "geom_(?:text|label)_repel"', error):
+        return None
+    return _replace_outside_strings(script, r"(?<![\w.:])(geom_(?:text|label)_repel)\s*\(", r"ggrepel::\1(")
+
+
+# Frequent invented colour names and the closest valid R colour
+_COLOUR_SUBSTITUTES: Dict[str, str] = {
+    "lightred": "salmon",
+    "darkyellow": "gold3",
+    "lightpurple": "plum",
+    "darkpurple": "purple4",
+    "darkpink": "deeppink3",
+    "lightorange": "sandybrown",
+    "lightbrown": "burlywood",
+    "darkbrown": "saddlebrown",
+    "lightblack": "grey30",
+    "darkwhite": "grey90",
+}
+
+
+@register_fix_rule("invalid_colour_name")
+def fix_invalid_colour_name(script: str, error: str, context: dict) -> Optional[str]:
+    """`Unknown colour name: X` / `invalid color name 'X'`: use the normalized or closest valid colour."""
+    match = re.search(r"Unknown colou?r name: ([^\n]+?)\s*$", error, re.MULTILINE) or \
+        re.search(r"invalid colou?r name '([^']+)'", error)
+    if not match:
+        return None
+    bad = match.group(1).strip().strip("'\"")
+    normalized = re.sub(r"[\s_-]", "", bad.lower()).replace("gray", "grey")
+    replacement = _COLOUR_SUBSTITUTES.get(normalized, normalized if normalized != bad else "grey50")
+    return re.sub(rf"([\"']){re.escape(bad)}\1", rf'"{replacement}"', script)
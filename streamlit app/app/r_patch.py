@@ -0,0 +1,162 @@
+# app/r_patch.py
+"""
+Structured edits returned by the debugger in patch mode.
+
+Two formats are accepted:
+
+- Line-range edits against the numbered script shown to the model::
+
+    @@ REPLACE 12-14
+    <new lines>
+    @@ INSERT AFTER 5
+    <new lines>
+    @@ DELETE 20-21
+    @@ END
+
+- A unified diff (``--- a`` / ``+++ b`` / ``@@ -l,n +l,n @@`` hunks), whose context
+  and removed lines must match the script.
+
+Line-number prefixes (``12| ``) that the model copies from the numbered script are
+removed from edit lines. Edits are validated before anything is applied; any problem
+raises `PatchError` so the caller can fall back to a full rewrite.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+_EDIT_HEADER = re.compile(r"^@@\s*(REPLACE|DELETE)\s+(\d+)(?:\s*-\s*(\d+))?\s*$|^@@\s*INSERT\s+AFTER\s+(\d+)\s*$", re.IGNORECASE)
+_EDIT_END = re.compile(r"^@@\s*END\s*$", re.IGNORECASE)
+_HUNK_HEADER = re.compile(r"^@@\s*-(\d+)(?:,(\d+))?\s+\+(\d+)(?:,(\d+))?\s*@@")
+# The "12| " prefix of `number_lines`, echoed back with a line
+_LINE_NUMBER_PREFIX = re.compile(r"^\s*\d+\|\s?")
+# How far a unified diff hunk may have drifted from its stated line number
+_MAX_HUNK_OFFSET = 10
+
+
+class PatchError(ValueError):
+    """The debugger's edit could not be parsed or does not apply to the script."""
+
+
+@dataclass
+class LineEdit:
+    """Replaces lines `start`..`end` (1-based, inclusive); `end == start - 1` inserts before `start`."""
+    start: int
+    end: int
+    lines: List[str] = field(default_factory=list)
+
+
+def number_lines(script: str) -> str:
+    """Prefixes each line with its 1-based number, as shown to the model."""
+    lines = script.split("\n")
+    width = len(str(len(lines)))
+    return "\n".join(f"{i:>{width}}| {line}" for i, line in enumerate(lines, start=1))
+
+
+def _strip_line_number(line: str) -> str:
+    return _LINE_NUMBER_PREFIX.sub("", line, count=1)
+
+
+def _strip_fences(text: str) -> str:
+    return "\n".join(line for line in text.strip().split("\n") if not line.strip().startswith("```"))
+
+
+def parse_line_edits(text: str) -> List[LineEdit]:
+    edits, current = [], None
+    for line in _strip_fences(text).split("\n"):
+        header = _EDIT_HEADER.match(line.strip())
+        if header or _EDIT_END.match(line.strip()):
+            if current:
+                edits.append(current)
+            current = None
+            if header:
+                if header.group(4):
+                    after = int(header.group(4))
+                    current = LineEdit(start=after + 1, end=after)
+                else:
+                    start = int(header.group(2))
+                    end = int(header.group(3) or start)
+                    if end < start:
+                        raise PatchError(f"Invalid line range {start}-{end}.")
+                    current = LineEdit(start=start, end=end)
+                    if header.group(1).upper() == "DELETE":
+                        edits.append(current)
+                        current = None
+        elif current is not None:
+            current.lines.append(_strip_line_number(line))
+    if current:
+        edits.append(current)
+    return edits
+
+
+def apply_line_edits(script: str, edits: List[LineEdit]) -> str:
+    lines = script.split("\n")
+    ordered = sorted(edits, key=lambda e: (e.start, e.end))
+    for edit in ordered:
+        if edit.start < 1 or edit.end > len(lines) or edit.start > len(lines) + 1:
+            raise PatchError(f"Lines {edit.start}-{edit.end} are outside the script (1-{len(lines)}).")
+    for previous, edit in zip(ordered, ordered[1:]):
+        if edit.start <= previous.end:
+            raise PatchError(f"Overlapping edits at lines {previous.start}-{previous.end} and {edit.start}-{edit.end}.")
+    # Bottom-up, so earlier line numbers stay valid
+    for edit in reversed(ordered):
+        lines[edit.start - 1:edit.end] = edit.lines
+    return "\n".join(lines)
+
+
+def apply_unified_diff(script: str, diff: str) -> str:
+    lines = script.split("\n")
+    hunks, current = [], None
+    for line in _strip_fences(diff).split("\n"):
+        if line.startswith("---") or line.startswith("+++") or line.startswith("\\"):
+            continue
+        header = _HUNK_HEADER.match(line)
+        if header:
+            current = {"start": int(header.group(1)), "old": [], "new": []}
+            hunks.append(current)
+        elif current is not None:
+            marker, text = (line[:1], line[1:]) if line[:1] in " +-" else (" ", line)
+            text = _strip_line_number(text)
+            if marker in " -":
+                current["old"].append(text)
+            if marker in " +":
+                current["new"].append(text)
+    if not hunks:
+        raise PatchError("No diff hunks found.")
+
+    # Locate every hunk first (nearest match to the stated line), then apply bottom-up
+    located = []
+    for hunk in hunks:
+        expected = max(hunk["start"] - 1, 0)
+        size = len(hunk["old"])
+        for offset in sorted(range(-_MAX_HUNK_OFFSET, _MAX_HUNK_OFFSET + 1), key=abs):
+            position = expected + offset
+            if 0 <= position <= len(lines) - size and \
+                    [l.rstrip() for l in lines[position:position + size]] == [l.rstrip() for l in hunk["old"]]:
+                located.append((position, size, hunk["new"]))
+                break
+        else:
+            raise PatchError(f"Hunk at line {hunk['start']} does not match the script.")
+    located.sort(key=lambda h: h[0])
+    for (pos_a, size_a, _), (pos_b, _, _) in zip(located, located[1:]):
+        if pos_b < pos_a + size_a:
+            raise PatchError("Overlapping diff hunks.")
+    for position, size, new in reversed(located):
+        lines[position:position + size] = new
+    return "\n".join(lines)
+
+
+def apply_patch(script: str, response: str) -> str:
+    """
+    Applies the debugger's edits to `script`.
+
+    Raises:
+        PatchError: if the response contains no recognizable edit or an edit does not apply.
+    """
+    text = _strip_fences(response)
+    if any(_HUNK_HEADER.match(line) for line in text.split("\n")):
+        return apply_unified_diff(script, text)
+    edits = parse_line_edits(text)
+    if not edits:
+        raise PatchError("No edits found in the response.")
+    return apply_line_edits(script, edits)
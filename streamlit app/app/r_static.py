@@ -0,0 +1,239 @@
+# app/r_static.py
+"""
+Local, static analysis of generated R code (no R installation required).
+"""
+
+import re
+from typing import Callable, List, Optional
+
+_LIBRARY_CALL = re.compile(r"^\s*(?:library|require)\s*\(\s*['\"]?([A-Za-z][A-Za-z0-9._]*)")
+_CLOSING = {")": "(", "]": "[", "}": "{"}
+# First line of a script in a completion without a fence: a package load or an assignment
+_CODE_START = re.compile(r"^\s*(?:(?:library|require|suppressPackageStartupMessages|options|set\.seed)\s*\(|[A-Za-z.][\w.]*\s*<-)")
+
+
+class IncrementalRParser:
+    """
+    Tracks bracket, string and comment state of R code as it streams in, one chunk at a time.
+
+    Only complete lines are scanned. Markdown fence lines are skipped. With `completion`,
+    the text is a raw model answer: a <thinking> block and any prose before the script
+    are skipped (scanning starts after the opening fence, or without a fence at the
+    first line that looks like code) and scanning stops at the closing fence, so an
+    apostrophe in "Here's the script" is not taken for an R string.
+    `on_library` is called once, as soon as the first `library()` line arrives.
+    """
+
+    def __init__(self, on_library: Optional[Callable[[str], None]] = None, completion: bool = False):
+        self.on_library = on_library
+        self._completion = completion
+        # "prose" before the script, "thinking" inside a <thinking> block, "code", or "done" after the script
+        self._region = "prose" if completion else "code"
+        self.libraries: List[str] = []
+        self.error: Optional[str] = None
+        self.line_number = 0
+        self._pending = ""
+        self._stack: List[tuple] = []  # (bracket, line number)
+        self._string_quote: Optional[str] = None
+        self._escaped = False
+
+    def feed(self, text: str) -> Optional[str]:
+        """Adds streamed text and returns an unrecoverable syntax error, if one was found."""
+        if self.error:
+            return self.error
+        self._pending += text
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            self._scan_line(line)
+            if self.error:
+                break
+        return self.error
+
+    def _enter_code(self, line: str) -> bool:
+        """Advances through the text before the script; True if `line` is the script's first line."""
+        if self._region == "thinking":
+            if "</thinking>" in line:
+                self._region = "prose"
+            return False
+        if self._region == "prose":
+            if "<thinking>" in line and "</thinking>" not in line:
+                self._region = "thinking"
+                return False
+            if line.strip().startswith("```"):
+                self._region = "code"
+                return False
+            if _CODE_START.match(line):
+                self._region = "code"
+                return True
+        return False
+
+    def close(self) -> Optional[str]:
+        """Scans any trailing partial line and reports brackets or strings left open."""
+        if self._pending and not self.error:
+            self._scan_line(self._pending)
+            self._pending = ""
+        if self.error:
+            return self.error
+        if self._string_quote:
+            return f"Unterminated string starting with {self._string_quote}"
+        if self._stack:
+            bracket, line_number = self._stack[-1]
+            return f"Unclosed '{bracket}' opened on line {line_number}"
+        return None
+
+    def _scan_line(self, line: str):
+        self.line_number += 1
+        if self._region != "code" and not self._enter_code(line):
+            return
+        if self._string_quote is None and line.strip().startswith("```"):
+            if self._completion:
+                self._region = "done"
+            return
+        if self._string_quote is None and not self._stack:
+            match = _LIBRARY_CALL.match(line)
+            if match:
+                self.libraries.append(match.group(1))
+                if len(self.libraries) == 1 and self.on_library:
+                    self.on_library(match.group(1))
+        for char in line:
+            if self._string_quote:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == self._string_quote:
+                    self._string_quote = None
+                continue
+            if char == "#":
+                break
+            if char in "'\"`":
+                self._string_quote = char
+            elif char in "([{":
+                self._stack.append((char, self.line_number))
+            elif char in _CLOSING:
+                if not self._stack:
+                    self.error = f"Unexpected '{char}' on line {self.line_number}"
+                    return
+                bracket, opened_on = self._stack.pop()
+                if bracket != _CLOSING[char]:
+                    self.error = (f"Unexpected '{char}' on line {self.line_number}: "
+                                  f"'{bracket}' opened on line {opened_on} is still open")
+                    return
+
+
+def r_syntax_error(code: str) -> Optional[str]:
+    """The first syntax error the incremental parser finds in a complete script, or None."""
+    parser = IncrementalRParser()
+    parser.feed(code)
+    return parser.close()
+
+
+def r_make_names(names: List[str]) -> List[str]:
+    """Mimics R's `make.names(names, unique = TRUE)`, i.e. the column names `read.csv` produces."""
+    result, seen = [], {}
+    for name in names:
+        clean = re.sub(r"[^A-Za-z0-9._]", ".", str(name))
+        if not clean or re.match(r"^(\d|_|\.\d)", clean):
+            clean = "X" + clean
+        if clean in seen:
+            seen[clean] += 1
+            clean = f"{clean}.{seen[clean]}"
+        else:
+            seen[clean] = 0
+        result.append(clean)
+    return result
+
+
+_AES_BLOCK = re.compile(r"\baes\s*\(")
+_AES_MAPPING = re.compile(r"\b(?:x|y|xend|yend|xmin|xmax|ymin|ymax|colou?r|fill|size|shape|label|group|alpha|linetype)\s*=\s*([A-Za-z.][\w.]*)\s*(?=[,)]|$)")
+_R_RESERVED = {"TRUE", "FALSE", "NULL", "NA", "Inf", "NaN", "T", "F"}
+
+
+def _strip_comments_and_strings(script: str) -> str:
+    return re.sub(r"#[^\n]*", "", re.sub(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'", '""', script))
+
+
+def _balanced_call_args(code: str, open_index: int) -> str:
+    depth = 0
+    for i in range(open_index, len(code)):
+        if code[i] == "(":
+            depth += 1
+        elif code[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return code[open_index + 1:i]
+    return code[open_index + 1:]
+
+
+# `data <- read.csv(` or `data <- as.data.frame(arrow::read_feather(`, the ways scripts load the input
+_DATA_READ_ASSIGNMENT = re.compile(
+    r"([A-Za-z.][\w.]*)\s*(?:<-|=)\s*(?:[A-Za-z.][\w.:]*\s*\(\s*)*?(?:utils::)?(?:read\.csv|(?:arrow::)?read_feather)\s*\(")
+
+
+def find_unknown_columns(script: str, available_columns: List[str]) -> List[str]:
+    """
+    Finds bare column references that match no data column and are never created by the script.
+
+    Checks `<data>$col` on the data frame read from the input file (with `read.csv` or,
+    possibly wrapped in e.g. `as.data.frame()`, `read_feather`) and bare identifiers
+    mapped in `aes()`. Names created anywhere in the script (`name =`, `name <-`, or as a
+    string such as `names_to = "name"`) are not reported.
+    """
+    known = set(available_columns) | set(r_make_names(available_columns))
+    code = _strip_comments_and_strings(script)
+    strings = set(re.findall(r"[\"']([^\"'\n]*)[\"']", script))
+
+    candidates = []
+    data_vars = _DATA_READ_ASSIGNMENT.findall(code)
+    for var in data_vars:
+        candidates += re.findall(rf"(?<![\w.]){re.escape(var)}\s*\$\s*([A-Za-z.][\w.]*)", code)
+    for match in _AES_BLOCK.finditer(code):
+        candidates += _AES_MAPPING.findall(_balanced_call_args(code, match.end() - 1))
+
+    unknown = []
+    for name in candidates:
+        if name in known or name in _R_RESERVED or name.startswith("..") or name in strings or name in unknown:
+            continue
+        created = re.search(
+            rf"(?<![\w.]){re.escape(name)}\s*(?:=(?!=)|<-)|->\s*{re.escape(name)}(?![\w.])|(?<![\w.]){re.escape(name)}\s*\(",
+            code)
+        if not created:
+            unknown.append(name)
+    return unknown
+
+
+def preflight_check(script: str, available_columns: List[str], allowed_packages) -> List[tuple]:
+    """
+    Runs cheap static checks on a generated script before it is sent to the sandbox.
+
+    Returns:
+        A list of (check name, message) tuples, empty when every check passes.
+    """
+    issues = []
+    parser = IncrementalRParser()
+    parser.feed(script)
+    syntax_error = parser.close()
+    if syntax_error:
+        issues.append(("syntax", f"R syntax error: {syntax_error}"))
+
+    disallowed = [lib for lib in parser.libraries if lib not in allowed_packages]
+    if disallowed:
+        issues.append(("library", f"Packages not available in the sandbox: {', '.join(disallowed)}. "
+                                  f"Only {', '.join(allowed_packages)} may be loaded."))
+
+    code = _strip_comments_and_strings(script)
+    if not re.search(r"(?<![\w.])final_plot\s*(?:<-|=(?!=))", code):
+        issues.append(("final_plot", "The script never assigns the ggplot object to `final_plot`."))
+
+    for placeholder, description in (("__OUTPUT_PNG_FILE__", "PNG"), ("__OUTPUT_PDF_FILE__", "PDF")):
+        if not re.search(rf"ggsave\s*\(\s*(?:filename\s*=\s*)?[\"']{placeholder}[\"']", script):
+            issues.append(("ggsave", f"Missing `ggsave(\"{placeholder}\", plot = final_plot, ...)` for the {description} output."))
+
+    if not re.search(r"[\"']__INPUT_(?:FILE|DATA)__[\"']", script):
+        issues.append(("input_file", "The script does not read the data from \"__INPUT_FILE__\" or \"__INPUT_DATA__\"."))
+
+    unknown_columns = find_unknown_columns(script, available_columns) if available_columns else []
+    if unknown_columns:
+        issues.append(("columns", f"Columns not found in the data: {', '.join(unknown_columns)}. "
+                                  f"Available columns (as loaded in R, by read.csv or read_feather): {', '.join(r_make_names(available_columns))}."))
+    return issues
@@ -0,0 +1,181 @@
+# app/result_cache.py
+"""
+Content-addressed cache of finished agent runs.
+
+An entry is keyed by the bytes of the uploaded data (and reference image), the
+normalized request and every other run setting, and stores the final PNG, PDF and R
+script. On an exact hit the whole graph is skipped: no LLM and no docker calls.
+"""
+
+import json
+import time
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from typing import Iterator, Optional
+
+# Bump when the pipeline changes in a way that invalidates stored results
+CACHE_VERSION = "2"
+
+DEFAULT_MAX_ENTRIES = 200
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+DEFAULT_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+_ARTIFACTS = {
+    "output_figure_path": "output_figure.png",
+    "output_pdf_path": "output_figure.pdf",
+    "output_code_path": "output_script.R",
+}
+# State keys left out of the settings part of the key: credentials, the request (keyed
+# normalized), values derived from the data, and progress reporting. Paths are left out
+# too, the files behind the input paths are hashed instead.
+_UNKEYED_STATE = ("api_key", "vision_api_key", "user_request", "data_profile", "stream_tokens")
+
+
+def hash_file(path: Optional[str]) -> str:
+    """Returns the SHA-256 of a file's bytes, reading it in chunks."""
+    if not path:
+        return ""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def key_settings(state: dict) -> dict:
+    """Every scalar setting of an initial state that can change what the agent produces."""
+    return {
+        name: value for name, value in state.items()
+        if name not in _UNKEYED_STATE and not name.endswith("_path")
+        and isinstance(value, (str, int, float, bool, type(None)))
+    }
+
+
+def normalize_request(request: str) -> str:
+    """Collapses whitespace so re-submitting the same prompt maps to the same key."""
+    return " ".join((request or "").split())
+
+
+class ResultCache:
+    """Stores final plot artifacts on disk with size and age based eviction."""
+
+    def __init__(self, cache_dir, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES, max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+
+    def make_key(self, state: dict) -> str:
+        """Builds the cache key for an initial graph state."""
+        payload = {
+            "version": CACHE_VERSION,
+            "data": hash_file(state.get("file_path")),
+            "reference_image": hash_file(state.get("reference_image_path")),
+            "request": normalize_request(state.get("user_request", "")),
+            "settings": key_settings(state),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _read_meta(self, entry: Path) -> Optional[dict]:
+        try:
+            with open(entry / "meta.json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, entry: Path, meta: dict):
+        tmp = entry / "meta.json.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        tmp.replace(entry / "meta.json")
+
+    def restore(self, key: str, state: dict) -> bool:
+        """Copies a cached entry to the output paths of `state`. Returns False on a miss."""
+        entry = self.cache_dir / key
+        with self._lock:
+            meta = self._read_meta(entry)
+            if meta is None:
+                return False
+            if time.time() - meta["created_at"] > self.max_age_seconds:
+                shutil.rmtree(entry, ignore_errors=True)
+                return False
+            for state_key, name in _ARTIFACTS.items():
+                if (entry / name).exists() and state.get(state_key):
+                    shutil.copyfile(entry / name, state[state_key])
+            meta["last_access"] = time.time()
+            self._write_meta(entry, meta)
+        return True
+
+    def store(self, key: str, state: dict):
+        """Saves the output artifacts of a successful run and applies eviction."""
+        if not all(state.get(k) and Path(state[k]).exists() for k in ("output_figure_path", "output_code_path")):
+            return
+        tmp_entry = self.cache_dir / f".{key}.tmp"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir(parents=True)
+        size = 0
+        for state_key, name in _ARTIFACTS.items():
+            if state.get(state_key) and Path(state[state_key]).exists():
+                shutil.copyfile(state[state_key], tmp_entry / name)
+                size += (tmp_entry / name).stat().st_size
+        now = time.time()
+        self._write_meta(tmp_entry, {"created_at": now, "last_access": now, "size": size})
+        with self._lock:
+            entry = self.cache_dir / key
+            shutil.rmtree(entry, ignore_errors=True)
+            tmp_entry.rename(entry)
+            self._evict()
+
+    def _evict(self):
+        """Drops expired entries, then least recently used ones until within limits."""
+        entries = []
+        now = time.time()
+        for entry in self.cache_dir.iterdir():
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            meta = self._read_meta(entry)
+            if meta is None or now - meta["created_at"] > self.max_age_seconds:
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            entries.append((meta["last_access"], meta["size"], entry))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+
+def cached_stream(agent_runnable, initial_state: dict, cache: Optional[ResultCache],
+                  bypass: bool = False, **stream_kwargs) -> Iterator[dict]:
+    """
+    Wraps `agent_runnable.stream()` with the result cache.
+
+    On a hit a single synthetic chunk is yielded and the stored artifacts are copied
+    to the output paths; on a miss the graph runs normally and a successful result
+    is stored. Pass `bypass=True` to always run the graph and skip storing.
+    """
+    if cache is None or bypass:
+        yield from agent_runnable.stream(initial_state, **stream_kwargs)
+        return
+
+    key = cache.make_key(initial_state)
+    if cache.restore(key, initial_state):
+        print("--- Result cache hit: returning stored plot without running the agent.")
+        hit_chunk = {"result_cache": {"current_step": "Loaded identical previous result from cache."}}
+        # With several stream modes LangGraph yields (mode, chunk) tuples
+        yield ("updates", hit_chunk) if isinstance(stream_kwargs.get("stream_mode"), list) else hit_chunk
+        return
+
+    yield from agent_runnable.stream(initial_state, **stream_kwargs)
+    cache.store(key, initial_state)
@@ -0,0 +1,82 @@
+# app/stage_limits.py
+"""
+Process-wide concurrency limits per pipeline stage.
+
+However many jobs or candidate scripts are running, at most `STAGE_LIMITS[stage]`
+text-model calls, vision-model calls and R executions are in flight at once; the
+rest wait for a slot. Limits are read from the environment at import time.
+
+Threads and coroutines share the same slots: `astage_slot` polls the semaphore
+instead of blocking, so waiting coroutines do not tie up the event loop or threads.
+"""
+
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict, Optional
+
+STAGE_LIMITS: Dict[str, int] = {
+    "llm": int(os.getenv("GGPLOTAGENT_MAX_CONCURRENT_LLM", "8")),
+    "vision": int(os.getenv("GGPLOTAGENT_MAX_CONCURRENT_VISION", "4")),
+    "r": int(os.getenv("GGPLOTAGENT_MAX_CONCURRENT_R", "4")),
+}
+# Waits longer than this are logged, to spot an undersized stage
+_SLOW_WAIT_SECONDS = 1.0
+# Polling interval bounds of coroutines waiting for a slot
+_ASYNC_POLL_MIN_SECONDS = 0.01
+_ASYNC_POLL_MAX_SECONDS = 0.25
+# How often a thread waiting with an `abort` event checks it
+ABORT_POLL_SECONDS = 0.25
+
+_semaphores: Dict[str, threading.BoundedSemaphore] = {
+    stage: threading.BoundedSemaphore(max(1, limit)) for stage, limit in STAGE_LIMITS.items()
+}
+
+
+class StageAborted(RuntimeError):
+    """Raised by `stage_slot` when its `abort` event is set before a slot frees up."""
+
+
+@contextmanager
+def stage_slot(stage: str, abort: Optional[threading.Event] = None):
+    """
+    Holds one of the `stage` slots for the duration of the block.
+
+    If `abort` is given and gets set while waiting, gives up with `StageAborted`
+    instead of taking a slot the caller no longer needs.
+    """
+    semaphore = _semaphores[stage]
+    started = time.monotonic()
+    if abort is None:
+        semaphore.acquire()
+    else:
+        while not semaphore.acquire(timeout=ABORT_POLL_SECONDS):
+            if abort.is_set():
+                raise StageAborted(f"Gave up waiting for a '{stage}' slot.")
+    waited = time.monotonic() - started
+    if waited > _SLOW_WAIT_SECONDS:
+        print(f"   > [QUEUE] Waited {waited:.1f}s for a free '{stage}' slot.")
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@asynccontextmanager
+async def astage_slot(stage: str):
+    """Async counterpart of `stage_slot`, sharing its limits."""
+    semaphore = _semaphores[stage]
+    started = time.monotonic()
+    delay = _ASYNC_POLL_MIN_SECONDS
+    while not semaphore.acquire(blocking=False):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, _ASYNC_POLL_MAX_SECONDS)
+    waited = time.monotonic() - started
+    if waited > _SLOW_WAIT_SECONDS:
+        print(f"   > [QUEUE] Waited {waited:.1f}s for a free '{stage}' slot.")
+    try:
+        yield
+    finally:
+        semaphore.release()
@@ -1,5 +1,6 @@
 # app/main.py (Now streamlit_app.py)
 import os
+import time
 import uuid
 import pandas as pd
 import shutil
@@ -9,12 +10,16 @@ from pathlib import Path
 
 # Import your existing agent logic and configuration
 
-from app.agent_logic import create_agent_runnable, CustomLLM, HumanMessage, AIMessage
+from app.agent_logic import create_agent_runnable, CustomLLM
+from app.r_executor import check_runtime_image, RuntimeImageError, R_DOCKER_IMAGE, R_EXEC_TIMEOUT
+from app.result_cache import ResultCache
+from app.llm_cache import get_llm_cache
+from app.job_queue import (JobQueue, QUEUED, SUCCEEDED, DEFAULT_BASE_URL, DEFAULT_MODEL, DEFAULT_VISION_MODEL,
+                           prepare_initial_state)
 
 
-DEFAULT_MODEL = "deepseek-v3-250324"
-DEFAULT_VISION_MODEL = "doubao-1-5-thinking-vision-pro-250428"
 TEMP_DIR = "temp_data"
+JOB_POLL_INTERVAL = 0.5  # seconds between job status polls
 
 
 os.makedirs(TEMP_DIR, exist_ok=True)
@@ -35,6 +40,8 @@ if "results" not in st.session_state:
     st.session_state.results = None
 if "old_temp_dir" not in st.session_state:
     st.session_state.old_temp_dir = None
+if "job_id" not in st.session_state:
+    st.session_state.job_id = None
 
 # --- Streamlit UI Configuration ---
 
@@ -78,13 +85,38 @@ def initialize_agent():
             # on-the-fly inside the agent nodes during each run.
             agent_runnable = create_agent_runnable()
         st.success("AI Agent compiled successfully!")
-        return agent_runnable
     except Exception as e:
         st.error(f"FATAL: Could not initialize LLM or compile agent. Error: {e}")
         return None
 
+    # Scripts run without network access, so the image must already provide every allowed package
+    try:
+        with st.spinner(f"Checking R runtime image '{R_DOCKER_IMAGE}'..."):
+            check_runtime_image()
+    except RuntimeImageError as e:
+        st.error(f"R runtime check failed: {e}")
+    return agent_runnable
+
 agent_runnable = initialize_agent()
 
+@st.cache_resource
+def get_result_cache():
+    """Shared cache of finished runs, kept outside the per-request temp directories."""
+    return ResultCache(Path(TEMP_DIR) / "result_cache")
+
+result_cache = get_result_cache()
+
+@st.cache_resource
+def get_job_queue():
+    """One queue and worker pool shared by every browser session."""
+    return JobQueue(agent_runnable, result_cache)
+
+job_queue = get_job_queue() if agent_runnable else None
+
+# Re-attach to a running or finished job after a page refresh
+if st.session_state.job_id is None and st.query_params.get("job"):
+    st.session_state.job_id = st.query_params.get("job")
+
 # --- Main UI ---
 
 st.title("📊 ggplotAgent")
@@ -127,7 +159,7 @@ with st.sidebar:
         st.subheader("Text Model API")
         base_url = st.text_input(
             "Base URL (Text)",
-            value="https://ark.cn-beijing.volces.com/api/v3",
+            value=DEFAULT_BASE_URL,
             help="The base URL for the OpenAI-compatible text API."
         )
         model_name = st.text_input(
@@ -144,7 +176,7 @@ with st.sidebar:
         st.subheader("Vision Model API")
         vision_base_url = st.text_input(
             "Base URL (Vision)",
-            value="https://ark.cn-beijing.volces.com/api/v3", # 默认值可能与文本模型相同
+            value=DEFAULT_BASE_URL, # 默认值可能与文本模型相同
             help="The base URL for the OpenAI-compatible vision API."
         )
         vision_model = st.text_input(
@@ -166,17 +198,136 @@ with st.sidebar:
             step=1,
             help="The maximum number of times the agent will try to debug a failed script."
         )
+        r_backend = st.selectbox(
+            "R Execution Backend",
+            options=["pool", "docker"],
+            index=0,
+            help="'pool' reuses warm R sessions with tidyverse and ggrepel preloaded; 'docker' starts a new container for every attempt."
+        )
+        parallel_candidates = st.number_input(
+            "Parallel Candidate Scripts",
+            min_value=1,
+            max_value=5,
+            value=1,
+            help="Generate several scripts at once (with different temperatures) and run them side by side; the first one that passes the visual check is kept. Uses more API calls and R workers."
+        )
+        r_timeout = st.number_input(
+            "R Time Limit (seconds)",
+            min_value=10,
+            max_value=1800,
+            value=int(R_EXEC_TIMEOUT),
+            step=10,
+            help="Each R script is stopped after this long and the debugger is asked for a faster version."
+        )
+        use_result_cache = st.checkbox(
+            "Reuse Cached Results",
+            value=True,
+            help="Return the stored plot instantly when the same data, request and models were already run. Uncheck to force a fresh run."
+        )
+        use_llm_cache = st.checkbox(
+            "Memoize LLM Responses",
+            value=False,
+            help="Reuse stored validator, planner and coder responses for identical prompts instead of calling the model again."
+        )
+        parallel_planning = st.checkbox(
+            "Speculative Planning",
+            value=False,
+            help="Validate the data and draft the plan at the same time; the plan is discarded and its request aborted if validation fails. Saves one model round trip on successful runs, at the cost of a partial planner call on rejected requests."
+        )
+        debug_patch_mode = st.checkbox(
+            "Patch-Mode Debugging",
+            value=False,
+            help="The debugger returns line edits to the failing script instead of rewriting it, which is much shorter to generate. Falls back to a full rewrite if the edits do not apply."
+        )
+        pipelined_execution = st.checkbox(
+            "Pipelined Execution",
+            value=False,
+            help="Check the R script for syntax errors while it is being generated, aborting early if it cannot parse, and warm an R worker as soon as the script header arrives."
+        )
+        downsample_for_render = st.checkbox(
+            "Thin Dense Scatter Data",
+            value=False,
+            help="For large scatter/volcano plots, keep all significant and extreme points but thin overplotted regions before rendering, so PNG/PDF export is faster."
+        )
+        use_style_cache = st.checkbox(
+            "Reuse Reference Image Analyses",
+            value=True,
+            help="Skip the vision call when a visually identical reference image was analyzed before with the same data columns."
+        )
+        two_phase_render = st.checkbox(
+            "Draft Renders for QA",
+            value=False,
+            help="Retries render a single low-resolution PNG for the visual check; the 300 dpi PNG and the PDF are rendered once, after the check passes."
+        )
+        draft_dpi = st.number_input(
+            "Draft DPI",
+            min_value=50,
+            max_value=300,
+            value=100,
+            step=25,
+            disabled=not two_phase_render
+        )
+        if use_llm_cache:
+            llm_cache_stats = get_llm_cache().stats()
+            st.caption(f"LLM cache: {llm_cache_stats['hits']} hits / {llm_cache_stats['misses']} misses")
 
     is_disabled = not all([agent_runnable, prompt, data_file])
     generate_button = st.button("Generate Plot", type="primary", use_container_width=True, disabled=is_disabled)
 
 # --- Main Content Area for Outputs ---
 
+def follow_job(job_id: str) -> dict:
+    """Polls a job until it finishes, showing its progress, and returns the results to display."""
+    with st.status("Agent is working...", expanded=True) as status:
+        st.write(f"🚀 Job `{job_id}` submitted. Waiting for progress...")
+        live_code = st.empty()
+        last_seq = 0
+        while True:
+            for event in job_queue.events(job_id, after_seq=last_seq):
+                last_seq = event.seq
+                if event.kind == "step":
+                    live_code.empty()
+                    status.update(label=event.message)
+                    st.write(f"🔄 {event.message}")
+            record = job_queue.get(job_id)
+            if record is None or record.finished:
+                break
+            if record.status == QUEUED:
+                status.update(label=f"Queued: {job_queue.position(job_id) or 0} job(s) ahead of yours...")
+            # Render the partially generated R script of the running job
+            live_text = job_queue.live_output(job_id)
+            if live_text:
+                live_code.code(live_text, language='r')
+            time.sleep(JOB_POLL_INTERVAL)
+        live_code.empty()
+
+        if record is not None and record.status == SUCCEEDED:
+            status.update(label="✅ Plot generated successfully!", state="complete", expanded=False)
+        else:
+            status.update(label="❌ Agent failed to generate the plot.", state="error", expanded=True)
+
+    if record is None:
+        return {"error": f"Job {job_id} was not found.", "success": False}
+    code_path = record.result.get("code_path")
+    if record.status == SUCCEEDED and code_path and Path(code_path).exists() and Path(record.result["figure_path"]).exists():
+        with open(code_path, "r", encoding="utf-8") as f:
+            r_code = f.read()
+        return {
+            "figure_path": record.result["figure_path"],
+            "pdf_path": record.result["pdf_path"],
+            "code": r_code,
+            "success": True
+        }
+    return {"error": record.error or "An unknown error occurred.", "success": False}
+
+
 if generate_button:
-    # Clean up the previous run's temporary directory if it exists
-    if st.session_state.old_temp_dir and st.session_state.old_temp_dir.exists():
+    # Clean up the previous run's temporary directory, unless its job is still running
+    previous_job = job_queue.get(st.session_state.job_id) if st.session_state.job_id else None
+    if st.session_state.old_temp_dir and st.session_state.old_temp_dir.exists() and (previous_job is None or previous_job.finished):
         shutil.rmtree(st.session_state.old_temp_dir, ignore_errors=True)
     st.session_state.results = None # Reset results for the new run
+    st.session_state.job_id = None
     # Validate inputs
     if not prompt:
         st.warning("Please enter a plot request.")
@@ -204,89 +355,44 @@ if generate_button:
             
             # 3. Prepare Initial State
             try:
-                df_head_str = pd.read_csv(data_file_path).head().to_string()
+                initial_state = prepare_initial_state(
+                    prompt, data_file_path, temp_dir_request,
+                    reference_image_path=ref_image_path,
+                    api_key=api_key,
+                    vision_api_key=vision_api_key,
+                    base_url=base_url,
+                    model_name=model_name,
+                    vision_model=DEFAULT_VISION_MODEL,
+                    vision_base_url=vision_base_url,
+                    max_retries=max_retries_input,
+                    r_backend=r_backend,
+                    r_timeout=r_timeout,
+                    llm_cache=use_llm_cache,
+                    pipelined_execution=pipelined_execution,
+                    downsample_for_render=downsample_for_render,
+                    style_cache=use_style_cache,
+                    parallel_candidates=parallel_candidates,
+                    parallel_planning=parallel_planning,
+                    debug_patch_mode=debug_patch_mode,
+                    two_phase_render=two_phase_render,
+                    draft_dpi=draft_dpi
+                )
             except Exception as e:
                 st.error(f"Error reading provided CSV file: {e}")
                 # Stop execution if CSV is invalid
                 st.stop()
-            
-            output_figure_path = temp_dir_request / "output_figure.png"
-            output_pdf_path = temp_dir_request / "output_figure.pdf"
-            output_code_path = temp_dir_request / "output_script.R"
-
-            initial_state = {
-                "messages": [HumanMessage(content=prompt)],
-                "user_request": prompt,
-                "file_path": str(data_file_path.absolute()),
-                "reference_image_path": str(ref_image_path.absolute()) if ref_image_path else None,
-                "dataframe_head": df_head_str,
-                "output_code_path": str(output_code_path.absolute()),
-                "output_figure_path": str(output_figure_path.absolute()),
-                "output_pdf_path": str(output_pdf_path.absolute()),
-                "retry_count": 0,
-                "bypass_confirmation": True,
-                "error_history": [],
-                "base_url": base_url,
-                "model_name": model_name,
-                "api_key": api_key,
-                "vision_api_key": vision_api_key,
-                "vision_model": DEFAULT_VISION_MODEL,
-                "vision_base_url": vision_base_url,
-                "max_retries": max_retries_input
-            }
-
-            # --- Stream Agent Execution ---
-            final_state = {}
-            with st.status("Agent is working...", expanded=True) as status:
-                st.write("🚀 Agent initiated. Starting process...")
-                
-                # The .stream() method yields a dictionary for each step, 
-                # with the key being the node name and the value being its output.
-                for state_chunk in agent_runnable.stream(initial_state):
-                    # state_chunk is typically like {'node_name': {'messages': [...], 'current_step': '...'}}
-                    
-                    # Check if the final state is in the current chunk
-                    if "__end__" in state_chunk:
-                        final_state = state_chunk["__end__"]
-                    
-                    # We iterate through the values of the chunk. Usually there's only one.
-                    for node_output in state_chunk.values():
-                        # Ensure the output is a dictionary before trying to access it
-                        if isinstance(node_output, dict):
-                            # Check for the progress update message
-                            current_step_desc = node_output.get("current_step")
-                            if current_step_desc:
-                                status.update(label=current_step_desc)
-                                st.write(f"🔄 {current_step_desc}")
-
-                # After the loop, update the status based on the final outcome
-                if output_figure_path.exists():
-                     status.update(label="✅ Plot generated successfully!", state="complete", expanded=False)
-                else:
-                     status.update(label="❌ Agent failed to generate the plot.", state="error", expanded=True)
 
-            
-            if output_figure_path.exists():
-                with open(output_code_path, "r", encoding="utf-8") as f:
-                    r_code = f.read()
-                
-                st.session_state.results = {
-                    "figure_path": str(output_figure_path),
-                    "pdf_path": str(output_pdf_path),
-                    "code": r_code,
-                    "success": True
-                }
-            else:
-                error_message = "An unknown error occurred."
-                if final_state and final_state.get('messages'):
-                     error_message = final_state.get('messages')[-1].content
-                st.session_state.results = {
-                    "error": error_message,
-                    "success": False
-                }            
+            # --- Submit to the job queue; the run survives page refreshes ---
+            job_id = job_queue.submit(initial_state, use_result_cache=use_result_cache)
+            st.session_state.job_id = job_id
+            st.query_params["job"] = job_id
         except Exception as e:
             st.error(f"Error processing your request: {e}")
 
+# --- Follow the current job until it finishes ---
+if st.session_state.job_id and st.session_state.results is None and job_queue:
+    st.session_state.results = follow_job(st.session_state.job_id)
+
                 
 # --- Display results if they exist in session state ---
 if st.session_state.results:
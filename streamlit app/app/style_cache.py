@@ -0,0 +1,202 @@
+# app/style_cache.py
+"""
+Cache of style specifications extracted from reference images.
+
+Entries are keyed on a fingerprint of the image plus the available data columns and
+the vision model, so re-uploads of the same figure skip the vision call. The same
+bytes always hit. A re-saved, resized or recompressed copy hits when its perceptual
+difference hash (dHash, 16x16 grayscale gradients) is within `max_distance` bits of a
+stored one and its coarse colour histogram is within `max_colour_distance`, so figures
+with the same layout but other colours or finer details are analyzed again. Entries
+expire after a TTL and the least recently used ones are evicted beyond `max_entries`.
+"""
+
+import os
+import time
+import sqlite3
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+try:
+    from PIL import Image
+except ImportError:  # without Pillow reference images are never cached
+    Image = None
+
+STYLE_CACHE_PATH = os.getenv("GGPLOTAGENT_STYLE_CACHE_PATH", os.path.join("temp_data", "style_cache.sqlite"))
+STYLE_CACHE_TTL_SECONDS = float(os.getenv("GGPLOTAGENT_STYLE_CACHE_TTL", str(30 * 24 * 3600)))
+STYLE_CACHE_MAX_ENTRIES = int(os.getenv("GGPLOTAGENT_STYLE_CACHE_MAX_ENTRIES", "500"))
+DHASH_SIZE = 16
+# Hamming distance (out of DHASH_SIZE**2 = 256 bits) under which two images can count as the same figure
+STYLE_CACHE_MAX_DISTANCE = int(os.getenv("GGPLOTAGENT_STYLE_CACHE_MAX_DISTANCE", "16"))
+# Share of foreground pixels (0-1) allowed to fall in other colour bins for a near match
+STYLE_CACHE_MAX_COLOUR_DISTANCE = float(os.getenv("GGPLOTAGENT_STYLE_CACHE_MAX_COLOUR_DISTANCE", "0.25"))
+_COLOUR_LEVELS = 4  # per RGB channel, so 64 histogram bins
+
+
+@dataclass
+class ImageFingerprint:
+    """What a reference image is matched on: its exact bytes, its layout and its colours."""
+    sha256: str
+    dhash: int
+    colours: Tuple[float, ...]
+
+
+def dhash(image, hash_size: int = DHASH_SIZE) -> int:
+    """Difference hash: compares neighbouring pixels of a (hash_size + 1) x hash_size grayscale thumbnail."""
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | int(left > right)
+    return value
+
+
+def colour_histogram(image, size: int = 64) -> Tuple[float, ...]:
+    """
+    Share of the foreground pixels of a size x size thumbnail in each of the coarse RGB colour bins.
+
+    The most frequent bin is taken as the background and left out, so thin points and
+    lines weigh as much as they do to a reader, not as little as their pixel count.
+    """
+    step = 256 // _COLOUR_LEVELS
+    counts = [0] * _COLOUR_LEVELS ** 3
+    # Box averaging: stable under recompression while small marks keep most of their colour
+    for r, g, b in image.convert("RGB").resize((size, size), Image.BOX).getdata():
+        counts[(r // step * _COLOUR_LEVELS + g // step) * _COLOUR_LEVELS + b // step] += 1
+    counts[counts.index(max(counts))] = 0
+    total = sum(counts) or 1
+    return tuple(round(count / total, 4) for count in counts)
+
+
+def colour_distance(a, b) -> float:
+    """Total variation distance between two colour histograms: 0 for the same colours, 1 for disjoint ones."""
+    return sum(abs(x - y) for x, y in zip(a, b)) / 2
+
+
+def fingerprint_image(image_path: str) -> Optional[ImageFingerprint]:
+    """
+    Fingerprints a reference image for the style cache.
+
+    Returns None when Pillow is unavailable or the image cannot be decoded.
+    """
+    if Image is None:
+        return None
+    try:
+        with open(image_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with Image.open(image_path) as image:
+            return ImageFingerprint(digest, dhash(image), colour_histogram(image))
+    except Exception as e:
+        print(f"   > [WARNING] Could not hash reference image: {e}")
+        return None
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def columns_key(columns: List[str], vision_model: str) -> str:
+    return hashlib.sha256(f"{vision_model}|{'|'.join(sorted(columns))}".encode("utf-8")).hexdigest()
+
+
+class StyleSpecCache:
+    """SQLite-backed, nearest-hash lookup of reference image style specifications."""
+
+    def __init__(self, path: str = STYLE_CACHE_PATH, ttl_seconds: float = STYLE_CACHE_TTL_SECONDS,
+                 max_entries: int = STYLE_CACHE_MAX_ENTRIES, max_distance: int = STYLE_CACHE_MAX_DISTANCE,
+                 max_colour_distance: float = STYLE_CACHE_MAX_COLOUR_DISTANCE):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.max_colour_distance = max_colour_distance
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            # Hashes are stored as hex text: 64-bit values overflow SQLite's signed INTEGER
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS style_cache ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, phash TEXT NOT NULL, columns_key TEXT NOT NULL, "
+                "spec TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS style_cache_columns ON style_cache (columns_key)")
+            # Entries of caches created before images were fingerprinted have neither; they never match
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(style_cache)")}
+            for column in ("sha256", "colours"):
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE style_cache ADD COLUMN {column} TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # commits on success
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, fingerprint: ImageFingerprint, key: str) -> Optional[str]:
+        """
+        Returns the spec of the same image or, failing that, of the nearest stored image
+        within `max_distance` bits and `max_colour_distance`; None otherwise.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, sha256, phash, colours, spec FROM style_cache "
+                "WHERE columns_key = ? AND created_at >= ? AND colours IS NOT NULL",
+                (key, now - self.ttl_seconds)
+            ).fetchall()
+            candidates = []
+            for row_id, digest, h, colours, spec in rows:
+                if digest == fingerprint.sha256:
+                    candidates = [(-1, row_id, spec)]
+                    break
+                distance = hamming_distance(fingerprint.dhash, int(h, 16))
+                if (distance <= self.max_distance
+                        and colour_distance(fingerprint.colours, json.loads(colours)) <= self.max_colour_distance):
+                    candidates.append((distance, row_id, spec))
+            best = min(candidates, default=None)
+            if best is None:
+                return None
+            conn.execute("UPDATE style_cache SET last_access = ? WHERE id = ?", (now, best[1]))
+            return best[2]
+
+    def set(self, fingerprint: ImageFingerprint, key: str, spec: str) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM style_cache WHERE sha256 = ? AND columns_key = ?", (fingerprint.sha256, key))
+            conn.execute(
+                "INSERT INTO style_cache (sha256, phash, colours, columns_key, spec, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fingerprint.sha256, f"{fingerprint.dhash:064x}", json.dumps(fingerprint.colours), key, spec, now, now)
+            )
+            conn.execute("DELETE FROM style_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM style_cache WHERE id IN (SELECT id FROM style_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM style_cache")
+
+
+_style_cache: Optional[StyleSpecCache] = None
+_style_cache_lock = threading.Lock()
+
+
+def get_style_cache() -> StyleSpecCache:
+    """Returns the process-wide style cache, created on first use."""
+    global _style_cache
+    with _style_cache_lock:
+        if _style_cache is None:
+            _style_cache = StyleSpecCache()
+        return _style_cache
@@ -0,0 +1,77 @@
+from app.error_history import compact_stderr, estimate_tokens, format_error_history, parse_history_entry
+
+
+def entry(number, script, error):
+    return f"ATTEMPT {number} FAILED\n--- SCRIPT ---\n{script}\n--- ERROR ---\n{error}"
+
+
+SCRIPT_A = "library(ggplot2)\ndata <- read.csv(\"__INPUT_FILE__\")\nfinal_plot <- ggplot(data, aes(x, y))"
+SCRIPT_B = SCRIPT_A + " + geom_point()"
+
+
+def test_parse_history_entry():
+    attempt = parse_history_entry(entry(2, SCRIPT_A, "Error: object 'x' not found"))
+    assert attempt.header == "ATTEMPT 2 FAILED"
+    assert attempt.script == SCRIPT_A
+    assert attempt.error == "Error: object 'x' not found"
+
+
+def test_compact_stderr_drops_startup_noise():
+    stderr = "── Attaching core tidyverse packages ──\n✔ dplyr 1.1.4\nError in f(): boom\nCalls: f\nExecution halted"
+    assert compact_stderr(stderr) == "Error in f(): boom\nCalls: f\nExecution halted"
+
+
+def test_compact_stderr_keeps_head_and_tail():
+    stderr = "Error: first\n" + "\n".join(f"line {i}" for i in range(100)) + "\nlast line"
+    compacted = compact_stderr(stderr, max_lines=9).splitlines()
+    assert compacted[0] == "Error: first"
+    assert compacted[-1] == "last line"
+    assert "lines omitted" in compacted[6]
+
+
+def test_repeated_script_is_shown_once_with_its_newest_attempt():
+    history = format_error_history([entry(1, SCRIPT_A, "Error: one"), entry(2, SCRIPT_A, "Error: two")])
+    assert history.count(SCRIPT_A) == 1
+    assert "(identical to the script of attempt 2)" in history
+    assert history.index("identical to the script of attempt 2") < history.index(SCRIPT_A)
+
+
+def test_script_identical_to_current_is_referenced():
+    history = format_error_history([entry(1, SCRIPT_A, "Error: one")], current_script=SCRIPT_A + "\n")
+    assert SCRIPT_A not in history
+    assert "(identical to the current script)" in history
+
+
+def test_scripts_can_be_left_out():
+    history = format_error_history([entry(1, SCRIPT_A, "Error: one")], include_scripts=False)
+    assert "--- SCRIPT ---" not in history
+    assert "Error: one" in history
+
+
+def test_older_attempts_are_summarized_when_over_budget():
+    entries = [entry(n, f"{SCRIPT_A}\n# attempt {n}\n" + "x <- 1\n" * 50, f"Error: failure {n}") for n in range(1, 6)]
+    history = format_error_history(entries, token_budget=300)
+    assert history.startswith("(")
+    summary = history.split("\n", 1)[0]
+    assert "earlier attempt(s) summarized" in summary
+    assert "ATTEMPT 1 FAILED: Error: failure 1" in summary
+    assert "# attempt 5" in history
+    assert "# attempt 1" not in history
+
+
+def test_oversized_newest_attempt_keeps_its_script_whole_or_not_at_all():
+    long_error = "Error: head of the error\n" + "\n".join(f"detail {i} " + "y" * 80 for i in range(20)) + "\nExecution halted"
+    long_script = SCRIPT_B + "\n" + "\n".join(f"z{i} <- {i}" for i in range(300))
+    history = format_error_history([entry(1, long_script, long_error)], token_budget=200)
+    assert "library(ggplot2)" not in history or long_script in history
+    assert "(omitted to fit the prompt; see the current script)" in history
+    assert "Error: head of the error" in history
+    assert history.rstrip().endswith("Execution halted")
+    assert "characters omitted" in history
+    assert estimate_tokens(history) <= 200
+
+
+def test_oversized_attempt_matching_current_script_keeps_the_reference():
+    history = format_error_history([entry(1, SCRIPT_A, "Error: " + "e" * 5000)], current_script=SCRIPT_A, token_budget=100)
+    assert "(identical to the current script)" in history
+    assert SCRIPT_A not in history
@@ -0,0 +1,79 @@
+from app.r_fixes import (apply_fix_rules, fix_ggrepel_namespace, fix_invalid_colour_name, fix_mangled_column_name,
+                         fix_placeholder_quoting, list_fix_rules)
+
+CONTEXT = {"available_columns": ["gene name", "log2 FC", "p"]}
+
+
+def test_rules_are_registered_in_order():
+    assert list_fix_rules() == ["mangled_column_name", "placeholder_quoting", "ggrepel_namespace", "invalid_colour_name"]
+
+
+def test_mangled_column_name():
+    script = 'final_plot <- ggplot(data, aes(x = log2_FC, y = p, label = gene_name)) + labs(x = "log2_FC") # log2_FC'
+    fixed = fix_mangled_column_name(script, "Error: object 'log2_FC' not found", CONTEXT)
+    assert fixed == 'final_plot <- ggplot(data, aes(x = log2.FC, y = p, label = gene_name)) + labs(x = "log2_FC") # log2_FC'
+
+
+def test_mangled_column_name_backticks():
+    script = "final_plot <- ggplot(data, aes(label = `gene name`))"
+    fixed = fix_mangled_column_name(script, "Error: object 'gene name' not found", CONTEXT)
+    assert fixed == "final_plot <- ggplot(data, aes(label = gene.name))"
+
+
+def test_mangled_column_name_no_op():
+    script = "final_plot <- ggplot(data, aes(x = gene.name, y = q))"
+    # Already the name read.csv produces, an unrelated name, no columns, or another error
+    assert fix_mangled_column_name(script, "object 'gene.name' not found", CONTEXT) is None
+    assert fix_mangled_column_name(script, "object 'q' not found", CONTEXT) is None
+    assert fix_mangled_column_name(script, "object 'gene_name' not found", {}) is None
+    assert fix_mangled_column_name(script, "could not find function \"ggplot\"", CONTEXT) is None
+
+
+def test_placeholder_quoting():
+    script = "data <- read.csv('__INPUT_FILE__')\nggsave(\"'__OUTPUT_PNG_FILE__'\", final_plot)\nggsave(__OUTPUT_PDF_FILE__)"
+    fixed = fix_placeholder_quoting(script, "cannot open file ''__INPUT_FILE__'': No such file", {})
+    assert fixed == 'data <- read.csv("__INPUT_FILE__")\nggsave("__OUTPUT_PNG_FILE__", final_plot)\nggsave("__OUTPUT_PDF_FILE__")'
+
+
+def test_placeholder_quoting_no_op():
+    script = "data <- read.csv('__INPUT_FILE__')"
+    assert fix_placeholder_quoting(script, "object 'x' not found", {}) is None
+    quoted = 'data <- read.csv("__INPUT_FILE__")'
+    assert fix_placeholder_quoting(quoted, "cannot open file", {}) == quoted
+
+
+def test_ggrepel_namespace():
+    script = 'final_plot <- p + geom_text_repel(aes(label = g)) + geom_label_repel (data = top)\n# geom_text_repel(\nlabs(caption = "geom_text_repel()")'
+    fixed = fix_ggrepel_namespace(script, 'Error in geom_text_repel(): could not find function "geom_text_repel"', {})
+    assert fixed == ('final_plot <- p + ggrepel::geom_text_repel(aes(label = g)) + ggrepel::geom_label_repel(data = top)\n'
+                     '# geom_text_repel(\nlabs(caption = "geom_text_repel()")')
+
+
+def test_ggrepel_namespace_no_op():
+    script = "final_plot <- p + ggrepel::geom_text_repel(aes(label = g))"
+    assert fix_ggrepel_namespace(script, 'could not find function "geom_text_repel"', {}) == script
+    assert fix_ggrepel_namespace(script, 'could not find function "geom_pointt"', {}) is None
+
+
+def test_invalid_colour_name():
+    script = 'p + scale_colour_manual(values = c(up = "lightred", down = "Dark Blue", ns = "blurple"))'
+    assert fix_invalid_colour_name(script, "Error: Unknown colour name: lightred", {}) == \
+        'p + scale_colour_manual(values = c(up = "salmon", down = "Dark Blue", ns = "blurple"))'
+    assert fix_invalid_colour_name(script, "invalid color name 'Dark Blue'", {}) == \
+        'p + scale_colour_manual(values = c(up = "lightred", down = "darkblue", ns = "blurple"))'
+    assert fix_invalid_colour_name(script, "Unknown colour name: blurple", {}) == \
+        'p + scale_colour_manual(values = c(up = "lightred", down = "Dark Blue", ns = "grey50"))'
+
+
+def test_invalid_colour_name_no_op():
+    assert fix_invalid_colour_name('p + geom_point(colour = "red")', "object 'x' not found", {}) is None
+
+
+def test_apply_fix_rules_returns_first_change_and_skips_applied():
+    script = "data <- read.csv('__INPUT_FILE__')\nfinal_plot <- ggplot(data, aes(x = log2_FC))"
+    error = "Error: object 'log2_FC' not found"
+    signature, fixed = apply_fix_rules(script, error, CONTEXT)
+    assert signature == "mangled_column_name: Error: object 'log2_FC' not found"
+    assert "aes(x = log2.FC)" in fixed
+    # A rule already applied to this error falls through to the debugger
+    assert apply_fix_rules(script, error, CONTEXT, already_applied={signature}) is None
@@ -0,0 +1,74 @@
+import pytest
+
+from app.r_patch import PatchError, apply_patch, number_lines
+
+SCRIPT = "\n".join(f"line {i}" for i in range(1, 31))
+
+
+def lines_of(script):
+    return script.split("\n")
+
+
+def test_number_lines():
+    assert number_lines("a\nb").split("\n") == ["1| a", "2| b"]
+    assert number_lines(SCRIPT).split("\n")[0] == " 1| line 1"
+
+
+def test_replace_insert_and_delete():
+    patched = apply_patch(SCRIPT, "@@ REPLACE 2-3\nnew 2\n@@ INSERT AFTER 5\ninserted\n@@ DELETE 30\n@@ END")
+    result = lines_of(patched)
+    assert result[:7] == ["line 1", "new 2", "line 4", "line 5", "inserted", "line 6", "line 7"]
+    assert result[-1] == "line 29"
+
+
+def test_line_number_prefixes_are_stripped():
+    patched = apply_patch(SCRIPT, "```\n@@ REPLACE 4\n 4| x <- 1\n10|y <- 2\n@@ END\n```")
+    assert lines_of(patched)[3:5] == ["x <- 1", "y <- 2"]
+
+
+def test_overlapping_edits_are_rejected():
+    with pytest.raises(PatchError, match="Overlapping edits"):
+        apply_patch(SCRIPT, "@@ REPLACE 2-4\na\n@@ DELETE 4-5\n@@ END")
+
+
+@pytest.mark.parametrize("edit", ["@@ REPLACE 29-31\nx", "@@ DELETE 0", "@@ INSERT AFTER 31\nx"])
+def test_out_of_range_edits_are_rejected(edit):
+    with pytest.raises(PatchError, match="outside the script"):
+        apply_patch(SCRIPT, edit + "\n@@ END")
+
+
+def test_reversed_range_is_rejected():
+    with pytest.raises(PatchError, match="Invalid line range"):
+        apply_patch(SCRIPT, "@@ REPLACE 5-3\nx\n@@ END")
+
+
+def test_response_without_edits_is_rejected():
+    with pytest.raises(PatchError, match="No edits"):
+        apply_patch(SCRIPT, "The script looks fine to me.")
+
+
+def test_unified_diff_applies_at_stated_line():
+    diff = "--- a/script.R\n+++ b/script.R\n@@ -10,3 +10,3 @@\n line 10\n-line 11\n+fixed 11\n line 12"
+    assert lines_of(apply_patch(SCRIPT, diff))[9:12] == ["line 10", "fixed 11", "line 12"]
+
+
+def test_unified_diff_hunk_within_offset_is_found():
+    # Stated 6 lines too early, still within the allowed drift
+    diff = "@@ -14,2 +14,2 @@\n line 20\n-line 21\n+fixed 21"
+    assert lines_of(apply_patch(SCRIPT, diff))[20] == "fixed 21"
+
+
+def test_unified_diff_hunk_beyond_offset_is_rejected():
+    with pytest.raises(PatchError, match="does not match"):
+        apply_patch(SCRIPT, "@@ -1,2 +1,2 @@\n line 25\n-line 26\n+fixed 26")
+
+
+def test_unified_diff_strips_line_number_prefixes():
+    diff = "@@ -3,2 +3,2 @@\n  3| line 3\n- 4| line 4\n+ 4| fixed 4"
+    assert lines_of(apply_patch(SCRIPT, diff))[2:4] == ["line 3", "fixed 4"]
+
+
+def test_overlapping_hunks_are_rejected():
+    diff = "@@ -5,2 +5,1 @@\n line 5\n-line 6\n@@ -6,2 +6,1 @@\n line 6\n-line 7"
+    with pytest.raises(PatchError, match="Overlapping diff hunks"):
+        apply_patch(SCRIPT, diff)
@@ -0,0 +1,108 @@
+from app.r_static import IncrementalRParser, find_unknown_columns, preflight_check, r_make_names, r_syntax_error
+
+ALLOWED = ("tidyverse", "ggrepel")
+VALID_SCRIPT = """library(tidyverse)
+data <- read.csv("__INPUT_FILE__")
+final_plot <- ggplot(data, aes(x = gene_length, y = expression)) + geom_point()
+ggsave("__OUTPUT_PNG_FILE__", plot = final_plot, width = 6, height = 4)
+ggsave(filename = "__OUTPUT_PDF_FILE__", plot = final_plot, width = 6, height = 4)
+"""
+COLUMNS = ["gene_length", "expression"]
+
+
+def parse_completion(text, chunk_size=7):
+    parser = IncrementalRParser(completion=True)
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    return parser, parser.close()
+
+
+def check_names(script, columns=COLUMNS):
+    return [name for name, _ in preflight_check(script, columns, ALLOWED)]
+
+
+def test_completion_skips_prose_apostrophes():
+    parser, error = parse_completion("Here's the script you asked for:\n```r\nlibrary(ggrepel)\nx <- c(1, 2)\n```\nIt's done.\n")
+    assert error is None
+    assert parser.libraries == ["ggrepel"]
+
+
+def test_completion_skips_thinking_block():
+    text = "<thinking>\nI'll use (a bracket here\n</thinking>\nlibrary(tidyverse)\nfinal_plot <- ggplot()\n"
+    parser, error = parse_completion(text)
+    assert error is None
+    assert parser.libraries == ["tidyverse"]
+
+
+def test_completion_stops_at_closing_fence():
+    _, error = parse_completion("```r\nx <- list(a = 1)\n```\nNote: the ) above closes the list.\n")
+    assert error is None
+
+
+def test_on_library_called_once_with_first_package():
+    seen = []
+    parser = IncrementalRParser(on_library=seen.append)
+    parser.feed("library(tidyverse)\nlibrary(ggrepel)\n")
+    assert seen == ["tidyverse"]
+    assert parser.libraries == ["tidyverse", "ggrepel"]
+
+
+def test_brackets_in_strings_and_comments_are_ignored():
+    assert r_syntax_error('x <- "a ) b" # stray ] here\ny <- \'(\'\nz <- `odd)name`\n') is None
+
+
+def test_escaped_quote_keeps_string_open():
+    assert r_syntax_error('x <- c("say \\"hi\\" (")\n') is None
+    assert r_syntax_error('x <- "unterminated\n') == 'Unterminated string starting with "'
+
+
+def test_mismatched_and_unclosed_brackets():
+    assert r_syntax_error("x <- c(1, 2]\n") == "Unexpected ']' on line 1: '(' opened on line 1 is still open"
+    assert r_syntax_error("x <- 1)\n") == "Unexpected ')' on line 1"
+    assert r_syntax_error("f <- function() {\n  1\n") == "Unclosed '{' opened on line 1"
+
+
+def test_make_names_matches_r():
+    # make.names(c("a b", "1x", "_y", ".2z", "ok", "ok", "", "a-b", ".x"), unique = TRUE)
+    names = ["a b", "1x", "_y", ".2z", "ok", "ok", "", "a-b", ".x"]
+    assert r_make_names(names) == ["a.b", "X1x", "X_y", "X.2z", "ok", "ok.1", "X", "a.b.1", ".x"]
+
+
+def test_unknown_columns_respect_make_names_and_created_names():
+    script = """data <- as.data.frame(arrow::read_feather("__INPUT_DATA__"))
+data$log_len <- log(data$gene.length)
+final_plot <- ggplot(data, aes(x = log_len, y = expresion, colour = group)) + geom_point()
+"""
+    assert find_unknown_columns(script, ["gene length", "expression", "group"]) == ["expresion"]
+
+
+def test_valid_script_passes_preflight():
+    assert preflight_check(VALID_SCRIPT, COLUMNS, ALLOWED) == []
+
+
+def test_preflight_syntax():
+    assert check_names(VALID_SCRIPT.replace("geom_point()", "geom_point(")) == ["syntax"]
+
+
+def test_preflight_library():
+    assert check_names("library(plotly)\n" + VALID_SCRIPT) == ["library"]
+
+
+def test_preflight_final_plot():
+    assert check_names(VALID_SCRIPT.replace("final_plot <-", "p <-")) == ["final_plot"]
+
+
+def test_preflight_ggsave():
+    script = VALID_SCRIPT.replace('ggsave(filename = "__OUTPUT_PDF_FILE__"', 'ggsave("plot.pdf"')
+    assert preflight_check(script, COLUMNS, ALLOWED) == [
+        ("ggsave", 'Missing `ggsave("__OUTPUT_PDF_FILE__", plot = final_plot, ...)` for the PDF output.')]
+
+
+def test_preflight_input_file():
+    assert check_names(VALID_SCRIPT.replace('"__INPUT_FILE__"', '"data.csv"')) == ["input_file"]
+
+
+def test_preflight_columns():
+    assert check_names(VALID_SCRIPT.replace("y = expression", "y = expr")) == ["columns"]
+    # Without known columns the check is skipped
+    assert check_names(VALID_SCRIPT.replace("y = expression", "y = expr"), columns=[]) == []